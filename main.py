@@ -1,43 +1,98 @@
+import os
 import sys
 
-import src.file_parse as file_parse
+from timeit import default_timer as timer
+
+# Only the modules every run needs are imported here. The renderers are imported where they are
+# used, so a run loads NumPy and the engine it renders with, and nothing else.
+import src.instrument as instrument
 import src.utils as utils
-import src.scene as scene
-import src.raytracer as raytracer
+
 # Main method
 if __name__ == "__main__":
     # get the file name
     args = sys.argv
     cmnd_line_args = utils.parse_args(args)
+    if cmnd_line_args.stats:
+        instrument.enable()
+    if cmnd_line_args.jit:
+        import src.jit as jit
+        if not jit.enable():
+            print("Numba is not installed, rendering without --jit", file=sys.stderr)
+
+    antialias_settings = None
+    if cmnd_line_args.antialias:
+        import src.antialias as antialias
+        antialias_settings = antialias.Settings(cmnd_line_args.aa_threshold, cmnd_line_args.aa_samples,
+                                                cmnd_line_args.aa_max_samples)
+
+    if cmnd_line_args.is_many:
+        # render every scene in this run, each on one worker
+        import src.corpus as corpus
+        start = timer()
+        scenes = corpus.find_scenes(cmnd_line_args.files)
+        settings = corpus.Settings(cmnd_line_args.output_dir, cmnd_line_args.accel, cmnd_line_args.cache_dir,
+                                   cmnd_line_args.seed, cmnd_line_args.samples, antialias_settings)
+        results = corpus.render_all(scenes, settings, cmnd_line_args.workers)
+        elapsed = timer() - start
+        print(corpus.summary(results, elapsed))
+        if cmnd_line_args.output_dir is not None:
+            corpus.write_summary(os.path.join(cmnd_line_args.output_dir, corpus.SUMMARY), results, elapsed,
+                                 cmnd_line_args.workers)
+        if instrument.enabled:
+            print(instrument.report())
+        if cmnd_line_args.stats_json is not None:
+            instrument.write_json(cmnd_line_args.stats_json)
+        sys.exit(1 if any(result.error is not None for result in results) else 0)
 
     # open the file
-    with open(cmnd_line_args.file, "r") as file:
-        lines = file.readlines()
-        # Read the first line to determine meta info about the file
-        first_line: str
-        if lines:
-            first_line = lines[0]
-        else:
-            raise Exception("Not Enough Lines")
-        
-        # Get the image info from the first line
-        image_info = file_parse.get_image_info(first_line)
-        scene_meta = scene.SceneMata(
-            height=image_info.height,
-            width=image_info.width
-        )
-        scene_objects = scene.SceneObjects()
-        if len(lines) > 1:
-            for i in range(1, len(lines)):
-                line = utils.line_to_list(lines[i])
-                # If the line is empty, do nothing
-                if not line:
-                    pass
-                else:
-                    file_parse.parse_line(line, scene_objects, scene_meta)
-
-        # make the image
-        image = utils.make_images(image_info)
-        raytracer.raytrace_scene(scene_objects, scene_meta, image)
-        # Do the actual raytracing with the image and the 
-        image.save(image_info.filename)
+    if cmnd_line_args.engine != "reference" and cmnd_line_args.cache_dir is not None:
+        import src.cache as cache
+        image_info, scene_meta, compiled_scene = cache.load_scene(
+            cmnd_line_args.file, cmnd_line_args.cache_dir, cmnd_line_args.accel)
+    else:
+        import src.file_parse as file_parse
+        with open(cmnd_line_args.file, "r") as file:
+            if cmnd_line_args.engine == "reference":
+                image_info, scene_meta, scene_objects = file_parse.parse_file(file)
+            else:
+                image_info, scene_meta, compiled_scene = file_parse.stream_scene(file, cmnd_line_args.accel)
+    if cmnd_line_args.samples is not None:
+        scene_meta.samples = cmnd_line_args.samples
+
+    if not image_info.is_single_file:
+        if cmnd_line_args.engine == "reference":
+            sys.exit("The reference engine renders single images only")
+        if cmnd_line_args.progressive:
+            sys.exit("--progressive renders single images only")
+        # render every frame of the animation, sharing what was parsed so far
+        import src.animation as animation
+        import src.file_parse as file_parse
+        with open(cmnd_line_args.file, "r") as file:
+            sections = file_parse.frame_sections(file, image_info.number_of_images)
+        animation.render_animation(compiled_scene, scene_meta, sections, utils.make_filename_list(image_info),
+                                   workers=cmnd_line_args.workers, accel=cmnd_line_args.accel,
+                                   seed=cmnd_line_args.seed, antialias_settings=antialias_settings)
+        if cmnd_line_args.stats_json is not None:
+            instrument.write_json(cmnd_line_args.stats_json)
+        sys.exit()
+
+    # make the image
+    image = utils.make_images(image_info)
+    # Do the actual raytracing with the image and the scene
+    if cmnd_line_args.engine == "reference":
+        import src.raytracer as raytracer
+        raytracer.raytrace_scene(scene_objects, scene_meta, image, seed=cmnd_line_args.seed)
+    elif cmnd_line_args.progressive:
+        import src.progressive as progressive
+        progressive.raytrace_scene(compiled_scene, scene_meta, image, image_info.filename,
+                                   time_budget=cmnd_line_args.time_budget,
+                                   preview_interval=cmnd_line_args.preview_interval,
+                                   seed=cmnd_line_args.seed)
+    else:
+        import src.tiles as tiles
+        tiles.raytrace_scene(compiled_scene, scene_meta, image, workers=cmnd_line_args.workers,
+                             seed=cmnd_line_args.seed, antialias_settings=antialias_settings)
+    image.save(image_info.filename)
+    if cmnd_line_args.stats_json is not None:
+        instrument.write_json(cmnd_line_args.stats_json)
@@ -1,11 +1,10 @@
 #!/bin/zsh
-# shopt -s nullglob
+# render every scene in one run, then compare each image with the expected one
+make build
+venv/bin/python3 main.py test/test_files --workers 0
 for file in test/test_files/*.txt
 do
-    make run file=$file
     filename="$(basename "${file%.*}")"
     make comp file=$filename.png
     rm $filename.png
-     
 done
-# shopt -u nullglob
@@ -0,0 +1,144 @@
+"""Renders the frames of a `pngs` scene file. The lines before the first `frame` line describe
+the shared part of every frame and are compiled once, with their BVH. Each frame only parses its
+own section and appends its spheres and lights to the shared ones. Frames are spread over a pool
+of worker processes, each of which renders and saves whole frames. `antialias` and `cache` are
+only imported when a render uses them.
+"""
+import concurrent.futures
+import copy
+from typing import TYPE_CHECKING, Optional, Tuple, Union
+
+from PIL import Image
+from timeit import default_timer as timer
+
+import src.batch as batch
+import src.compiled as compiled_scene
+import src.file_parse as file_parse
+import src.instrument as instrument
+import src.jit as jit
+import src.scene as scene
+import src.tiles as tiles
+
+if TYPE_CHECKING:
+    import src.antialias as antialias
+
+def compile_frame(shared: compiled_scene.CompiledScene, shared_meta: scene.SceneMata, lines: "list[str]",
+                  accel: str = "auto") -> Tuple[scene.SceneMata, compiled_scene.CompiledScene]:
+    """Builds the scene of one frame. The frame starts from the state left by the shared lines,
+    with `SceneMata.clear` applied. The BVHs of the shared primitives are reused unless the frame adds
+    enough primitives of its own to need a BVH over them too, in which case new ones are built for the frame.
+
+    Args:
+        shared (compiled_scene.CompiledScene): the objects every frame has
+        shared_meta (scene.SceneMata): the state after the shared lines, it is not changed
+        lines (list[str]): the lines of the frame's section
+        accel (str): "bvh", "none", or "auto", see `compiled.compile_scene`
+
+    Returns:
+        Tuple[scene.SceneMata, compiled_scene.CompiledScene]: the state and objects of the frame
+    """
+    meta = copy.deepcopy(shared_meta)
+    meta.clear()
+    own = file_parse.stream_frame(lines, meta, len(shared.vertices))
+    frame = compiled_scene.append_scene(shared, own)
+    if not compiled_scene.wants_bvh(frame, accel):
+        frame.drop_trees()
+    elif not shared.trees() or own.n_primitives >= compiled_scene.BVH_THRESHOLD:
+        frame.build_bvh()
+    return meta, frame
+
+def render_frame(index: int, lines: "list[str]", filename: str, shared: compiled_scene.CompiledScene,
+                 shared_meta: scene.SceneMata, accel: str = "auto", seed: int = 0,
+                 antialias_settings: Optional["antialias.Settings"] = None) -> float:
+    """Compiles, renders and saves one frame, anti-aliased with `antialias_settings` unless it is None
+
+    Returns:
+        float: the time taken in seconds
+    """
+    start = timer()
+    meta, frame = compile_frame(shared, shared_meta, lines, accel)
+    pixels = tiles.render_frame(frame, meta, workers=1, seed=seed, frame=index)
+    if antialias_settings is not None:
+        import src.antialias as antialias
+        antialias.refine(pixels, frame, meta, antialias_settings, seed, index)
+    Image.fromarray(batch.encode(pixels, meta), "RGBA").save(filename)
+    return timer() - start
+
+### WORKER PROCESSES ###
+# The shared part of the animation, given to each worker once by `_init_worker`
+_worker_shared: Optional[compiled_scene.CompiledScene] = None
+_worker_meta: Optional[scene.SceneMata] = None
+_worker_accel: str = "auto"
+_worker_seed: int = 0
+_worker_antialias: Optional["antialias.Settings"] = None
+
+def _init_worker(shared: Union[compiled_scene.CompiledScene, str], shared_meta: scene.SceneMata,
+                 accel: str, seed: int, antialias_settings: Optional["antialias.Settings"],
+                 instrumented: bool = False, jitted: bool = False) -> None:
+    """`shared` is either the scene or the path of a cache file to map it from"""
+    global _worker_shared, _worker_meta, _worker_accel, _worker_seed, _worker_antialias
+    if instrumented:
+        instrument.enable()
+        instrument.reset()
+    if jitted:
+        # one worker runs on each core already
+        jit.enable(threads=False)
+    if isinstance(shared, str):
+        import src.cache as cache
+        _, _, shared = cache.read(shared)
+    _worker_shared = shared
+    _worker_meta = shared_meta
+    _worker_accel = accel
+    _worker_seed = seed
+    _worker_antialias = antialias_settings
+
+def _render_frame_in_worker(job: Tuple[int, "list[str]", str]) -> Tuple[float, Optional[dict]]:
+    index, lines, filename = job
+    seconds = render_frame(index, lines, filename, _worker_shared, _worker_meta, _worker_accel, _worker_seed,
+                           _worker_antialias)
+    recorded = None
+    if instrument.enabled:
+        recorded = instrument.snapshot()
+        instrument.reset()
+    return seconds, recorded
+
+def render_animation(shared: compiled_scene.CompiledScene, shared_meta: scene.SceneMata,
+                     sections: "list[list[str]]", filenames: "list[str]", workers: int = 1,
+                     accel: str = "auto", seed: int = 0,
+                     antialias_settings: Optional["antialias.Settings"] = None) -> None:
+    """Renders every frame of an animation and saves frame i to `filenames[i]`
+
+    Args:
+        shared (compiled_scene.CompiledScene): the objects every frame has, with their BVH already built if they use one
+        shared_meta (scene.SceneMata): the state after the shared lines
+        sections (list[list[str]]): the lines of each frame's section, see `file_parse.frame_sections`
+        filenames (list[str]): where to save each frame
+        workers (int): the number of processes to render frames on, 0 for one per cpu
+        accel (str): "bvh", "none", or "auto", see `compiled.compile_scene`
+        seed (int): seed for the random numbers used by rough surfaces, each frame draws its own from it
+        antialias_settings (antialias.Settings): refine the edges of every frame this way, None for one ray per pixel
+    """
+    start = timer()
+    if workers <= 0:
+        workers = tiles.default_workers()
+    jobs = list(zip(range(len(sections)), sections, filenames))
+    if workers <= 1 or len(jobs) <= 1:
+        times = [render_frame(*job, shared, shared_meta, accel, seed, antialias_settings) for job in jobs]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=min(workers, len(jobs)), initializer=_init_worker,
+            initargs=(shared.cache_path or shared, shared_meta, accel, seed, antialias_settings, instrument.enabled,
+                      jit.enabled),
+        ) as pool:
+            times = []
+            for seconds, recorded in pool.map(_render_frame_in_worker, jobs):
+                times.append(seconds)
+                if recorded is not None:
+                    instrument.merge(recorded)
+    end = timer()
+    print(f"Elapsed raytracing time = {end-start}s for {len(jobs)} frames")
+    if times:
+        print(f"Frame times: min {min(times)}s, max {max(times)}s")
+    print(shared.summary())
+    if instrument.enabled:
+        print(instrument.report())
@@ -0,0 +1,118 @@
+"""Adaptive anti-aliasing. The image is first rendered with one ray per pixel. Pixels that differ
+from a neighbor by more than a threshold, which is where object edges and shadow boundaries are,
+then get extra rays at jittered points inside the pixel, and are replaced by the average of all of
+their samples. Smooth areas keep their single ray, so the cost grows with the length of the edges
+instead of with the size of the image.
+"""
+import dataclasses
+from typing import Optional, Tuple
+
+import numpy as np
+
+import src.batch as batch
+import src.compiled as compiled_scene
+import src.instrument as instrument
+import src.sampling as sampling
+import src.scene as scene
+
+# Largest difference, as a fraction of 255 in any sRGBA channel, between neighbors that is not an edge
+THRESHOLD = 0.1
+# Extra rays fired into each edge pixel
+EXTRA_SAMPLES = 4
+# Extra rays traced at once
+CHUNK_RAYS = 4096
+# First key of the random numbers of the anti-aliasing pass, past any tile index, see `sampling.make_rng`
+STREAM = 1 << 32
+
+@dataclasses.dataclass
+class Settings():
+    """How much anti-aliasing to do
+    \b threshold: see `THRESHOLD`
+    \b samples: extra rays for each edge pixel
+    \b max_samples: the most extra rays for the whole image, None for one per pixel of the image.
+    When there are more edge pixels than this allows, the ones with the most contrast are refined.
+    """
+    threshold: float = THRESHOLD
+    samples: int = EXTRA_SAMPLES
+    max_samples: Optional[int] = None
+
+def find_edges(srgba: np.ndarray) -> np.ndarray:
+    """Measures how much each pixel differs from the pixels left, right, above and below it
+
+    Args:
+        srgba (np.ndarray): (height, width, 4) encoded pixels
+
+    Returns:
+        np.ndarray: (height, width) the largest channel difference to a neighbor, as a fraction of 255
+    """
+    values = srgba.astype(np.int16)
+    contrast = np.zeros(values.shape[:2], dtype=np.int16)
+    across = np.abs(np.diff(values, axis=1)).max(axis=-1)
+    contrast[:, :-1] = np.maximum(contrast[:, :-1], across)
+    contrast[:, 1:] = np.maximum(contrast[:, 1:], across)
+    down = np.abs(np.diff(values, axis=0)).max(axis=-1)
+    contrast[:-1] = np.maximum(contrast[:-1], down)
+    contrast[1:] = np.maximum(contrast[1:], down)
+    return contrast / 255
+
+def select_pixels(contrast: np.ndarray, settings: Settings) -> Tuple[np.ndarray, np.ndarray]:
+    """Picks the pixels to refine, the ones with the most contrast first when the cap is reached
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: the column and row of each pixel, in row major order
+    """
+    max_samples = contrast.size if settings.max_samples is None else settings.max_samples
+    limit = max_samples // max(1, settings.samples)
+    edges = np.flatnonzero(contrast.ravel() > settings.threshold)
+    if len(edges) > limit:
+        # stable, so pixels of equal contrast keep their order and the choice is repeatable
+        strongest = np.argsort(-contrast.ravel()[edges], kind="stable")[:limit]
+        edges = np.sort(edges[strongest])
+    ys, xs = np.unravel_index(edges, contrast.shape)
+    return xs, ys
+
+def refine(frame: np.ndarray, compiled: compiled_scene.CompiledScene, meta: scene.SceneMata,
+           settings: Settings, seed: int = 0, frame_index: int = 0) -> int:
+    """Fires extra rays into the edge pixels of a rendered frame and averages them in. Each pixel
+    keeps the average color of the samples that hit something, and the fraction of samples that
+    hit becomes its alpha, so silhouettes against the background are smoothed too.
+
+    Args:
+        frame (np.ndarray): (height, width, 4) linear framebuffer from one ray per pixel, changed in place
+        compiled (compiled_scene.CompiledScene): the scene
+        meta (scene.SceneMata): Metadata about the scene
+        settings (Settings): how much anti-aliasing to do
+        seed (int): seed for the positions of the extra rays and for rough surfaces
+        frame_index (int): the frame of an animation, part of the key of the random numbers
+
+    Returns:
+        int: the number of pixels that were refined
+    """
+    if settings.samples <= 0:
+        return 0
+    with instrument.stage("antialias"):
+        xs, ys = select_pixels(find_edges(batch.encode(frame, meta)), settings)
+        if len(xs) == 0:
+            return 0
+        instrument.count("antialias pixels", len(xs))
+        instrument.count("antialias rays", len(xs) * settings.samples)
+        sample_xs = np.repeat(xs, settings.samples)
+        sample_ys = np.repeat(ys, settings.samples)
+        samples = np.zeros((len(sample_xs), 4), dtype=batch.FRAME_DTYPE)
+        for chunk_index, first in enumerate(range(0, len(sample_xs), CHUNK_RAYS)):
+            rng = sampling.make_rng(seed, frame_index, STREAM, chunk_index)
+            chunk = slice(first, first + CHUNK_RAYS)
+            # the first ray of a pixel goes through its corner, so the extra ones spread around it
+            jitter = rng.uniform(-0.5, 0.5, (2, len(sample_xs[chunk])))
+            samples[chunk] = batch.trace_pixels(sample_xs[chunk] + jitter[0], sample_ys[chunk] + jitter[1],
+                                                compiled, meta, rng)
+        samples = samples.reshape(len(xs), settings.samples, 4)
+        first_samples = frame[ys, xs]
+        coverage = first_samples[:, 3] + samples[..., 3].sum(axis=1)
+        color_sum = first_samples[:, :3] + samples[..., :3].sum(axis=1)
+        refined = np.zeros((len(xs), 4), dtype=batch.FRAME_DTYPE)
+        hit = coverage > 0
+        refined[hit, :3] = color_sum[hit] / coverage[hit, np.newaxis]
+        refined[:, 3] = coverage / (settings.samples + 1)
+        frame[ys, xs] = refined
+        return len(xs)
@@ -0,0 +1,587 @@
+"""Whole-frame render path. Rays for the frame are built as arrays and intersected
+against every primitive at once instead of one `Shape.intersection` call per ray.
+Shadows and Lambert shading are evaluated for every (hit, light) pair in one pass.
+The scene is read from a `compiled.CompiledScene`.
+"""
+import dataclasses
+from typing import Callable, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+from timeit import default_timer as timer
+
+import src.bvh as bvh
+import src.camera as camera
+import src.colors as colors
+import src.compiled as compiled_scene
+import src.instrument as instrument
+import src.jit as jit
+import src.light as light
+import src.optics as optics
+import src.sampling as sampling
+import src.scene as scene
+import src.shapes as shapes
+
+# Upper bound on the number of (ray, sphere) pairs held in memory at once
+PAIRS_PER_CHUNK = 1 << 20
+# Type of the linear framebuffers. float32 would halve their size, but rounding the colors to it
+# moves some channels across a quantization step, so the output would no longer match `raytracer`.
+FRAME_DTYPE = np.float64
+
+def pixel_grid(meta: scene.SceneMata) -> Tuple[np.ndarray, np.ndarray]:
+    """`camera.pixel_grid` for the image of the scene"""
+    return camera.pixel_grid(meta.width, meta.height)
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    """Normalizes each row of an (N, 3) array"""
+    return vectors / np.linalg.norm(vectors, axis=-1, keepdims=True)
+
+def intersect_spheres(origins: np.ndarray, directions: np.ndarray,
+                      centers: np.ndarray, radii: np.ndarray, fudge = 10e-5) -> np.ndarray:
+    """Intersects every ray with every sphere
+
+    Args:
+        origins (np.ndarray): (N, 3) ray origins
+        directions (np.ndarray): (N, 3) normalized ray directions
+        centers (np.ndarray): (S, 3) sphere centers
+        radii (np.ndarray): (S,) sphere radii
+
+    Returns:
+        np.ndarray: (N, S) distance along each ray to each sphere, `np.inf` where there is no hit
+    """
+    return shapes.sphere_distances(origins[:, np.newaxis, :], directions[:, np.newaxis, :],
+                            centers[np.newaxis, :, :], radii[np.newaxis, :], fudge)
+
+# Distances from a range of rays, given as (start, stop), to a fixed set of primitives
+RangeIntersection = Callable[[int, int], np.ndarray]
+
+def _scan_closest(n_rays: int, n_primitives: int, intersect: RangeIntersection) -> Tuple[np.ndarray, np.ndarray]:
+    """Finds the closest of `n_primitives` primitives hit by each ray, a chunk of rays at a time"""
+    indices = np.full(n_rays, -1, dtype=np.intp)
+    distances = np.full(n_rays, np.inf)
+    if n_rays == 0 or n_primitives == 0:
+        return indices, distances
+    chunk = max(1, PAIRS_PER_CHUNK // n_primitives)
+    for start in range(0, n_rays, chunk):
+        stop = min(start + chunk, n_rays)
+        t = intersect(start, stop)
+        _count_tests(t)
+        # argmin picks the first of equal distances, like the strict `<` in `raytracer.closest_intersection`
+        closest = np.argmin(t, axis=1)
+        closest_t = t[np.arange(stop - start), closest]
+        hit = np.isfinite(closest_t)
+        indices[start:stop] = np.where(hit, closest, -1)
+        distances[start:stop] = closest_t
+    return indices, distances
+
+def closest_hits(origins: np.ndarray, directions: np.ndarray,
+                 centers: np.ndarray, radii: np.ndarray, fudge = 10e-5) -> Tuple[np.ndarray, np.ndarray]:
+    """Finds the closest sphere hit by each ray. The rays are processed in chunks so that the
+    (rays, spheres) intermediate arrays stay bounded.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: (N,) index of the closest sphere (-1 for a miss) and (N,) distance to it
+    """
+    def intersect(start: int, stop: int) -> np.ndarray:
+        return intersect_spheres(origins[start:stop], directions[start:stop], centers, radii, fudge)
+    return _scan_closest(len(origins), len(radii), intersect)
+
+# Number of primitives tested per step of `occluded`. Rays that are blocked after a step skip the rest.
+SPHERES_PER_STEP = 8
+
+# Distances from a set of rays to a slice of a fixed set of primitives
+StepIntersection = Callable[[np.ndarray, slice], np.ndarray]
+
+def _scan_occluded(max_distances: np.ndarray, n_primitives: int, intersect: StepIntersection) -> np.ndarray:
+    """Checks whether each ray is blocked by one of `n_primitives` primitives, a few primitives at a time"""
+    blocked = np.zeros(len(max_distances), dtype=bool)
+    active = np.arange(len(max_distances))
+    for first in range(0, n_primitives, SPHERES_PER_STEP):
+        if len(active) == 0:
+            break
+        step = slice(first, first + SPHERES_PER_STEP)
+        hit = np.zeros(len(active), dtype=bool)
+        chunk = max(1, PAIRS_PER_CHUNK // SPHERES_PER_STEP)
+        for start in range(0, len(active), chunk):
+            rays = active[start:start + chunk]
+            t = intersect(rays, step)
+            _count_tests(t)
+            hit[start:start + chunk] = (t < max_distances[rays, np.newaxis]).any(axis=1)
+        blocked[active[hit]] = True
+        active = active[~hit]
+    return blocked
+
+def occluded(origins: np.ndarray, directions: np.ndarray, max_distances: np.ndarray,
+             centers: np.ndarray, radii: np.ndarray, fudge = 10e-5) -> np.ndarray:
+    """Checks whether each ray hits a sphere before travelling `max_distances`. The spheres
+    are tested a few at a time and a ray is dropped as soon as one of them blocks it.
+
+    Args:
+        origins (np.ndarray): (N, 3) ray origins
+        directions (np.ndarray): (N, 3) normalized ray directions
+        max_distances (np.ndarray): (N,) distance to the light, `np.inf` for suns
+
+    Returns:
+        np.ndarray: (N,) true where something blocks the ray
+    """
+    def intersect(rays: np.ndarray, step: slice) -> np.ndarray:
+        return intersect_spheres(origins[rays], directions[rays], centers[step], radii[step], fudge)
+    return _scan_occluded(max_distances, len(radii), intersect)
+
+def _count_tests(t: np.ndarray) -> None:
+    """Records ray/primitive tests and hits given the distances they found"""
+    if instrument.enabled:
+        instrument.count("intersection tests", t.size)
+        instrument.count("intersection hits", np.isfinite(t).sum())
+
+def _pairs(primitives: compiled_scene.Primitives, origins: np.ndarray, directions: np.ndarray,
+           fudge: float) -> bvh.PairIntersection:
+    def intersect(rays: np.ndarray, index: np.ndarray) -> np.ndarray:
+        t = primitives.distances(origins[rays], directions[rays], *primitives.arrays(index), fudge)
+        _count_tests(t)
+        return t
+    return intersect
+
+def _scan_kind_closest(primitives: compiled_scene.Primitives, origins: np.ndarray, directions: np.ndarray,
+                       start: int, fudge: float) -> Tuple[np.ndarray, np.ndarray]:
+    """`closest_hits` against the primitives of a kind from `start` on, the indices counting from `start`"""
+    arrays = primitives.arrays(slice(start, primitives.count))
+    if jit.enabled and primitives.kind == "sphere":
+        return jit.closest_spheres(origins, directions, *arrays, fudge)
+    def intersect(first: int, stop: int) -> np.ndarray:
+        return primitives.distances(origins[first:stop, np.newaxis], directions[first:stop, np.newaxis], *arrays, fudge)
+    return _scan_closest(len(origins), primitives.count - start, intersect)
+
+def _scan_kind_occluded(primitives: compiled_scene.Primitives, origins: np.ndarray, directions: np.ndarray,
+                        max_distances: np.ndarray, start: int, fudge: float) -> np.ndarray:
+    """`occluded` against the primitives of a kind from `start` on"""
+    if jit.enabled and primitives.kind == "sphere":
+        return jit.occluded_spheres(origins, directions, max_distances,
+                                    *primitives.arrays(slice(start, primitives.count)), fudge)
+    def intersect(rays: np.ndarray, step: slice) -> np.ndarray:
+        index = slice(start + step.start, min(start + step.stop, primitives.count))
+        return primitives.distances(origins[rays, np.newaxis], directions[rays, np.newaxis],
+                                    *primitives.arrays(index), fudge)
+    return _scan_occluded(max_distances, primitives.count - start, intersect)
+
+def find_closest(compiled: compiled_scene.CompiledScene, origins: np.ndarray, directions: np.ndarray,
+                 fudge = 10e-5) -> Tuple[np.ndarray, np.ndarray]:
+    """`closest_hits` against every primitive of the scene, through the BVHs it has. Primitives
+    are numbered like in `compiled`.
+    """
+    with instrument.stage("intersect"):
+        return _find_closest(compiled, origins, directions, fudge)
+
+def _find_closest(compiled: compiled_scene.CompiledScene, origins: np.ndarray, directions: np.ndarray,
+                  fudge: float) -> Tuple[np.ndarray, np.ndarray]:
+    indices = np.full(len(origins), -1, dtype=np.intp)
+    distances = np.full(len(origins), np.inf)
+    for primitives in compiled.primitives():
+        if primitives.count == 0:
+            continue
+        kind_indices, kind_distances = _closest_of_kind(primitives, origins, directions, fudge)
+        kind_indices = kind_indices + primitives.first
+        # ties between kinds go to the primitive that comes first in the scene file, like in
+        # `raytracer.closest_intersection`
+        tied = np.flatnonzero((kind_distances == distances) & (indices >= 0))
+        closer = kind_distances < distances
+        closer[tied] = compiled.source_order[kind_indices[tied]] < compiled.source_order[indices[tied]]
+        indices[closer] = kind_indices[closer]
+        distances[closer] = kind_distances[closer]
+    return indices, distances
+
+def _closest_of_kind(primitives: compiled_scene.Primitives, origins: np.ndarray, directions: np.ndarray,
+                     fudge: float) -> Tuple[np.ndarray, np.ndarray]:
+    """The closest hit among the primitives of one kind, the indices counting from the first of them"""
+    tree = primitives.tree
+    if tree is None:
+        return _scan_kind_closest(primitives, origins, directions, 0, fudge)
+    indices, distances = tree.closest_hits(origins, directions, _pairs(primitives, origins, directions, fudge))
+    first = tree.n_primitives
+    if first < primitives.count:
+        rest, rest_distances = _scan_kind_closest(primitives, origins, directions, first, fudge)
+        # strictly closer, so ties still go to the lower index
+        closer = rest_distances < distances
+        indices[closer] = rest[closer] + first
+        distances[closer] = rest_distances[closer]
+    return indices, distances
+
+def find_occluded(compiled: compiled_scene.CompiledScene, origins: np.ndarray, directions: np.ndarray,
+                  max_distances: np.ndarray, fudge = 10e-5) -> np.ndarray:
+    """`occluded` against every primitive of the scene, through the BVHs it has"""
+    with instrument.stage("shadow"):
+        return _find_occluded(compiled, origins, directions, max_distances, fudge)
+
+def _find_occluded(compiled: compiled_scene.CompiledScene, origins: np.ndarray, directions: np.ndarray,
+                   max_distances: np.ndarray, fudge: float) -> np.ndarray:
+    blocked = np.zeros(len(origins), dtype=bool)
+    for primitives in compiled.primitives():
+        if primitives.count == 0:
+            continue
+        # only the rays nothing has blocked yet are tested against the next kind
+        rest = np.flatnonzero(~blocked)
+        blocked[rest] = _occluded_by_kind(primitives, origins[rest], directions[rest], max_distances[rest], fudge)
+    return blocked
+
+def _occluded_by_kind(primitives: compiled_scene.Primitives, origins: np.ndarray, directions: np.ndarray,
+                      max_distances: np.ndarray, fudge: float) -> np.ndarray:
+    tree = primitives.tree
+    if tree is None:
+        return _scan_kind_occluded(primitives, origins, directions, max_distances, 0, fudge)
+    blocked = tree.any_hits(origins, directions, max_distances, _pairs(primitives, origins, directions, fudge))
+    first = tree.n_primitives
+    if first < primitives.count:
+        rest = np.flatnonzero(~blocked)
+        blocked[rest] = _scan_kind_occluded(primitives, origins[rest], directions[rest], max_distances[rest],
+                                            first, fudge)
+    return blocked
+
+def surface_normals(points: np.ndarray, directions: np.ndarray, shape_index: np.ndarray,
+                    compiled: compiled_scene.CompiledScene, rng: Optional[np.random.Generator] = None) -> np.ndarray:
+    """Vectorized version of `normal_at_point` of the shapes, with two sided primitives turned towards
+    the ray like in `raytracer.shade_hit`. The perturbations of every rough hit are drawn in one call.
+
+    Args:
+        points (np.ndarray): (N, 3) points on the primitives
+        directions (np.ndarray): (N, 3) direction of the ray that hit each point
+        shape_index (np.ndarray): (N,) the primitive each point is on
+        compiled (compiled_scene.CompiledScene): the scene
+        rng (np.random.Generator): where the perturbations come from, the global random state when None
+
+    Returns:
+        np.ndarray: (N, 3) normalized normals with gausian roughness applied
+    """
+    normals = np.empty((len(points), 3))
+    two_sided = np.zeros(len(points), dtype=bool)
+    for primitives in compiled.primitives():
+        on_kind = (shape_index >= primitives.first) & (shape_index < primitives.first + primitives.count)
+        if on_kind.any():
+            normals[on_kind] = primitives.normals(points[on_kind], shape_index[on_kind] - primitives.first)
+            if primitives.two_sided:
+                two_sided |= on_kind
+    roughness = compiled.roughness[shape_index]
+    rough = roughness > 0
+    if rough.any():
+        normals[rough] = normalize((np.random if rng is None else rng).normal(normals[rough], roughness[rough, np.newaxis]))
+    facing_away = two_sided & (np.einsum("ni,ni->n", normals, directions) > 0)
+    normals[facing_away] = -normals[facing_away]
+    return normals
+
+def _two_sided(shape_index: np.ndarray, compiled: compiled_scene.CompiledScene) -> np.ndarray:
+    """Whether each of the primitives is two sided"""
+    two_sided = np.zeros(len(shape_index), dtype=bool)
+    for primitives in compiled.primitives():
+        if primitives.two_sided:
+            two_sided |= (shape_index >= primitives.first) & (shape_index < primitives.first + primitives.count)
+    return two_sided
+
+def shade(points: np.ndarray, normals: np.ndarray, surface_colors: np.ndarray,
+          compiled: compiled_scene.CompiledScene, fudge = 10e-5,
+          rng: Optional[np.random.Generator] = None) -> np.ndarray:
+    """Computes the direct light at every hit from every light at once. This is the
+    light loop of `raytracer.shade_hit` with `Sun.lambert` and `Bulb.lambert` folded in.
+
+    Args:
+        points (np.ndarray): (N, 3) points of intersection
+        normals (np.ndarray): (N, 3) normals at the points of intersection
+        surface_colors (np.ndarray): (N, 3) linear color of the shape at each point
+        compiled (compiled_scene.CompiledScene): the lights, and the spheres that can cast shadows
+        rng (np.random.Generator): where the shadow rays of soft lights go, the global random state when None
+
+    Returns:
+        np.ndarray: (N, 3) linear color from direct lighting
+    """
+    with instrument.stage("shade"):
+        return _shade(points, normals, surface_colors, compiled, fudge, rng)
+
+def _shade(points: np.ndarray, normals: np.ndarray, surface_colors: np.ndarray,
+           compiled: compiled_scene.CompiledScene, fudge: float,
+           rng: Optional[np.random.Generator]) -> np.ndarray:
+    light_points, light_colors, is_sun = compiled.light_points, compiled.light_colors, compiled.is_sun
+    n_points, n_lights = len(points), compiled.n_lights
+    if n_points == 0 or n_lights == 0:
+        return np.zeros((n_points, 3))
+    is_soft = compiled.is_soft
+    if (jit.enabled and compiled.n_primitives == compiled.n_spheres and compiled.tree is None
+            and not is_soft.any()):
+        lit, blocked = jit.shade_spheres(points, normals, surface_colors, light_points, light_colors, is_sun,
+                                         compiled.centers, compiled.radii, fudge)
+        instrument.count("shadow rays", n_points * n_lights)
+        instrument.count("shadow rays blocked", blocked)
+        return lit
+    # (N, L, 3) direction from every point to every light
+    to_light = light_points[np.newaxis, :, :] - points[:, np.newaxis, :]
+    distance_to_light = np.linalg.norm(to_light, axis=-1)
+    # suns are infinitely far away in the direction of their position
+    to_light = np.where(is_sun[np.newaxis, :, np.newaxis], light_points[np.newaxis, :, :], to_light)
+    shadow_distance = np.where(is_sun[np.newaxis, :], np.inf, distance_to_light)
+    to_light = normalize(to_light)
+
+    # soft lights get their own shadow rays below
+    hard = np.flatnonzero(~is_soft)
+    has_shadow = np.zeros((n_points, n_lights), dtype=bool)
+    shadow_origins = np.repeat(points, len(hard), axis=0)
+    has_shadow[:, hard] = find_occluded(compiled, shadow_origins, to_light[:, hard].reshape(-1, 3),
+                                        shadow_distance[:, hard].ravel(), fudge).reshape(n_points, len(hard))
+    instrument.count("shadow rays", n_points * len(hard))
+    if instrument.enabled:
+        instrument.count("shadow rays blocked", has_shadow.sum())
+
+    lambert = np.maximum(np.einsum("nli,ni->nl", to_light, normals), 0)
+    # bulbs fall off with the square of the distance
+    falloff = np.where(is_sun[np.newaxis, :], 1.0, 1/(distance_to_light**2))
+    weight = np.where(has_shadow, 0.0, lambert * falloff)
+    for index in np.flatnonzero(is_soft):
+        # points facing away from the light need no shadow rays
+        lit = np.flatnonzero(weight[:, index] > 0)
+        weight[lit, index] *= soft_visibility(points[lit], index, compiled, rng, fudge)
+    contributions = surface_colors[:, np.newaxis, :] * light_colors[np.newaxis, :, :] * weight[..., np.newaxis]
+    return contributions.sum(axis=1)
+
+def _light_targets(compiled: compiled_scene.CompiledScene, index: int, points: np.ndarray,
+                   uv: np.ndarray) -> np.ndarray:
+    """`light.SoftLight.targets` of the soft light `index`"""
+    if compiled.light_types[index] == compiled_scene.SPHERE_LIGHT:
+        return light.disk_targets(points, compiled.light_points[index], compiled.light_radii[index], uv)
+    edges = compiled.light_edges[index]
+    return light.parallelogram_targets(compiled.light_points[index], edges[:3], edges[3:], uv)
+
+def soft_visibility(points: np.ndarray, index: int, compiled: compiled_scene.CompiledScene,
+                    rng: Optional[np.random.Generator] = None, fudge = 10e-5) -> np.ndarray:
+    """Vectorized version of `light.SoftLight.visibility`. The probes of every point are traced
+    together, then the rest of the shadow rays of the points the probes left undecided.
+
+    Args:
+        points (np.ndarray): (N, 3) points being lit
+        index (int): the soft light
+        compiled (compiled_scene.CompiledScene): the scene
+        rng (np.random.Generator): where the samples come from, the global random state when None
+
+    Returns:
+        np.ndarray: (N,) the share of the light seen from each point
+    """
+    def reached(rows: np.ndarray, uv: np.ndarray) -> np.ndarray:
+        targets = _light_targets(compiled, index, points[rows], uv)
+        origins = np.repeat(points[rows], uv.shape[1], axis=0)
+        to_target = targets.reshape(-1, 3) - origins
+        distances = np.linalg.norm(to_target, axis=-1)
+        blocked = find_occluded(compiled, origins, to_target / distances[:, np.newaxis], distances, fudge)
+        instrument.count("shadow rays", len(origins))
+        if instrument.enabled:
+            instrument.count("shadow rays blocked", blocked.sum())
+        return (~blocked).reshape(len(rows), uv.shape[1]).sum(axis=1)
+
+    samples = int(compiled.light_samples[index])
+    rows = np.arange(len(points))
+    seen = np.zeros(len(points), dtype=np.intp)
+    rest = samples
+    visibility = np.zeros(len(points))
+    if samples > sampling.PROBES:
+        seen = reached(rows, sampling.quadrant_samples(rng, len(rows)))
+        visibility = seen / sampling.PROBES
+        undecided = (seen > 0) & (seen < sampling.PROBES)
+        instrument.count("soft shadows settled by probes", len(rows) - undecided.sum())
+        rows, seen = rows[undecided], seen[undecided]
+        rest -= sampling.PROBES
+    visibility[rows] = (seen + reached(rows, sampling.stratified_samples(rng, len(rows), rest))) / samples
+    return visibility
+
+def reflect(incident: np.ndarray, normals: np.ndarray) -> np.ndarray:
+    """Vectorized version of the direction in `raytracer.make_reflection_ray`, normalized like `shapes.Ray`"""
+    if jit.enabled:
+        return jit.reflect(incident, normals)
+    directions = (-2 * np.einsum("ni,ni->n", incident, normals)[:, np.newaxis] * normals) + incident
+    return normalize(directions)
+
+# Reflection and refraction rays whose weight in the pixel color, the product of the share every
+# surface they bounced off or went through passes on, is below this are not traced. The surface
+# they would leave keeps its own color. This is a deliberate approximation: the reference renderer
+# traces every bounce up to the reflection depth, so deep mirror scenes can differ from it by about
+# this fraction of a color. Pass `min_throughput=0` to `trace_rays` for the exact result.
+MIN_THROUGHPUT = 1 / 1024
+
+@dataclasses.dataclass
+class Bounce():
+    """What one level of `trace_rays` found, kept until the levels are blended back together
+    \b n_rays: the number of rays traced at this level
+    \b hits: the rays that hit something
+    \b hit_colors: (len(hits), 3) linear color of the direct light at each hit
+    \b shiny: the positions in `hits` that sent a reflection ray to the next level, in order
+    \b shininess: (len(shiny), 1) the shininess of those hits, with the Fresnel reflection of transparent ones
+    \b clear: the positions in `hits` that sent a refraction ray to the next level, after the reflection rays
+    \b transmission: (len(clear), 1) the weight of those refraction rays, see `optics.fresnel_weights`
+    \b rough: (len(hits),) true for the hits on a rough surface
+    """
+    n_rays: int
+    hits: np.ndarray
+    hit_colors: np.ndarray
+    shiny: np.ndarray
+    shininess: np.ndarray
+    clear: np.ndarray
+    transmission: np.ndarray
+    rough: np.ndarray
+
+def trace_rays(origins: np.ndarray, directions: np.ndarray, compiled: compiled_scene.CompiledScene,
+               meta: scene.SceneMata, rng: Optional[np.random.Generator] = None,
+               min_throughput: Optional[float] = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Vectorized version of `raytracer.trace_ray`. Reflections and refractions are traced as
+    wavefronts: every reflection and refraction ray of one depth is intersected and shaded together,
+    up to `meta.reflection_depth` levels counting both, and the levels are then blended from the
+    deepest up with the same `lerp` as the recursive renderers. The result matches the recursive
+    version exactly only with `min_throughput` 0, the default cutoff skips the faintest bounces.
+
+    Args:
+        origins (np.ndarray): (N, 3) ray origins
+        directions (np.ndarray): (N, 3) normalized ray directions
+        compiled (compiled_scene.CompiledScene): the scene
+        meta (scene.SceneMata): Metadata about the scene
+        rng (np.random.Generator): random numbers for rough surfaces, the global random state when None
+        min_throughput (float): the least weight a reflection or refraction ray needs to be traced, None for
+        `MIN_THROUGHPUT` as it is when called
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: (N, 3) linear color seen along each ray, a mask of
+        the rays that hit anything, and a mask of the rays whose color depends on a rough surface
+    """
+    if min_throughput is None:
+        min_throughput = MIN_THROUGHPUT
+    with instrument.stage("trace"):
+        bounces, hit = _trace_bounces(origins, directions, compiled, meta, rng, min_throughput)
+        ray_colors = ray_rough = None
+        for bounce in reversed(bounces):
+            if ray_colors is not None:
+                # rays that hit nothing blend towards black
+                n_shiny = len(bounce.shiny)
+                bounce.hit_colors[bounce.clear] = optics.lerp(bounce.hit_colors[bounce.clear], ray_colors[n_shiny:],
+                                                                 bounce.transmission)
+                bounce.hit_colors[bounce.shiny] = optics.lerp(bounce.hit_colors[bounce.shiny], ray_colors[:n_shiny],
+                                                                 bounce.shininess)
+                bounce.rough[bounce.shiny] |= ray_rough[:n_shiny]
+                bounce.rough[bounce.clear] |= ray_rough[n_shiny:]
+            ray_colors = np.zeros((bounce.n_rays, 3))
+            ray_colors[bounce.hits] = bounce.hit_colors
+            ray_rough = np.zeros(bounce.n_rays, dtype=bool)
+            ray_rough[bounce.hits] = bounce.rough
+        return ray_colors, hit, ray_rough
+
+def _trace_bounces(origins: np.ndarray, directions: np.ndarray, compiled: compiled_scene.CompiledScene,
+                   meta: scene.SceneMata, rng: Optional[np.random.Generator],
+                   min_throughput: float) -> Tuple["list[Bounce]", np.ndarray]:
+    """Traces the rays and their reflections and refractions one level at a time
+
+    Returns:
+        Tuple[list[Bounce], np.ndarray]: every level from the given rays down, and the hit mask of the given rays
+    """
+    bounces = []
+    first_hit = None
+    throughput = np.ones(len(origins))
+    depth = 0
+    while True:
+        hit_index, hit_distance = find_closest(compiled, origins, directions)
+        hits = np.flatnonzero(hit_index >= 0)
+        if first_hit is None:
+            first_hit = hit_index >= 0
+        shape_index = hit_index[hits]
+        points = origins[hits] + hit_distance[hits, np.newaxis] * directions[hits]
+        roughness = compiled.roughness[shape_index]
+        normals = surface_normals(points, directions[hits], shape_index, compiled, rng)
+        hit_colors = shade(points, normals, compiled.colors[shape_index], compiled, rng=rng)
+
+        shiny = clear = np.zeros(0, dtype=np.intp)
+        shininess = transmission = np.zeros(0)
+        if depth < meta.reflection_depth:
+            shininess = compiled.shininess[shape_index]
+            transparency = compiled.transparency[shape_index]
+            transparent = np.flatnonzero(transparency > 0.0)
+            transmission = np.zeros(len(hits))
+            refracted = np.zeros((len(hits), 3))
+            if len(transparent):
+                refracted[transparent], reflectance = optics.refract(
+                    directions[hits[transparent]], normals[transparent], compiled.ior[shape_index[transparent]],
+                    _two_sided(shape_index[transparent], compiled))
+                shininess[transparent], transmission[transparent] = optics.fresnel_weights(
+                    shininess[transparent], transparency[transparent], reflectance)
+            weight = throughput[hits] * shininess
+            shiny = np.flatnonzero((shininess > 0.0) & (weight >= min_throughput))
+            clear_weight = throughput[hits] * (1 - shininess) * transmission
+            clear = np.flatnonzero((transmission > 0.0) & (clear_weight >= min_throughput))
+        bounces.append(Bounce(len(origins), hits, hit_colors, shiny, shininess[shiny, np.newaxis],
+                              clear, transmission[clear, np.newaxis], roughness > 0))
+        if len(shiny) == 0 and len(clear) == 0:
+            return bounces, first_hit
+        instrument.count("reflection rays", len(shiny))
+        if len(clear):
+            instrument.count("refraction rays", len(clear))
+        # the reflection rays go first in the next level, then the refraction rays. Rays leaving a
+        # transparent surface start past it, see `raytracer.start_past_surface`.
+        reflected = reflect(directions[hits[shiny]], normals[shiny])
+        refracted = normalize(refracted[clear])
+        past = transparency[shiny, np.newaxis] > 0.0
+        directions = np.concatenate([reflected, refracted])
+        origins = np.concatenate([points[shiny] + np.where(past, 10e-5 * reflected, 0.0),
+                                  points[clear] + 10e-5 * refracted])
+        throughput = np.concatenate([weight[shiny], clear_weight[clear]])
+        depth += 1
+
+def trace_pixels(xs: np.ndarray, ys: np.ndarray, compiled: compiled_scene.CompiledScene,
+                 meta: scene.SceneMata, rng: Optional[np.random.Generator] = None) -> np.ndarray:
+    """Traces the eye rays of a set of pixels at once. Pixels whose color depends on a rough
+    surface are traced `meta.samples` times and averaged, every other pixel only once.
+
+    Args:
+        xs (np.ndarray): the column of each pixel
+        ys (np.ndarray): the row of each pixel
+        compiled (compiled_scene.CompiledScene): the scene
+        meta (scene.SceneMata): Metadata about the scene
+        rng (np.random.Generator): random numbers for rough surfaces, the global random state when None
+
+    Returns:
+        np.ndarray: (N, 4) linear color of each pixel, with an alpha of 1 where something was hit and 0 elsewhere
+    """
+    directions, valid = camera.eye_rays(xs, ys, meta)
+    rays = np.flatnonzero(valid)
+    directions = directions[rays]
+    origins = np.broadcast_to(np.asarray(meta.eye, dtype=float), directions.shape)
+    instrument.count("primary rays", len(rays))
+    ray_colors, hit, rough = trace_rays(origins, directions, compiled, meta, rng)
+    if meta.samples > 1 and rough.any():
+        again = np.flatnonzero(rough)
+        extra = meta.samples - 1
+        repeated = np.repeat(again, extra)
+        instrument.count("rough samples", len(repeated))
+        more, _, _ = trace_rays(origins[repeated], directions[repeated], compiled, meta, rng)
+        ray_colors[again] = (ray_colors[again] + more.reshape(len(again), extra, 3).sum(axis=1)) / meta.samples
+
+    pixels = np.zeros((len(xs), 4), dtype=FRAME_DTYPE)
+    pixels[rays[hit], :3] = ray_colors[hit]
+    pixels[rays[hit], 3] = 1.0
+    return pixels
+
+def encode(linear: np.ndarray, meta: scene.SceneMata) -> np.ndarray:
+    """Applies the exposure of the scene to linear pixels, or a whole framebuffer, and converts them to sRGBA
+
+    Returns:
+        np.ndarray: sRGBA as uint8, the same shape as `linear`
+    """
+    with instrument.stage("encode"):
+        return colors.linear_to_srgb(linear, meta.exposure_function)
+
+def render_pixels(xs: np.ndarray, ys: np.ndarray, compiled: compiled_scene.CompiledScene,
+                  meta: scene.SceneMata, rng: Optional[np.random.Generator] = None) -> np.ndarray:
+    """`trace_pixels` followed by `encode`
+
+    Returns:
+        np.ndarray: (N, 4) sRGBA value of each pixel, fully transparent where nothing was hit
+    """
+    return encode(trace_pixels(xs, ys, compiled, meta, rng), meta)
+
+def raytrace_scene(compiled: compiled_scene.CompiledScene, meta: scene.SceneMata, image: Image, seed: int = 0) -> None:
+    """Renders the scene like `raytracer.raytrace_scene`, but the whole frame at once"""
+    start = timer()
+
+    xs, ys = pixel_grid(meta)
+    frame = np.zeros((meta.height, meta.width, 4), dtype=FRAME_DTYPE)
+    frame[ys, xs] = trace_pixels(xs, ys, compiled, meta, sampling.make_rng(seed))
+    image.paste(Image.fromarray(encode(frame, meta), "RGBA"))
+    end = timer()
+    print(f"Elapsed raytracing time = {end-start}s")
@@ -0,0 +1,303 @@
+"""Benchmarks the batch renderer over the scenes in `test/test_files` and over synthetic scenes
+that scale one thing at a time: spheres, lights, bounces and resolution. Every run records wall
+time, rays per second and the peak memory of the main process, and is checked against the expected
+images when there are any. Memory allocated by tile worker processes, with --workers above 1, is not
+counted. Results can be saved as JSON and compared with a saved baseline.
+
+With --startup it instead runs `main.py` on a scene in a fresh interpreter under `-X importtime`
+and lists the modules that took longest to import.
+
+Usage: python -m src.benchmark [--output results.json] [--baseline baseline.json] [--startup scene.txt]
+"""
+import argparse
+import dataclasses
+import glob
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+from typing import Optional, Tuple
+
+import numpy as np
+from PIL import Image
+from timeit import default_timer as timer
+
+import src.batch as batch
+import src.file_parse as file_parse
+import src.instrument as instrument
+import src.tiles as tiles
+import src.utils as utils
+
+TEST_FILES = os.path.join("test", "test_files")
+CORRECT_FILES = os.path.join("test", "correct_files")
+# A pixel matches when no channel is off by more than this fraction of 255, like `compare -fuzz 2%`
+FUZZ = 0.02
+# The fraction of pixels that may be off before a render counts as wrong
+MISMATCH_LIMIT = 0.001
+# A run this much slower than the baseline is reported as a regression
+REGRESSION_LIMIT = 0.1
+
+@dataclasses.dataclass
+class Case():
+    """One scene to benchmark
+    \b name: unique name of the case, used to match it with the baseline
+    \b text: the scene file
+    """
+    name: str
+    text: str
+
+@dataclasses.dataclass
+class Result():
+    """Measurements of one case
+    \b parse_time, render_time: the best seconds over the repeats for each step
+    \b rays: primary, shadow, reflection and refraction rays traced
+    \b ray_counts: everything `instrument` counted
+    \b peak_memory: the most bytes allocated at once by the main process while parsing and rendering,
+    leaving out the tile workers when there are several
+    \b mismatched_pixels: pixels outside of `FUZZ` of the expected image, None without one
+    \b matches: whether the mismatched pixels are within `MISMATCH_LIMIT`, None without an expected image
+    """
+    name: str
+    width: int
+    height: int
+    parse_time: float
+    render_time: float
+    rays: int
+    ray_counts: dict
+    peak_memory: int
+    mismatched_pixels: Optional[int] = None
+    matches: Optional[bool] = None
+
+    @property
+    def wall_time(self) -> float:
+        return self.parse_time + self.render_time
+
+    @property
+    def rays_per_second(self) -> float:
+        return self.rays / self.render_time if self.render_time > 0 else float("inf")
+
+    def as_dict(self) -> dict:
+        values = dataclasses.asdict(self)
+        values["wall_time"] = self.wall_time
+        values["rays_per_second"] = self.rays_per_second
+        return values
+
+### CASES ###
+
+def corpus_cases(directory: str = TEST_FILES) -> "list[Case]":
+    cases = []
+    for path in sorted(glob.glob(os.path.join(directory, "*.txt"))):
+        with open(path) as file:
+            cases.append(Case(os.path.splitext(os.path.basename(path))[0], file.read()))
+    return cases
+
+def synthetic_scene(spheres: int = 100, lights: int = 1, bounces: int = 0, size: int = 100, seed: int = 0) -> str:
+    """A random scene of spheres in front of the camera over a large floor sphere.
+    When `bounces` is more than 0 every sphere is shiny and rays reflect up to `bounces` times.
+    """
+    rng = np.random.default_rng(seed)
+    lines = [f"png {size} {size} synthetic.png", f"bounces {bounces}"]
+    if bounces:
+        lines.append("shininess 0.5")
+    for _ in range(lights):
+        lines.append("color {} {} {}".format(*rng.uniform(0.2, 1, 3) / lights))
+        lines.append("sun {} {} {}".format(*rng.uniform(-1, 1, 2), 1))
+    lines.append("color 1 1 1")
+    lines.append("sphere 0 -1001 -10 1000")
+    for center, radius, color in zip(rng.uniform([-4, -1, -14], [4, 3, -4], (spheres, 3)),
+                                     rng.uniform(0.1, 0.6, spheres), rng.uniform(0, 1, (spheres, 3))):
+        lines.append("color {} {} {}".format(*color))
+        lines.append("sphere {} {} {} {}".format(*center, radius))
+    return "\n".join(lines) + "\n"
+
+def synthetic_cases() -> "list[Case]":
+    """Scenes that scale one parameter each, starting from 100 spheres, 1 light, no bounces at 100x100"""
+    cases = []
+    for spheres in (10, 100, 1000, 10000):
+        cases.append(Case(f"spheres-{spheres}", synthetic_scene(spheres=spheres)))
+    for lights in (4, 16):
+        cases.append(Case(f"lights-{lights}", synthetic_scene(lights=lights)))
+    for bounces in (1, 4, 8):
+        cases.append(Case(f"bounces-{bounces}", synthetic_scene(bounces=bounces)))
+    for size in (200, 400):
+        cases.append(Case(f"size-{size}", synthetic_scene(size=size)))
+    return cases
+
+### RUNNING ###
+
+def mismatched_pixels(actual: np.ndarray, expected: np.ndarray, fuzz: float = FUZZ) -> int:
+    """Counts the pixels where any channel differs by more than `fuzz` of 255
+
+    Args:
+        actual (np.ndarray): (height, width, 4) sRGBA pixels
+        expected (np.ndarray): (height, width, channels) pixels, RGB images count as opaque
+
+    Returns:
+        int: the number of mismatched pixels, every pixel if the sizes differ
+    """
+    if expected.shape[-1] == 3:
+        expected = np.concatenate([expected, np.full(expected.shape[:-1] + (1,), 255, dtype=expected.dtype)], axis=-1)
+    if actual.shape != expected.shape:
+        return int(np.prod(actual.shape[:-1]))
+    difference = np.abs(actual.astype(int) - expected.astype(int)).max(axis=-1)
+    return int((difference > fuzz * 255).sum())
+
+def _render(case: Case, workers: int, accel: str):
+    image_info, meta, compiled = file_parse.stream_scene(io.StringIO(case.text), accel)
+    parsed = timer()
+    frame = batch.encode(tiles.render_frame(compiled, meta, workers), meta)
+    return image_info, meta, frame, parsed
+
+def run_case(case: Case, workers: int = 1, accel: str = "auto", repeat: int = 1,
+             reference_dir: Optional[str] = CORRECT_FILES) -> Result:
+    """Renders a case `repeat` times for timing, and once more with `instrument` enabled to
+    measure memory and count rays
+
+    Args:
+        reference_dir (str): the directory of expected images, named like the scene's output file
+    """
+    parse_time = render_time = float("inf")
+    for _ in range(repeat):
+        start = timer()
+        image_info, meta, frame, parsed = _render(case, workers, accel)
+        end = timer()
+        parse_time = min(parse_time, parsed - start)
+        render_time = min(render_time, end - parsed)
+
+    was_enabled = instrument.enabled
+    recorded = instrument.snapshot()
+    instrument.reset()
+    instrument.enable()
+    tracemalloc.start()
+    try:
+        _render(case, workers, accel)
+        _, peak_memory = tracemalloc.get_traced_memory()
+        ray_counts = dict(instrument.counters)
+    finally:
+        tracemalloc.stop()
+        if not was_enabled:
+            instrument.disable()
+        instrument.reset()
+        instrument.merge(recorded)
+
+    result = Result(
+        name=case.name,
+        width=meta.width,
+        height=meta.height,
+        parse_time=parse_time,
+        render_time=render_time,
+        rays=sum(ray_counts.get(name, 0) for name in ("primary rays", "shadow rays", "reflection rays",
+                                                               "refraction rays")),
+        ray_counts=ray_counts,
+        peak_memory=peak_memory,
+    )
+    if reference_dir is not None:
+        expected_path = os.path.join(reference_dir, os.path.basename(image_info.filename))
+        if os.path.exists(expected_path):
+            expected = np.asarray(Image.open(expected_path).convert("RGBA"))
+            result.mismatched_pixels = mismatched_pixels(frame, expected)
+            result.matches = result.mismatched_pixels <= MISMATCH_LIMIT * meta.width * meta.height
+    return result
+
+### STARTUP ###
+
+MAIN = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "main.py")
+
+def import_times(args: "list[str]", cwd: Optional[str] = None) -> Tuple["dict[str, float]", float]:
+    """Runs `main.py` with `args` in a new interpreter under `-X importtime`
+
+    Args:
+        args (list[str]): the command line after `main.py`
+        cwd (str): the directory to run in, where the images are written
+
+    Returns:
+        Tuple[dict[str, float], float]: the seconds each module took to import, including the modules
+        it imported itself, and the seconds spent on imports in total
+    """
+    finished = subprocess.run([sys.executable, "-X", "importtime", MAIN, *args], cwd=cwd, stdout=subprocess.DEVNULL,
+                              stderr=subprocess.PIPE, text=True, check=True)
+    times = {}
+    total = 0.0
+    for line in finished.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package, indented by two spaces for each level
+        if not line.startswith("import time:") or line.endswith("imported package"):
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        seconds = int(cumulative) / 1e6
+        times[name.strip()] = seconds
+        if not name.startswith("  "):
+            total += seconds
+    return times, total
+
+def compare_results(results: "list[dict]", baseline: "list[dict]", limit: float = REGRESSION_LIMIT) -> "list[str]":
+    """Lists the cases that got slower than the baseline by more than `limit`. Cases missing from
+    either side are skipped.
+    """
+    baseline_by_name = {entry["name"]: entry for entry in baseline}
+    problems = []
+    for entry in results:
+        old = baseline_by_name.get(entry["name"])
+        if old is None:
+            continue
+        if entry["wall_time"] > old["wall_time"] * (1 + limit):
+            problems.append(f"{entry['name']}: {old['wall_time']:.3f}s -> {entry['wall_time']:.3f}s")
+    return problems
+
+def format_result(result: Result) -> str:
+    check = {None: "", True: "ok", False: f"WRONG ({result.mismatched_pixels} px)"}[result.matches]
+    return (f"{result.name:20s} {result.width:4d}x{result.height:<4d} {result.wall_time:8.3f}s "
+            f"{result.rays_per_second:12.0f} rays/s {result.peak_memory / 2**20:8.1f} MiB main process peak  {check}")
+
+def main(args: "list[str]") -> int:
+    parser = argparse.ArgumentParser(prog="python -m src.benchmark", description=__doc__.split("\n\n")[0])
+    parser.add_argument("--cases", choices=("all", "corpus", "synthetic"), default="all")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--accel", choices=utils.ACCELS, default="auto")
+    parser.add_argument("--repeat", type=int, default=1, help="timed renders per case, the best is kept")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare with the results in this JSON file")
+    parser.add_argument("--reference-dir", default=CORRECT_FILES,
+                        help="directory of expected images (default: %(default)s)")
+    parser.add_argument("--limit", type=float, default=REGRESSION_LIMIT,
+                        help="slowdown over the baseline reported as a regression (default: %(default)s)")
+    parser.add_argument("--startup", metavar="SCENE",
+                        help="only time the imports of main.py rendering this scene file, in a temporary directory")
+    parsed = parser.parse_args(args)
+
+    if parsed.startup:
+        with tempfile.TemporaryDirectory() as directory:
+            times, total = import_times([os.path.abspath(parsed.startup), "--workers", str(parsed.workers),
+                                         "--accel", parsed.accel], directory)
+        for name, seconds in sorted(times.items(), key=lambda item: item[1], reverse=True)[:20]:
+            print(f"{name:40s} {seconds * 1000:8.1f} ms")
+        print(f"{len(times)} modules imported in {total * 1000:.1f} ms")
+        return 0
+
+    cases = []
+    if parsed.cases in ("all", "corpus"):
+        cases += corpus_cases()
+    if parsed.cases in ("all", "synthetic"):
+        cases += synthetic_cases()
+    results = []
+    for case in cases:
+        result = run_case(case, parsed.workers, parsed.accel, parsed.repeat, parsed.reference_dir)
+        print(format_result(result))
+        results.append(result.as_dict())
+
+    if parsed.output:
+        with open(parsed.output, "w") as file:
+            json.dump({"workers": parsed.workers, "accel": parsed.accel, "results": results}, file, indent=2)
+    wrong = [entry["name"] for entry in results if entry["matches"] is False]
+    problems = [f"{name}: does not match the expected image" for name in wrong]
+    if parsed.baseline:
+        with open(parsed.baseline) as file:
+            problems += compare_results(results, json.load(file)["results"], parsed.limit)
+    for problem in problems:
+        print(problem)
+    return 1 if problems else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
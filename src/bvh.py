@@ -0,0 +1,246 @@
+"""A bounding volume hierarchy stored as flat arrays. Node `i` is described by row `i` of
+every node array, and leaves point at a run of `order`, which lists primitive indices.
+Queries walk the tree for a whole batch of rays at once, one level per step.
+"""
+import dataclasses
+from typing import Callable, Tuple
+
+import numpy as np
+from timeit import default_timer as timer
+
+LEAF_SIZE = 4
+
+# Given the ray and primitive index of each (ray, primitive) pair, returns the distance
+# along the ray to the primitive, `np.inf` for a miss
+PairIntersection = Callable[[np.ndarray, np.ndarray], np.ndarray]
+
+@dataclasses.dataclass
+class QueryStats():
+    """Counters for the work done by BVH queries
+    \b rays: rays that were queried
+    \b node_tests: ray/box tests against nodes
+    \b primitive_tests: ray/primitive tests in leaves
+    \b hits: rays that hit something
+    """
+    rays: int = 0
+    node_tests: int = 0
+    primitive_tests: int = 0
+    hits: int = 0
+
+    def __add__(self, other):
+        return QueryStats(
+            self.rays + other.rays,
+            self.node_tests + other.node_tests,
+            self.primitive_tests + other.primitive_tests,
+            self.hits + other.hits,
+        )
+
+@dataclasses.dataclass
+class BVH():
+    """A flattened BVH
+    \b lo, hi: (M, 3) corners of the bounding box of each node
+    \b left, right: (M,) child node indices, -1 for leaves
+    \b start, count: (M,) the run of `order` holding a leaf's primitives
+    \b order: (P,) primitive indices grouped by leaf
+    """
+    lo: np.ndarray
+    hi: np.ndarray
+    left: np.ndarray
+    right: np.ndarray
+    start: np.ndarray
+    count: np.ndarray
+    order: np.ndarray
+    build_time: float = 0.0
+    closest_stats: QueryStats = dataclasses.field(default_factory=QueryStats)
+    any_stats: QueryStats = dataclasses.field(default_factory=QueryStats)
+
+    @property
+    def n_nodes(self) -> int:
+        return len(self.left)
+
+    @property
+    def n_primitives(self) -> int:
+        return len(self.order)
+
+    def nbytes(self) -> int:
+        return sum(a.nbytes for a in (self.lo, self.hi, self.left, self.right, self.start, self.count, self.order))
+
+    def depth(self) -> int:
+        depth = 0
+        level = np.array([0])
+        while len(level):
+            depth += 1
+            inner = level[self.left[level] >= 0]
+            level = np.concatenate([self.left[inner], self.right[inner]])
+        return depth
+
+    def reset_stats(self) -> None:
+        self.closest_stats = QueryStats()
+        self.any_stats = QueryStats()
+
+    def _box_entry(self, origins: np.ndarray, inverse_directions: np.ndarray,
+                   nodes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Slab test of each ray against the box of its node
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: a mask of the rays that hit their box and the distance at which they enter it
+        """
+        with np.errstate(invalid="ignore"):
+            t1 = (self.lo[nodes] - origins) * inverse_directions
+            t2 = (self.hi[nodes] - origins) * inverse_directions
+        # fmin/fmax skip the nans from rays lying exactly in a slab plane
+        t_near = np.fmax(np.fmax.reduce(np.fmin(t1, t2), axis=1), 0)
+        t_far = np.fmin.reduce(np.fmax(t1, t2), axis=1)
+        return t_far >= t_near, t_near
+
+    def _leaf_pairs(self, rays: np.ndarray, leaves: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Expands (ray, leaf) pairs into (ray, primitive) pairs"""
+        counts = self.count[leaves]
+        pair_rays = np.repeat(rays, counts)
+        firsts = np.repeat(self.start[leaves] - (np.cumsum(counts) - counts), counts)
+        return pair_rays, self.order[firsts + np.arange(len(pair_rays))]
+
+    def _descend(self, rays: np.ndarray, nodes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Replaces each (ray, inner node) pair with pairs for both children"""
+        return np.concatenate([rays, rays]), np.concatenate([self.left[nodes], self.right[nodes]])
+
+    def closest_hits(self, origins: np.ndarray, directions: np.ndarray,
+                     intersect: PairIntersection) -> Tuple[np.ndarray, np.ndarray]:
+        """Finds the closest primitive hit by each ray. Ties go to the lowest primitive index,
+        like a linear scan over the primitives.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: (N,) index of the closest primitive (-1 for a miss) and (N,) distance to it
+        """
+        n_rays = len(origins)
+        best = np.full(n_rays, -1, dtype=np.intp)
+        best_t = np.full(n_rays, np.inf)
+        with np.errstate(divide="ignore"):
+            inverse_directions = 1 / directions
+        rays = np.arange(n_rays)
+        nodes = np.zeros(n_rays, dtype=np.intp)
+        self.closest_stats.rays += n_rays
+        while len(rays):
+            self.closest_stats.node_tests += len(rays)
+            hit, entry = self._box_entry(origins[rays], inverse_directions[rays], nodes)
+            keep = hit & (entry <= best_t[rays])
+            rays, nodes = rays[keep], nodes[keep]
+            leaf = self.left[nodes] < 0
+            if leaf.any():
+                pair_rays, pair_prims = self._leaf_pairs(rays[leaf], nodes[leaf])
+                t = intersect(pair_rays, pair_prims)
+                self.closest_stats.primitive_tests += len(t)
+                found = np.isfinite(t)
+                pair_rays, pair_prims, t = pair_rays[found], pair_prims[found], t[found]
+                # the first pair of each ray after sorting by (ray, distance, primitive)
+                by_ray = np.lexsort((pair_prims, t, pair_rays))
+                candidate_rays, first = np.unique(pair_rays[by_ray], return_index=True)
+                candidate_t = t[by_ray][first]
+                candidate_prims = pair_prims[by_ray][first]
+                better = (candidate_t < best_t[candidate_rays]) | (
+                    (candidate_t == best_t[candidate_rays]) & (candidate_prims < best[candidate_rays]))
+                best_t[candidate_rays[better]] = candidate_t[better]
+                best[candidate_rays[better]] = candidate_prims[better]
+            rays, nodes = self._descend(rays[~leaf], nodes[~leaf])
+        self.closest_stats.hits += int((best >= 0).sum())
+        return best, best_t
+
+    def any_hits(self, origins: np.ndarray, directions: np.ndarray, max_distances: np.ndarray,
+                 intersect: PairIntersection) -> np.ndarray:
+        """Checks whether each ray hits any primitive closer than its max distance. A ray stops
+        being traversed as soon as one blocker is found.
+
+        Returns:
+            np.ndarray: (N,) true where something blocks the ray
+        """
+        n_rays = len(origins)
+        blocked = np.zeros(n_rays, dtype=bool)
+        with np.errstate(divide="ignore"):
+            inverse_directions = 1 / directions
+        rays = np.arange(n_rays)
+        nodes = np.zeros(n_rays, dtype=np.intp)
+        self.any_stats.rays += n_rays
+        while len(rays):
+            unblocked = ~blocked[rays]
+            rays, nodes = rays[unblocked], nodes[unblocked]
+            self.any_stats.node_tests += len(rays)
+            hit, entry = self._box_entry(origins[rays], inverse_directions[rays], nodes)
+            keep = hit & (entry < max_distances[rays])
+            rays, nodes = rays[keep], nodes[keep]
+            leaf = self.left[nodes] < 0
+            if leaf.any():
+                pair_rays, pair_prims = self._leaf_pairs(rays[leaf], nodes[leaf])
+                t = intersect(pair_rays, pair_prims)
+                self.any_stats.primitive_tests += len(t)
+                blocked[pair_rays[t < max_distances[pair_rays]]] = True
+            rays, nodes = self._descend(rays[~leaf], nodes[~leaf])
+        self.any_stats.hits += int(blocked.sum())
+        return blocked
+
+    def summary(self) -> str:
+        closest, any_hit = self.closest_stats, self.any_stats
+        return (
+            f"BVH: {self.n_nodes} nodes over {self.n_primitives} shapes, depth {self.depth()}, "
+            f"built in {self.build_time}s\n"
+            f"BVH closest-hit queries: {closest.rays} rays, {closest.node_tests} node tests, "
+            f"{closest.primitive_tests} shape tests, {closest.hits} hits\n"
+            f"BVH any-hit queries: {any_hit.rays} rays, {any_hit.node_tests} node tests, "
+            f"{any_hit.primitive_tests} shape tests, {any_hit.hits} blocked"
+        )
+
+def build(lo: np.ndarray, hi: np.ndarray, leaf_size: int = LEAF_SIZE) -> BVH:
+    """Builds a BVH by splitting primitives at the median centroid along the longest axis
+
+    Args:
+        lo (np.ndarray): (P, 3) lower corner of each primitive's bounding box
+        hi (np.ndarray): (P, 3) upper corner of each primitive's bounding box
+        leaf_size (int): the most primitives a leaf may hold
+
+    Returns:
+        BVH: the hierarchy, with node 0 as the root
+    """
+    start_time = timer()
+    n_primitives = len(lo)
+    centroids = (lo + hi) / 2
+    order = np.arange(n_primitives)
+    # a binary tree with leaves of at least leaf_size / 2 primitives has fewer than this many nodes
+    max_nodes = max(1, 2 * (2 * n_primitives // max(1, leaf_size) + 1))
+    node_lo = np.full((max_nodes, 3), np.inf)
+    node_hi = np.full((max_nodes, 3), -np.inf)
+    left = np.full(max_nodes, -1, dtype=np.intp)
+    right = np.full(max_nodes, -1, dtype=np.intp)
+    start = np.zeros(max_nodes, dtype=np.intp)
+    count = np.zeros(max_nodes, dtype=np.intp)
+
+    n_nodes = 1
+    # (node, first, last) where order[first:last] are the node's primitives
+    stack = [(0, 0, n_primitives)]
+    while stack:
+        node, first, last = stack.pop()
+        ids = order[first:last]
+        if len(ids):
+            node_lo[node] = lo[ids].min(axis=0)
+            node_hi[node] = hi[ids].max(axis=0)
+        if last - first <= leaf_size:
+            start[node] = first
+            count[node] = last - first
+            continue
+        node_centroids = centroids[ids]
+        axis = np.argmax(node_centroids.max(axis=0) - node_centroids.min(axis=0))
+        middle = (last - first) // 2
+        order[first:last] = ids[np.argpartition(node_centroids[:, axis], middle)]
+        left[node], right[node] = n_nodes, n_nodes + 1
+        n_nodes += 2
+        stack.append((left[node], first, first + middle))
+        stack.append((right[node], first + middle, last))
+
+    return BVH(
+        lo=node_lo[:n_nodes],
+        hi=node_hi[:n_nodes],
+        left=left[:n_nodes],
+        right=right[:n_nodes],
+        start=start[:n_nodes],
+        count=count[:n_nodes],
+        order=order,
+        build_time=timer() - start_time,
+    )
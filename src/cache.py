@@ -0,0 +1,229 @@
+"""A binary cache of compiled scenes. Each scene file gets one cache file, named after the
+SHA-256 of its text, that holds the image info, the final `SceneMata` state, every array of the
+`compiled.CompiledScene` and its BVHs. Arrays are loaded with `np.memmap`, so opening a cached
+scene costs about the same for any size of scene, and processes that open the same cache file
+share its pages.
+
+Layout of a cache file:
+\b MAGIC, then the header length as a little endian uint64
+\b a JSON header with the version, image info, scene metadata, and the dtype, shape and
+offset of every array
+\b the raw array data, each array starting on an `ALIGNMENT` byte boundary
+"""
+import functools
+import hashlib
+import json
+import os
+import struct
+import tempfile
+from typing import Optional, Tuple
+
+import numpy as np
+
+import src.bvh as bvh
+import src.compiled as compiled
+import src.file_parse as file_parse
+import src.scene as scene
+import src.utils as utils
+
+MAGIC = b"RTSCENE\0"
+# Bump whenever the layout or meaning of a cache file changes
+CACHE_VERSION = 7
+ALIGNMENT = 64
+SUFFIX = ".scene"
+
+BVH_FIELDS = ("lo", "hi", "left", "right", "start", "count", "order")
+# Prefix of the arrays of each BVH in the file, and the `compiled.CompiledScene` attribute holding it
+TREES = tuple(("bvh." if kind == "sphere" else kind + "_bvh.", attribute)
+              for kind, attribute in compiled.TREE_FIELDS.items())
+
+def source_hash(path: str) -> str:
+    """SHA-256 of a scene file, read in blocks so large files are never held in memory"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def cache_path(cache_dir: str, digest: str) -> str:
+    return os.path.join(cache_dir, digest + SUFFIX)
+
+### SCENE METADATA ###
+
+def _meta_to_dict(meta: scene.SceneMata) -> dict:
+    exposure = None
+    function = meta.exposure_function
+    if isinstance(function, functools.partial) and function.func is scene.expose:
+        exposure = function.args[0]
+    elif function is not scene.no_exposure:
+        raise ValueError("Only exposure functions set by `expose` can be cached", function)
+    return {
+        "height": meta.height,
+        "width": meta.width,
+        "color": [meta.color.r, meta.color.g, meta.color.b, meta.color.a],
+        "eye": np.asarray(meta.eye).tolist(),
+        "forward": np.asarray(meta.forward).tolist(),
+        "right": np.asarray(meta.right).tolist(),
+        "up": np.asarray(meta.up).tolist(),
+        "exposure": exposure,
+        "lense": meta.lense.value,
+        "reflection_depth": meta.reflection_depth,
+        "shininess": meta.shininess,
+        "transparency": meta.transparency,
+        "roughness": meta.roughness,
+        "ior": meta.ior,
+        "samples": meta.samples,
+        "light_samples": meta.light_samples,
+    }
+
+def _meta_from_dict(values: dict) -> scene.SceneMata:
+    meta = scene.SceneMata(height=values["height"], width=values["width"])
+    meta.color = scene.colors.RGBLinear(*values["color"])
+    meta.eye = np.array(values["eye"])
+    meta.forward = np.array(values["forward"])
+    meta.right = np.array(values["right"])
+    meta.up = np.array(values["up"])
+    if values["exposure"] is not None:
+        meta.exposure_function = functools.partial(scene.expose, values["exposure"])
+    meta.lense = scene.Lense(values["lense"])
+    meta.reflection_depth = values["reflection_depth"]
+    meta.shininess = values["shininess"]
+    meta.transparency = values["transparency"]
+    meta.roughness = values["roughness"]
+    meta.ior = values["ior"]
+    meta.samples = values["samples"]
+    meta.light_samples = values["light_samples"]
+    return meta
+
+### READING AND WRITING ###
+
+def _scene_arrays(compiled_scene: compiled.CompiledScene) -> "dict[str, np.ndarray]":
+    arrays = {name: getattr(compiled_scene, name) for name in compiled.ARRAY_FIELDS}
+    for prefix, attribute in TREES:
+        tree = getattr(compiled_scene, attribute)
+        if tree is not None:
+            for name in BVH_FIELDS:
+                arrays[prefix + name] = getattr(tree, name)
+    return arrays
+
+def _aligned(offset: int) -> int:
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+def write(path: str, image_info: utils.ImageInfo, meta: scene.SceneMata,
+          compiled_scene: compiled.CompiledScene) -> None:
+    """Writes a cache file. The file is written under a temporary name and then renamed, so a
+    reader never sees a partly written cache.
+    """
+    arrays = _scene_arrays(compiled_scene)
+    layout = {}
+    offset = 0
+    for name, array in arrays.items():
+        layout[name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+        offset = _aligned(offset + array.nbytes)
+    header = json.dumps({
+        "version": CACHE_VERSION,
+        "image_info": {
+            "filename": image_info.filename,
+            "width": image_info.width,
+            "height": image_info.height,
+            "is_single_file": image_info.is_single_file,
+            "number_of_images": image_info.number_of_images,
+        },
+        "meta": _meta_to_dict(meta),
+        "bvh_build_times": {
+            prefix: getattr(compiled_scene, attribute).build_time
+            for prefix, attribute in TREES if getattr(compiled_scene, attribute) is not None
+        },
+        "arrays": layout,
+    }).encode()
+    data_start = _aligned(len(MAGIC) + 8 + len(header))
+
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    descriptor, temporary = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(descriptor, "wb") as file:
+            file.write(MAGIC + struct.pack("<Q", len(header)) + header)
+            for name, array in arrays.items():
+                file.seek(data_start + layout[name]["offset"])
+                file.write(np.ascontiguousarray(array).tobytes())
+            file.truncate(data_start + offset)
+        os.replace(temporary, path)
+    except BaseException:
+        os.unlink(temporary)
+        raise
+
+def read(path: str) -> Tuple[utils.ImageInfo, scene.SceneMata, compiled.CompiledScene]:
+    """Opens a cache file. The arrays of the scene are read only views of a memory map of the file.
+
+    Raises:
+        ValueError: if the file is not a cache file of the current version
+    """
+    with open(path, "rb") as file:
+        start = file.read(len(MAGIC) + 8)
+        if len(start) < len(MAGIC) + 8 or start[:len(MAGIC)] != MAGIC:
+            raise ValueError("Not a scene cache file", path)
+        header_length, = struct.unpack("<Q", start[len(MAGIC):])
+        header = json.loads(file.read(header_length))
+    if header["version"] != CACHE_VERSION:
+        raise ValueError("Scene cache file has a different version", path, header["version"])
+    data_start = _aligned(len(MAGIC) + 8 + header_length)
+
+    raw = np.memmap(path, dtype=np.uint8, mode="r")
+    arrays = {}
+    for name, entry in header["arrays"].items():
+        dtype = np.dtype(entry["dtype"])
+        count = int(np.prod(entry["shape"]))
+        first = data_start + entry["offset"]
+        arrays[name] = raw[first:first + count * dtype.itemsize].view(dtype).reshape(entry["shape"])
+
+    trees = {}
+    for prefix, attribute in TREES:
+        if prefix + "order" in arrays:
+            trees[attribute] = bvh.BVH(**{name: arrays[prefix + name] for name in BVH_FIELDS},
+                                       build_time=header["bvh_build_times"][prefix])
+    compiled_scene = compiled.CompiledScene(
+        **{name: arrays[name] for name in compiled.ARRAY_FIELDS},
+        **trees,
+        cache_path=path,
+    )
+    image_info = utils.ImageInfo(**header["image_info"])
+    return image_info, _meta_from_dict(header["meta"]), compiled_scene
+
+def load_scene(path: str, cache_dir: str, accel: str = "auto"
+               ) -> Tuple[utils.ImageInfo, scene.SceneMata, compiled.CompiledScene]:
+    """Loads a scene file through the cache, parsing it with `file_parse.stream_scene` and writing a
+    cache file first when there is no usable one.
+
+    Args:
+        path (str): the scene file
+        cache_dir (str): the directory holding the cache files
+        accel (str): "bvh", "none", or "auto", see `compiled.compile_scene`
+
+    Returns:
+        Tuple[utils.ImageInfo, scene.SceneMata, compiled.CompiledScene]: the same values as `file_parse.stream_scene`
+    """
+    entry = cache_path(cache_dir, source_hash(path))
+    loaded: Optional[Tuple[utils.ImageInfo, scene.SceneMata, compiled.CompiledScene]] = None
+    if os.path.exists(entry):
+        try:
+            loaded = read(entry)
+        except (ValueError, KeyError):
+            # an old or damaged cache file is replaced below
+            loaded = None
+    if loaded is None or (compiled.wants_bvh(loaded[2], accel) and loaded[2].tree is None):
+        if loaded is None:
+            with open(path, "r") as file:
+                image_info, meta, compiled_scene = file_parse.stream_scene(file, accel)
+        else:
+            image_info, meta, compiled_scene = loaded
+            compiled_scene.build_bvh()
+        write(entry, image_info, meta, compiled_scene)
+        loaded = read(entry)
+
+    image_info, meta, compiled_scene = loaded
+    if not compiled.wants_bvh(compiled_scene, accel) and compiled_scene.trees():
+        # the cached BVHs are still on disk, so workers must not reopen the cache file
+        compiled_scene.drop_trees()
+        compiled_scene.cache_path = None
+    return image_info, meta, compiled_scene
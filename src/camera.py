@@ -0,0 +1,121 @@
+"""Eye rays for the array renderers. The rays of every pixel of a frame are built in one go for
+each lens, and kept for the last few (camera, resolution) pairs, so the frames of an animation
+with a camera that does not move, and the tiles of one frame, all reuse the same bundle.
+"""
+import dataclasses
+import functools
+import math
+from typing import Tuple
+
+import numpy as np
+
+import src.scene as scene
+
+# How many (camera, resolution) pairs keep their rays
+CACHED_BUNDLES = 4
+
+@dataclasses.dataclass(frozen=True)
+class Camera():
+    """The part of `scene.SceneMata` that decides where eye rays go, as plain tuples so it can be hashed
+    \b eye: A point.
+    \b forward: A vector, its length is the focal length of the normal lens.
+    \b right, up: normalized vectors.
+    """
+    eye: Tuple[float, float, float]
+    forward: Tuple[float, float, float]
+    right: Tuple[float, float, float]
+    up: Tuple[float, float, float]
+    lense: scene.Lense
+
+    @classmethod
+    def from_meta(cls, meta: scene.SceneMata) -> "Camera":
+        def point(value) -> Tuple[float, float, float]:
+            return tuple(float(v) for v in np.asarray(value))
+        return cls(point(meta.eye), point(meta.forward), point(meta.right), point(meta.up), meta.lense)
+
+@dataclasses.dataclass
+class RayBundle():
+    """The eye rays of every pixel of a frame, in the order of `pixel_grid`
+    \b directions: (width * height, 3) normalized ray directions, zero where `valid` is false
+    \b valid: (width * height,) the pixels that shoot a ray at all
+    """
+    directions: np.ndarray
+    valid: np.ndarray
+
+def pixel_grid(width: int, height: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Lists every pixel of the image in the same order `raytracer.raytrace_scene` visits them
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: the column and row of each pixel
+    """
+    xs, ys = np.meshgrid(np.arange(width), np.arange(height), indexing="ij")
+    return xs.ravel(), ys.ravel()
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    return vectors / np.linalg.norm(vectors, axis=-1, keepdims=True)
+
+def directions(camera: Camera, xs: np.ndarray, ys: np.ndarray, width: int, height: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Vectorized version of `raytracer.make_eye_ray`, for any pixel positions, whole or not
+
+    Args:
+        camera (Camera): the camera
+        xs (np.ndarray): the column of each pixel
+        ys (np.ndarray): the row of each pixel
+        width (int): the width of the image
+        height (int): the height of the image
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: (N, 3) normalized ray directions, and a mask of the pixels
+        that shoot a ray at all. Directions are zero where the mask is false.
+    """
+    forward, right, up = np.array(camera.forward), np.array(camera.right), np.array(camera.up)
+    valid = np.ones(len(xs), dtype=bool)
+    if camera.lense == scene.Lense.panorama:
+        longitude = ((2*xs - width)/width * math.pi)[:, np.newaxis]
+        latitude = ((height - 2*ys)/height * (math.pi/2))[:, np.newaxis]
+        ray_directions = np.cos(latitude) * (np.sin(longitude) * right + np.cos(longitude) * _normalize(forward)) \
+            + np.sin(latitude) * up
+    else:
+        h_w_max = max(height, width)
+        s_x = ((2*xs - width)/h_w_max)[:, np.newaxis]
+        s_y = ((height - 2*ys)/h_w_max)[:, np.newaxis]
+        if camera.lense == scene.Lense.normal:
+            ray_directions = forward + s_x * right + s_y * up
+        elif camera.lense == scene.Lense.fisheye:
+            len_of_forward = np.linalg.norm(forward)
+            s_x = s_x / len_of_forward
+            s_y = s_y / len_of_forward
+            r_sqr = s_x**2 + s_y**2
+            # pixels outside the circle of the lens shoot no ray
+            valid = np.sqrt(r_sqr[:, 0]) <= 1
+            ray_directions = np.sqrt(np.maximum(1 - r_sqr, 0)) * forward + s_x * right + s_y * up
+    ray_directions = ray_directions.astype(float)
+    ray_directions[valid] = _normalize(ray_directions[valid])
+    ray_directions[~valid] = 0
+    return ray_directions, valid
+
+@functools.lru_cache(maxsize=CACHED_BUNDLES)
+def frame_rays(camera: Camera, width: int, height: int) -> RayBundle:
+    """The eye rays of every pixel of a width x height frame. The arrays are shared between
+    callers and read only.
+    """
+    xs, ys = pixel_grid(width, height)
+    ray_directions, valid = directions(camera, xs, ys, width, height)
+    ray_directions.flags.writeable = False
+    valid.flags.writeable = False
+    return RayBundle(ray_directions, valid)
+
+def eye_rays(xs: np.ndarray, ys: np.ndarray, meta: scene.SceneMata) -> Tuple[np.ndarray, np.ndarray]:
+    """The eye rays of a set of pixels. Whole pixels are looked up in the bundle of their frame,
+    other positions, like the jittered ones of `antialias`, are computed.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: (N, 3) normalized ray directions and a mask of the pixels that shoot a ray
+    """
+    camera = Camera.from_meta(meta)
+    if not (np.issubdtype(xs.dtype, np.integer) and np.issubdtype(ys.dtype, np.integer)):
+        return directions(camera, xs, ys, meta.width, meta.height)
+    bundle = frame_rays(camera, meta.width, meta.height)
+    # `pixel_grid` lists the pixels column by column
+    index = xs * meta.height + ys
+    return bundle.directions[index], bundle.valid[index]
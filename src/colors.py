@@ -78,6 +78,26 @@ class RGBLinear():
         self.g = exposure_funct(self.g)
         self.b = exposure_funct(self.b)
 
+def linear_to_srgb(linear: np.ndarray, exposure_funct: Callable[[np.ndarray], np.ndarray]) -> np.ndarray:
+    """Vectorized `RGBLinear.apply_exposure` followed by `RGBLinear.as_rgb(rounded=True)`. Every step
+    does the same float operations as the per-pixel version, so the results are the same bits.
+
+    Args:
+        linear (np.ndarray): (..., 4) linear RGB and alpha
+        exposure_funct (Callable[[np.ndarray], np.ndarray]): applied to the RGB channels, it must work on arrays
+
+    Returns:
+        np.ndarray: (..., 4) sRGBA as uint8
+    """
+    rgb = exposure_funct(linear[..., :3])
+    rgb = np.where(rgb <= 0.0031308, 12.92 * rgb, 1.055 * np.power(np.maximum(rgb, 0.0031308), 1/2.4) - 0.055)
+    values = np.concatenate([rgb * 255, linear[..., 3:] * 255], axis=-1)
+    # `bound`, including what `min` and `max` do with nan
+    values = np.where(values < 255, values, 255)
+    values = np.where(values > 0, values, 0)
+    # np.round rounds halves to even like `round`
+    return np.round(values).astype(np.uint8)
+
 def color_from_ndarray(array: np.ndarray) -> RGBLinear:
     return RGBLinear(r=array[0], g=array[1], b=array[2])
 
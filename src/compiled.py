@@ -0,0 +1,504 @@
+"""A compact form of `scene.SceneObjects` used by the array based renderers. Every property
+of the primitives and lights is kept in one contiguous array, indexed by primitive or light
+number, instead of in a dataclass per object.
+
+Primitives are numbered by kind, in the order of `KINDS`: spheres first, then triangles, boxes
+and planes. Primitive `i` is sphere `i` when `i` is less than `n_spheres`, triangle
+`i - n_spheres` when it is less than `n_spheres + n_triangles`, and so on. The material arrays
+hold one row per primitive in that order, and `source_order` keeps the position of each
+primitive in the scene file, which breaks ties between primitives at the same distance.
+"""
+import dataclasses
+from typing import Callable, Optional, Tuple, Union
+
+import numpy as np
+
+import src.bvh as bvh
+import src.light as light
+import src.scene as scene
+import src.shapes as shapes
+
+# Values of `CompiledScene.light_types`
+SUN = 0
+BULB = 1
+SPHERE_LIGHT = 2
+AREA_LIGHT = 3
+LIGHT_TYPES = {light.Sun: SUN, light.Bulb: BULB, light.SphereLight: SPHERE_LIGHT, light.AreaLight: AREA_LIGHT}
+
+# Scenes with at least this many primitives of a kind that fits in a BVH get BVHs when the
+# acceleration mode is "auto"
+BVH_THRESHOLD = 32
+
+# The kinds of primitives, in the order they are numbered
+KINDS = ("sphere", "triangle", "box", "plane")
+# The arrays with one row per sphere
+SPHERE_FIELDS = ("centers", "radii")
+# The arrays of the triangle mesh
+TRIANGLE_FIELDS = ("vertices", "triangles")
+# The arrays with one row per box
+BOX_FIELDS = ("box_lows", "box_highs")
+# The arrays with one row per plane
+PLANE_FIELDS = ("plane_normals", "plane_offsets")
+# The material arrays, with one row per primitive
+MATERIAL_FIELDS = ("colors", "shininess", "roughness", "transparency", "ior")
+# The position of each primitive in the scene file, with one row per primitive
+ORDER_FIELDS = ("source_order",)
+# The arrays with one row per light
+LIGHT_FIELDS = ("light_points", "light_colors", "light_types", "light_radii", "light_edges", "light_samples")
+ARRAY_FIELDS = (SPHERE_FIELDS + TRIANGLE_FIELDS + BOX_FIELDS + PLANE_FIELDS + MATERIAL_FIELDS + ORDER_FIELDS
+                + LIGHT_FIELDS)
+# The attribute of `CompiledScene` holding the BVH of each kind that has one. Planes are
+# unbounded, so they never go into a BVH and are always tested against every ray.
+TREE_FIELDS = {"sphere": "tree", "triangle": "triangle_tree", "box": "box_tree"}
+
+# Parameters of some primitives of a kind, given a slice or an index array into the kind
+PrimitiveArrays = Callable[[Union[np.ndarray, slice]], Tuple[np.ndarray, ...]]
+
+@dataclasses.dataclass
+class Primitives():
+    """The primitives of one kind in a `CompiledScene`, and how the array renderers trace them
+    \b kind: one of `KINDS`
+    \b first: the number of the first primitive of the kind
+    \b count: how many there are
+    \b tree: a BVH over the first `tree.n_primitives` of them, None if there is none
+    \b arrays: the parameters `distances` takes after the rays, for some primitives of the kind
+    \b distances: the function of `shapes` that intersects rays with the kind, like `shapes.sphere_distances`
+    \b normals: the normalized normals at (N, 3) points on the primitives with the given indices into the kind
+    \b two_sided: see `shapes.Shape.two_sided`
+    """
+    kind: str
+    first: int
+    count: int
+    tree: Optional[bvh.BVH]
+    arrays: PrimitiveArrays
+    distances: Callable[..., np.ndarray]
+    normals: Callable[[np.ndarray, np.ndarray], np.ndarray]
+    two_sided: bool
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    return vectors / np.linalg.norm(vectors, axis=-1, keepdims=True)
+
+@dataclasses.dataclass
+class CompiledScene():
+    """The primitives and lights of a scene as arrays
+    \b centers: (S, 3) sphere centers
+    \b radii: (S,) sphere radii
+    \b vertices: (V, 3) corners of the triangles
+    \b triangles: (T, 3) the rows of `vertices` at the corners of each triangle
+    \b box_lows, box_highs: (B, 3) the smallest and largest corner of each box
+    \b plane_normals: (P, 3) the normal of each plane, not normalized
+    \b plane_offsets: (P,) the offset of each plane, see `shapes.Plane`
+    \b colors: (S + T + B + P, 3) linear primitive colors
+    \b shininess, roughness, transparency, ior: (S + T + B + P,) primitive materials
+    \b source_order: (S + T + B + P,) the position of each primitive among the primitives of the scene
+    file, so the renderers can pick the one that comes first when two are hit at the same distance
+    \b light_points: (L, 3) bulb positions and the centers of soft lights, or the direction towards a sun
+    \b light_colors: (L, 3) linear light colors
+    \b light_types: (L,) `SUN`, `BULB`, `SPHERE_LIGHT` or `AREA_LIGHT`
+    \b light_radii: (L,) the radius of sphere lights, 0 for the others
+    \b light_edges: (L, 6) the two sides of area lights, 0 for the others
+    \b light_samples: (L,) the number of shadow rays of soft lights, 1 for the others
+    \b tree: a BVH over the first `tree.n_primitives` spheres, any spheres after those and every
+    sphere when it is None are tested against each ray one after another
+    \b triangle_tree, box_tree: the same for the triangles and the boxes
+    \b cache_path: the `cache` file the arrays are mapped from, if any
+    """
+    centers: np.ndarray
+    radii: np.ndarray
+    colors: np.ndarray
+    shininess: np.ndarray
+    roughness: np.ndarray
+    transparency: np.ndarray
+    ior: np.ndarray
+    source_order: np.ndarray
+    light_points: np.ndarray
+    light_colors: np.ndarray
+    light_types: np.ndarray
+    light_radii: np.ndarray
+    light_edges: np.ndarray
+    light_samples: np.ndarray
+    vertices: np.ndarray = dataclasses.field(default_factory=lambda: np.zeros((0, 3)))
+    triangles: np.ndarray = dataclasses.field(default_factory=lambda: np.zeros((0, 3), dtype=np.intp))
+    box_lows: np.ndarray = dataclasses.field(default_factory=lambda: np.zeros((0, 3)))
+    box_highs: np.ndarray = dataclasses.field(default_factory=lambda: np.zeros((0, 3)))
+    plane_normals: np.ndarray = dataclasses.field(default_factory=lambda: np.zeros((0, 3)))
+    plane_offsets: np.ndarray = dataclasses.field(default_factory=lambda: np.zeros(0))
+    tree: Optional[bvh.BVH] = None
+    triangle_tree: Optional[bvh.BVH] = None
+    box_tree: Optional[bvh.BVH] = None
+    cache_path: Optional[str] = None
+
+    @property
+    def n_spheres(self) -> int:
+        return len(self.radii)
+
+    @property
+    def n_triangles(self) -> int:
+        return len(self.triangles)
+
+    @property
+    def n_boxes(self) -> int:
+        return len(self.box_lows)
+
+    @property
+    def n_planes(self) -> int:
+        return len(self.plane_offsets)
+
+    @property
+    def n_primitives(self) -> int:
+        return self.n_spheres + self.n_triangles + self.n_boxes + self.n_planes
+
+    def counts(self) -> "dict[str, int]":
+        """The number of primitives of each kind, in the order of `KINDS`"""
+        return {"sphere": self.n_spheres, "triangle": self.n_triangles, "box": self.n_boxes, "plane": self.n_planes}
+
+    @property
+    def n_lights(self) -> int:
+        return len(self.light_types)
+
+    @property
+    def is_sun(self) -> np.ndarray:
+        return self.light_types == SUN
+
+    @property
+    def is_soft(self) -> np.ndarray:
+        """True for the lights that cast soft shadows, see `light.SoftLight`"""
+        return (self.light_types == SPHERE_LIGHT) | (self.light_types == AREA_LIGHT)
+
+    def triangle_edges(self, index: Union[np.ndarray, slice] = slice(None)) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """The first corner of each of the given triangles and the two edges leaving it
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray, np.ndarray]: p0, p1 - p0 and p2 - p0 of each triangle
+        """
+        corners = self.vertices[self.triangles[index]]
+        first = corners[..., 0, :]
+        return first, corners[..., 1, :] - first, corners[..., 2, :] - first
+
+    def primitives(self) -> "list[Primitives]":
+        """Every kind of primitive of the scene, in the order of `KINDS`, including the empty ones"""
+        counts = self.counts()
+        firsts = np.cumsum([0] + list(counts.values()))
+        def sphere_normals(points: np.ndarray, index: np.ndarray) -> np.ndarray:
+            return _normalize(points - self.centers[index])
+        def triangle_normals(points: np.ndarray, index: np.ndarray) -> np.ndarray:
+            _, edges1, edges2 = self.triangle_edges(index)
+            return _normalize(np.cross(edges1, edges2))
+        def box_normals(points: np.ndarray, index: np.ndarray) -> np.ndarray:
+            return shapes.box_normals(points, self.box_lows[index], self.box_highs[index])
+        def plane_normals(points: np.ndarray, index: np.ndarray) -> np.ndarray:
+            return _normalize(self.plane_normals[index])
+        described = {
+            "sphere": (lambda index: (self.centers[index], self.radii[index]), shapes.sphere_distances, sphere_normals),
+            "triangle": (self.triangle_edges, shapes.triangle_distances, triangle_normals),
+            "box": (lambda index: (self.box_lows[index], self.box_highs[index]), shapes.box_distances, box_normals),
+            "plane": (lambda index: (self.plane_normals[index], self.plane_offsets[index]), shapes.plane_distances,
+                      plane_normals),
+        }
+        return [
+            Primitives(kind, int(first), counts[kind], getattr(self, TREE_FIELDS[kind]) if kind in TREE_FIELDS else None,
+                       *described[kind], two_sided=kind in ("triangle", "plane"))
+            for kind, first in zip(KINDS, firsts)
+        ]
+
+    def bounds(self, kind: str) -> Tuple[np.ndarray, np.ndarray]:
+        """The smallest and largest corner of the bounding box of each primitive of a kind in `TREE_FIELDS`"""
+        if kind == "sphere":
+            radii = self.radii[:, np.newaxis]
+            return self.centers - radii, self.centers + radii
+        if kind == "triangle":
+            corners = self.vertices[self.triangles]
+            return corners.min(axis=1), corners.max(axis=1)
+        return self.box_lows, self.box_highs
+
+    def build_bvh(self) -> bvh.BVH:
+        """Builds the BVH of the spheres, and those of the other kinds in `TREE_FIELDS` that have any primitives
+
+        Returns:
+            bvh.BVH: the BVH of the spheres
+        """
+        counts = self.counts()
+        for kind, attribute in TREE_FIELDS.items():
+            tree = None
+            if kind == "sphere" or counts[kind]:
+                tree = bvh.build(*self.bounds(kind))
+            setattr(self, attribute, tree)
+        return self.tree
+
+    def trees(self) -> "list[bvh.BVH]":
+        """Every BVH the scene has, in the order of `KINDS`"""
+        return [tree for tree in (getattr(self, attribute) for attribute in TREE_FIELDS.values()) if tree is not None]
+
+    def drop_trees(self) -> None:
+        """Forgets every BVH, so every primitive is tested against each ray"""
+        for attribute in TREE_FIELDS.values():
+            setattr(self, attribute, None)
+
+    def nbytes(self) -> int:
+        """Memory used by the primitive and light arrays, not counting the BVH"""
+        return sum(getattr(self, name).nbytes for name in ARRAY_FIELDS)
+
+    def bytes_per_sphere(self) -> int:
+        return sum(
+            getattr(self, name).itemsize * int(np.prod(getattr(self, name).shape[1:]))
+            for name in SPHERE_FIELDS + MATERIAL_FIELDS + ORDER_FIELDS
+        )
+
+    def summary(self) -> str:
+        text = (
+            f"Compiled scene: {self.n_spheres} spheres, {self.n_triangles} triangles, {self.n_boxes} boxes, "
+            f"{self.n_planes} planes, {self.n_lights} lights, "
+            f"{self.nbytes()} bytes ({self.bytes_per_sphere()} bytes per sphere, "
+            f"{self.bytes_per_sphere() * 10**6 / 2**20:.1f} MiB per million spheres)"
+        )
+        if self.trees():
+            text += f"\nBVH memory: {sum(tree.nbytes() for tree in self.trees())} bytes"
+        return text
+
+class GrowingArray():
+    """An array that rows can be appended to, doubling its storage when it runs out"""
+    def __init__(self, width: int, dtype = float, capacity: int = 1024):
+        self._data = np.zeros((capacity, width), dtype=dtype)
+        self._length = 0
+
+    def __len__(self) -> int:
+        return self._length
+
+    def extend(self, rows: np.ndarray) -> None:
+        rows = np.asarray(rows, dtype=self._data.dtype).reshape(-1, self._data.shape[1])
+        needed = self._length + len(rows)
+        if needed > len(self._data):
+            grown = np.zeros((max(needed, 2 * len(self._data)), self._data.shape[1]), dtype=self._data.dtype)
+            grown[:self._length] = self._data[:self._length]
+            self._data = grown
+        self._data[self._length:needed] = rows
+        self._length = needed
+
+    def array(self) -> np.ndarray:
+        """A trimmed, contiguous copy of the rows added so far"""
+        return self._data[:self._length].copy()
+
+class SceneBuilder():
+    """Collects primitives and lights into growing arrays, for parsers that never make dataclasses
+
+    Args:
+        shared_vertices (int): the number of vertices of a scene this one will be appended to, see
+        `append_scene`. Vertex numbers count those first, so triangles can use them.
+    """
+    def __init__(self, shared_vertices: int = 0):
+        self._spheres = GrowingArray(4)
+        self._shared_vertices = shared_vertices
+        self._vertices = GrowingArray(3)
+        self._triangles = GrowingArray(3, dtype=np.intp)
+        self._boxes = GrowingArray(6)
+        self._planes = GrowingArray(4)
+        self._materials = {kind: GrowingArray(7) for kind in KINDS}
+        self._source_order = {kind: GrowingArray(1, dtype=np.intp) for kind in KINDS}
+        self._n_primitives = 0
+        # point, color, radius, edges and samples
+        self._lights = GrowingArray(14)
+        self._light_types = GrowingArray(1, dtype=np.int8)
+
+    @property
+    def n_vertices(self) -> int:
+        """The number of vertices triangles can use so far, counting the shared ones"""
+        return self._shared_vertices + len(self._vertices)
+
+    @staticmethod
+    def material(scene_meta: scene.SceneMata) -> "list[float]":
+        """The material state a primitive made now would get, as a row for `add_spheres` and the like"""
+        color = scene_meta.color
+        return [color.r, color.g, color.b, scene_meta.shininess, scene_meta.roughness, scene_meta.transparency,
+                scene_meta.ior]
+
+    def _add_order(self, kind: str, source_order: Optional[np.ndarray]) -> None:
+        """Numbers the primitives of `kind` just given materials"""
+        count = len(self._materials[kind]) - len(self._source_order[kind])
+        if source_order is None:
+            source_order = np.arange(self._n_primitives, self._n_primitives + count)
+        self._source_order[kind].extend(source_order)
+        self._n_primitives = max(self._n_primitives, int(np.max(source_order, initial=-1)) + 1)
+
+    def add_spheres(self, spheres: np.ndarray, materials: np.ndarray, source_order: Optional[np.ndarray] = None) -> None:
+        """Adds spheres to the scene
+
+        Args:
+            spheres (np.ndarray): (N, 4) rows of x, y, z, radius
+            materials (np.ndarray): (N, 7) rows made by `material`
+            source_order (np.ndarray): (N,) the position of each sphere in the scene file, None for
+            after every primitive added so far
+        """
+        self._spheres.extend(spheres)
+        self._materials["sphere"].extend(materials)
+        self._add_order("sphere", source_order)
+
+    def add_vertices(self, vertices: np.ndarray) -> None:
+        """Adds (N, 3) points that triangles can use as corners"""
+        self._vertices.extend(vertices)
+
+    def add_triangles(self, triangles: np.ndarray, materials: np.ndarray,
+                      source_order: Optional[np.ndarray] = None) -> None:
+        """Adds triangles to the scene
+
+        Args:
+            triangles (np.ndarray): (N, 3) the vertex number of each corner, counting from 0
+            materials (np.ndarray): (N, 7) rows made by `material`
+            source_order (np.ndarray): see `add_spheres`
+
+        Raises:
+            IndexError: if a corner is not one of the vertices added so far
+        """
+        triangles = np.asarray(triangles, dtype=np.intp).reshape(-1, 3)
+        if len(triangles) and (triangles.min() < 0 or triangles.max() >= self.n_vertices):
+            raise IndexError("A triangle uses a vertex that does not exist", self.n_vertices)
+        self._triangles.extend(triangles)
+        self._materials["triangle"].extend(materials)
+        self._add_order("triangle", source_order)
+
+    def add_boxes(self, boxes: np.ndarray, materials: np.ndarray, source_order: Optional[np.ndarray] = None) -> None:
+        """Adds axis-aligned boxes to the scene
+
+        Args:
+            boxes (np.ndarray): (N, 6) rows of two opposite corners, x, y, z each
+            materials (np.ndarray): (N, 7) rows made by `material`
+            source_order (np.ndarray): see `add_spheres`
+        """
+        corners = np.asarray(boxes, dtype=float).reshape(-1, 2, 3)
+        self._boxes.extend(np.concatenate([corners.min(axis=1), corners.max(axis=1)], axis=1))
+        self._materials["box"].extend(materials)
+        self._add_order("box", source_order)
+
+    def add_planes(self, planes: np.ndarray, materials: np.ndarray, source_order: Optional[np.ndarray] = None) -> None:
+        """Adds planes to the scene
+
+        Args:
+            planes (np.ndarray): (N, 4) rows of A, B, C, D for the plane Ax + By + Cz + D = 0
+            materials (np.ndarray): (N, 7) rows made by `material`
+            source_order (np.ndarray): see `add_spheres`
+        """
+        self._planes.extend(planes)
+        self._materials["plane"].extend(materials)
+        self._add_order("plane", source_order)
+
+    def add_light(self, light_type: int, point: np.ndarray, scene_meta: scene.SceneMata,
+                  radius: float = 0.0, edges: Optional[np.ndarray] = None) -> None:
+        """Adds a light with the current color. Soft lights also get `scene_meta.light_samples`.
+
+        Args:
+            light_type (int): one of `LIGHT_TYPES`
+            point (np.ndarray): the position of the light, or the direction towards a sun
+            radius (float): the radius of a sphere light
+            edges (np.ndarray): the two sides of an area light, one after the other
+        """
+        color = scene_meta.color
+        edges = np.zeros(6) if edges is None else edges
+        samples = scene_meta.light_samples if light_type in (SPHERE_LIGHT, AREA_LIGHT) else 1
+        self._lights.extend([point[0], point[1], point[2], color.r, color.g, color.b, radius, *edges, samples])
+        self._light_types.extend([light_type])
+
+    def build(self, accel: str = "auto") -> CompiledScene:
+        """Finishes the scene, see `compile_scene` for `accel`"""
+        spheres = self._spheres.array()
+        boxes = self._boxes.array()
+        planes = self._planes.array()
+        materials = np.concatenate([self._materials[kind].array() for kind in KINDS])
+        lights = self._lights.array()
+        compiled = CompiledScene(
+            centers=np.ascontiguousarray(spheres[:, :3]),
+            radii=spheres[:, 3].copy(),
+            vertices=self._vertices.array(),
+            triangles=self._triangles.array(),
+            box_lows=np.ascontiguousarray(boxes[:, :3]),
+            box_highs=np.ascontiguousarray(boxes[:, 3:]),
+            plane_normals=np.ascontiguousarray(planes[:, :3]),
+            plane_offsets=planes[:, 3].copy(),
+            colors=np.ascontiguousarray(materials[:, :3]),
+            shininess=materials[:, 3].copy(),
+            roughness=materials[:, 4].copy(),
+            transparency=materials[:, 5].copy(),
+            ior=materials[:, 6].copy(),
+            source_order=np.concatenate([self._source_order[kind].array()[:, 0] for kind in KINDS]),
+            light_points=np.ascontiguousarray(lights[:, :3]),
+            light_colors=np.ascontiguousarray(lights[:, 3:6]),
+            light_types=self._light_types.array()[:, 0].copy(),
+            light_radii=lights[:, 6].copy(),
+            light_edges=np.ascontiguousarray(lights[:, 7:13]),
+            light_samples=lights[:, 13].astype(np.intp),
+        )
+        _build_accel(compiled, accel)
+        return compiled
+
+def append_scene(first: CompiledScene, second: CompiledScene) -> CompiledScene:
+    """A scene with the primitives and lights of `second` after those of `first`, kind by kind. The
+    triangles of `second` are numbered as if it was built with `SceneBuilder(first.n_vertices)`.
+    The BVHs of `first` are kept, so only the primitives of `second` are outside of them. The
+    primitives of `second` come after all of those of `first` in `source_order`.
+    """
+    def by_kind(first_rows: np.ndarray, second_rows: np.ndarray) -> np.ndarray:
+        # the primitives stay grouped by kind in the result
+        parts = []
+        for first_kind, second_kind in zip(first.primitives(), second.primitives()):
+            parts.append(first_rows[first_kind.first:first_kind.first + first_kind.count])
+            parts.append(second_rows[second_kind.first:second_kind.first + second_kind.count])
+        return np.concatenate(parts)
+    return CompiledScene(
+        **{name: np.concatenate([getattr(first, name), getattr(second, name)])
+           for name in SPHERE_FIELDS + TRIANGLE_FIELDS + BOX_FIELDS + PLANE_FIELDS + LIGHT_FIELDS},
+        **{name: by_kind(getattr(first, name), getattr(second, name)) for name in MATERIAL_FIELDS},
+        source_order=by_kind(first.source_order, second.source_order + first.n_primitives),
+        **{attribute: getattr(first, attribute) for attribute in TREE_FIELDS.values()},
+    )
+
+def wants_bvh(compiled: CompiledScene, accel: str) -> bool:
+    """Whether the scene should have BVHs under the acceleration mode `accel`. Planes do not count,
+    since they never go into a BVH.
+    """
+    counts = compiled.counts()
+    return accel == "bvh" or (accel == "auto" and max(counts[kind] for kind in TREE_FIELDS) >= BVH_THRESHOLD)
+
+def _build_accel(compiled: CompiledScene, accel: str) -> None:
+    if wants_bvh(compiled, accel):
+        compiled.build_bvh()
+
+def compile_scene(objects: scene.SceneObjects, accel: str = "auto") -> CompiledScene:
+    """Packs the primitives and lights of the scene into arrays. Every triangle gets its own three vertices.
+
+    Args:
+        objects (scene.SceneObjects): the parsed scene
+        accel (str): "bvh", "none", or "auto" to build a BVH only for larger scenes
+
+    Returns:
+        CompiledScene: the scene as arrays
+    """
+    spheres = [shape for shape in objects.shapes if isinstance(shape, shapes.Sphere)]
+    triangles = [shape for shape in objects.shapes if isinstance(shape, shapes.Triangle)]
+    boxes = [shape for shape in objects.shapes if isinstance(shape, shapes.Box)]
+    planes = [shape for shape in objects.shapes if isinstance(shape, shapes.Plane)]
+    primitives = spheres + triangles + boxes + planes
+    source_order = {id(shape): number for number, shape in enumerate(objects.shapes)}
+    compiled = CompiledScene(
+        centers=np.array([s.center for s in spheres], dtype=float).reshape(-1, 3),
+        radii=np.array([s.radius for s in spheres], dtype=float),
+        vertices=np.array([[t.p0, t.p1, t.p2] for t in triangles], dtype=float).reshape(-1, 3),
+        triangles=np.arange(3 * len(triangles), dtype=np.intp).reshape(-1, 3),
+        box_lows=np.array([b.low for b in boxes], dtype=float).reshape(-1, 3),
+        box_highs=np.array([b.high for b in boxes], dtype=float).reshape(-1, 3),
+        plane_normals=np.array([p.normal for p in planes], dtype=float).reshape(-1, 3),
+        plane_offsets=np.array([p.offset for p in planes], dtype=float),
+        colors=np.array([[p.color.r, p.color.g, p.color.b] for p in primitives], dtype=float).reshape(-1, 3),
+        shininess=np.array([p.shininess for p in primitives], dtype=float),
+        roughness=np.array([p.roughness for p in primitives], dtype=float),
+        transparency=np.array([p.transparency for p in primitives], dtype=float),
+        ior=np.array([p.ior for p in primitives], dtype=float),
+        source_order=np.array([source_order[id(p)] for p in primitives], dtype=np.intp),
+        light_points=np.array([l.point for l in objects.lights], dtype=float).reshape(-1, 3),
+        light_colors=np.array([[l.color.r, l.color.g, l.color.b] for l in objects.lights], dtype=float).reshape(-1, 3),
+        light_types=np.array([LIGHT_TYPES[type(l)] for l in objects.lights], dtype=np.int8),
+        light_radii=np.array([getattr(l, "radius", 0.0) for l in objects.lights], dtype=float),
+        light_edges=np.array([np.concatenate([l.edge1, l.edge2]) if isinstance(l, light.AreaLight) else np.zeros(6)
+                              for l in objects.lights], dtype=float).reshape(-1, 6),
+        light_samples=np.array([l.samples if isinstance(l, light.SoftLight) else 1 for l in objects.lights],
+                               dtype=np.intp),
+    )
+    _build_accel(compiled, accel)
+    return compiled
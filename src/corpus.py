@@ -0,0 +1,205 @@
+"""Renders many scene files in one run. Each scene is rendered whole by one worker of a process
+pool, so small scenes pay for starting Python and importing the renderer once per worker instead
+of once per scene. With a cache directory every worker loads scenes through `cache`, so the
+compiled scenes are shared by the workers and by later runs. `animation`, `antialias` and `cache`
+are only imported when a scene needs them.
+
+Images keep the file names given in their scene files, in `output_dir` when there is one, where
+a `summary.json` with the timings of every scene is written too.
+"""
+import concurrent.futures
+import dataclasses
+import glob
+import json
+import os
+from typing import TYPE_CHECKING, Optional, Tuple
+
+from PIL import Image
+from timeit import default_timer as timer
+
+import src.batch as batch
+import src.file_parse as file_parse
+import src.instrument as instrument
+import src.jit as jit
+import src.tiles as tiles
+import src.utils as utils
+
+if TYPE_CHECKING:
+    import src.antialias as antialias
+
+SUMMARY = "summary.json"
+
+@dataclasses.dataclass
+class Settings():
+    """How every scene of a run is rendered, see `utils.CmdLineArgs`
+    \b output_dir: directory to write the images to, None to write them where their scene files say
+    \b cache_dir: directory of compiled scene caches, None to always parse
+    """
+    output_dir: Optional[str] = None
+    accel: str = "auto"
+    cache_dir: Optional[str] = None
+    seed: int = 0
+    samples: Optional[int] = None
+    antialias_settings: Optional["antialias.Settings"] = None
+
+@dataclasses.dataclass
+class SceneResult():
+    """What rendering one scene file did
+    \b path: the scene file
+    \b outputs: the images written
+    \b parse_time, render_time: seconds spent loading the scene, and rendering and saving its images
+    \b error: why the scene could not be rendered, None if it was
+    """
+    path: str
+    outputs: "list[str]" = dataclasses.field(default_factory=list)
+    width: int = 0
+    height: int = 0
+    parse_time: float = 0.0
+    render_time: float = 0.0
+    error: Optional[str] = None
+
+    @property
+    def wall_time(self) -> float:
+        return self.parse_time + self.render_time
+
+    def as_dict(self) -> dict:
+        values = dataclasses.asdict(self)
+        values["wall_time"] = self.wall_time
+        return values
+
+def find_scenes(paths: "list[str]") -> "list[str]":
+    """Lists the scene files to render. Files are kept as given, and directories stand for the
+    `.txt` files directly inside them, sorted by name.
+    """
+    scenes = []
+    for path in paths:
+        if os.path.isdir(path):
+            scenes += sorted(glob.glob(os.path.join(path, "*.txt")))
+        else:
+            scenes.append(path)
+    return scenes
+
+def output_path(filename: str, output_dir: Optional[str]) -> str:
+    return filename if output_dir is None else os.path.join(output_dir, os.path.basename(filename))
+
+### RENDERING ###
+
+def render_scene(path: str, settings: Settings) -> SceneResult:
+    """Renders every image of one scene file on this process
+
+    Returns:
+        SceneResult: the timings, or the error if the scene could not be rendered
+    """
+    result = SceneResult(path)
+    start = timer()
+    try:
+        if settings.cache_dir is not None:
+            import src.cache as cache
+            image_info, meta, compiled = cache.load_scene(path, settings.cache_dir, settings.accel)
+        else:
+            with open(path, "r") as file:
+                image_info, meta, compiled = file_parse.stream_scene(file, settings.accel)
+        if settings.samples is not None:
+            meta.samples = settings.samples
+        parsed = timer()
+        result.parse_time = parsed - start
+        result.width, result.height = image_info.width, image_info.height
+        filenames = [output_path(name, settings.output_dir) for name in utils.make_filename_list(image_info)]
+        if image_info.is_single_file:
+            frame = tiles.render_frame(compiled, meta, workers=1, seed=settings.seed)
+            if settings.antialias_settings is not None:
+                import src.antialias as antialias
+                antialias.refine(frame, compiled, meta, settings.antialias_settings, settings.seed)
+            Image.fromarray(batch.encode(frame, meta), "RGBA").save(filenames[0])
+        else:
+            import src.animation as animation
+            with open(path, "r") as file:
+                sections = file_parse.frame_sections(file, image_info.number_of_images)
+            for index, (lines, filename) in enumerate(zip(sections, filenames)):
+                animation.render_frame(index, lines, filename, compiled, meta, settings.accel, settings.seed,
+                                       settings.antialias_settings)
+        result.outputs = filenames
+        result.render_time = timer() - parsed
+    except Exception as error:
+        result.error = repr(error)
+    return result
+
+### WORKER PROCESSES ###
+# The settings of the run, given to each worker once by `_init_worker`
+_worker_settings: Optional[Settings] = None
+
+def _init_worker(settings: Settings, instrumented: bool = False, jitted: bool = False) -> None:
+    global _worker_settings
+    if instrumented:
+        instrument.enable()
+        instrument.reset()
+    if jitted:
+        # one worker runs on each core already
+        jit.enable(threads=False)
+    _worker_settings = settings
+
+def _render_scene_in_worker(path: str) -> Tuple[SceneResult, Optional[dict]]:
+    result = render_scene(path, _worker_settings)
+    recorded = None
+    if instrument.enabled:
+        recorded = instrument.snapshot()
+        instrument.reset()
+    return result, recorded
+
+def render_all(paths: "list[str]", settings: Settings, workers: int = 1) -> "list[SceneResult]":
+    """Renders every scene file, printing a line for each as it finishes. A scene that fails is
+    reported and the others still render.
+
+    Args:
+        paths (list[str]): the scene files
+        workers (int): the number of processes to render scenes on, 0 for one per cpu
+
+    Returns:
+        list[SceneResult]: the result of each scene, in the order of `paths` and once for each scene
+    """
+    if settings.output_dir is not None:
+        os.makedirs(settings.output_dir, exist_ok=True)
+    if workers <= 0:
+        workers = tiles.default_workers()
+    results = {}
+    unique = list(dict.fromkeys(paths))
+    if workers <= 1 or len(unique) <= 1:
+        for path in unique:
+            results[path] = render_scene(path, settings)
+            print(format_result(results[path]))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=min(workers, len(unique)), initializer=_init_worker,
+            initargs=(settings, instrument.enabled, jit.enabled),
+        ) as pool:
+            futures = [pool.submit(_render_scene_in_worker, path) for path in unique]
+            for future in concurrent.futures.as_completed(futures):
+                result, recorded = future.result()
+                results[result.path] = result
+                print(format_result(result))
+                if recorded is not None:
+                    instrument.merge(recorded)
+    return [results[path] for path in unique]
+
+### SUMMARY ###
+
+def format_result(result: SceneResult) -> str:
+    name = os.path.basename(result.path)
+    if result.error is not None:
+        return f"{name:24s} FAILED {result.error}"
+    return (f"{name:24s} {result.width:4d}x{result.height:<4d} {result.parse_time:8.3f}s parse "
+            f"{result.render_time:8.3f}s render {result.wall_time:8.3f}s total")
+
+def summary(results: "list[SceneResult]", elapsed: float) -> str:
+    """The totals of a run that took `elapsed` seconds"""
+    failed = sum(result.error is not None for result in results)
+    text = (f"Rendered {len(results) - failed} of {len(results)} scenes in {elapsed:.3f}s, "
+            f"{sum(result.wall_time for result in results):.3f}s of scene time")
+    if failed:
+        text += f", {failed} failed"
+    return text
+
+def write_summary(path: str, results: "list[SceneResult]", elapsed: float, workers: int) -> None:
+    with open(path, "w") as file:
+        json.dump({"workers": workers, "elapsed": elapsed, "scenes": [result.as_dict() for result in results]},
+                  file, indent=2)
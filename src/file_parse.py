@@ -1,5 +1,7 @@
 
-import math
+import functools
+from typing import Callable, Iterator, TextIO, Tuple
+
 import numpy as np
 import src.light as light
 
@@ -8,6 +10,7 @@ import src.vertex as vertex
 import src.colors as colors
 import src.scene as scene
 import src.shapes as shapes
+import src.compiled as compiled
 
 def get_image_info(line: str) -> utils.ImageInfo:
     """parses the first line of the file to get the metadata
@@ -27,6 +30,7 @@ def get_image_info(line: str) -> utils.ImageInfo:
     )
     # Set the values for the case in which we are making multiple png files
     if line_as_list[0] == "pngs":
+        image_info.is_single_file = False
         image_info.number_of_images = int(line_as_list[-1])
 
     return image_info
@@ -36,73 +40,433 @@ def get_vertex_by_index(verts, index: str) -> vertex.Vertex:
         index = int(index)
     else:
         raise Exception("The index of a vertex must be a number", index)
+    # 0 is no vertex, and a negative index would wrap around past the first one
+    if index == 0 or abs(index) > len(verts):
+        raise IndexError("A triangle uses a vertex that does not exist", index)
     # if its a negative index just use that idex
     if index < 0:
         return verts[index]
     return verts[index - 1]
 
+### DRAW DATA UPDATES ###
+# These keywords only change the state in `SceneMata` that later objects pick up
+
+def _add_vertex(line: "list[str]", scene_meta: scene.SceneMata) -> None:
+    scene_meta.vertices.append(vertex.Vertex(float(line[1]), float(line[2]), float(line[3])))
+
+def _set_color(line: "list[str]", scene_meta: scene.SceneMata) -> None:
+    r = float(line[1])
+    g = float(line[2])
+    b = float(line[3])
+    scene_meta.color = colors.RGBLinear(r, g, b)
+
+def _set_exposure(line: "list[str]", scene_meta: scene.SceneMata) -> None:
+    # Set the exposure function for the scene
+    v = float(line[1])
+    scene_meta.exposure_function = functools.partial(scene.expose, v)
+
+def _set_fisheye(line: "list[str]", scene_meta: scene.SceneMata) -> None:
+    # Set lense type to fisheye
+    scene_meta.lense = scene.Lense.fisheye
+
+def _set_panorama(line: "list[str]", scene_meta: scene.SceneMata) -> None:
+    # Set lense type to panorama
+    scene_meta.lense = scene.Lense.panorama
+
+def _set_shininess(line: "list[str]", scene_meta: scene.SceneMata) -> None:
+    shiny_level = float(line[1])
+    scene_meta.shininess = shiny_level
+
+def _set_bounces(line: "list[str]", scene_meta: scene.SceneMata) -> None:
+    bounce_num = int(line[1])
+    scene_meta.reflection_depth = bounce_num
+
+def _set_roughness(line: "list[str]", scene_meta: scene.SceneMata) -> None:
+    roughness = float(line[1])
+    scene_meta.roughness = roughness
+
+def _set_transparency(line: "list[str]", scene_meta: scene.SceneMata) -> None:
+    transparency = float(line[1])
+    scene_meta.transparency = transparency
+
+def _set_ior(line: "list[str]", scene_meta: scene.SceneMata) -> None:
+    ior = float(line[1])
+    if ior <= 0:
+        raise ValueError("ior must be positive", ior)
+    scene_meta.ior = ior
+
+def _set_light_samples(line: "list[str]", scene_meta: scene.SceneMata) -> None:
+    samples = int(line[1])
+    if samples < 1:
+        raise ValueError("lightsamples must be at least 1", samples)
+    scene_meta.light_samples = samples
+
+def _set_samples(line: "list[str]", scene_meta: scene.SceneMata) -> None:
+    samples = int(line[1])
+    if samples < 1:
+        raise ValueError("samples must be at least 1", samples)
+    scene_meta.samples = samples
+
+META_KEYWORDS = {
+    "color": _set_color,
+    "expose": _set_exposure,
+    "fisheye": _set_fisheye,
+    "panorama": _set_panorama,
+    "shininess": _set_shininess,
+    "bounces": _set_bounces,
+    "roughness": _set_roughness,
+    "transparency": _set_transparency,
+    "ior": _set_ior,
+    "samples": _set_samples,
+    "lightsamples": _set_light_samples,
+    "xyz": _add_vertex,
+}
+
+### OBJECTS ###
+
+def _point(line: "list[str]") -> np.ndarray:
+    x = float(line[1])
+    y = float(line[2])
+    z = float(line[3])
+    return np.array([x, y, z])
+
+def _add_sphere(line: "list[str]", scene_objects: scene.SceneObjects, scene_meta: scene.SceneMata) -> None:
+    new_sphere = shapes.Sphere(
+        center=_point(line),
+        radius=float(line[4]),
+        color=scene_meta.color,
+        shininess=scene_meta.shininess,
+        transparency=scene_meta.transparency,
+        roughness=scene_meta.roughness,
+        ior=scene_meta.ior,
+    )
+    scene_objects.shapes.append(new_sphere)
+
+def _add_box(line: "list[str]", scene_objects: scene.SceneObjects, scene_meta: scene.SceneMata) -> None:
+    first = np.array([float(v) for v in line[1:4]])
+    second = np.array([float(v) for v in line[4:7]])
+    new_box = shapes.Box(
+        low=np.minimum(first, second),
+        high=np.maximum(first, second),
+        color=scene_meta.color,
+        shininess=scene_meta.shininess,
+        transparency=scene_meta.transparency,
+        roughness=scene_meta.roughness,
+        ior=scene_meta.ior,
+    )
+    scene_objects.shapes.append(new_box)
+
+def _add_plane(line: "list[str]", scene_objects: scene.SceneObjects, scene_meta: scene.SceneMata) -> None:
+    new_plane = shapes.Plane(
+        normal=_point(line),
+        offset=float(line[4]),
+        color=scene_meta.color,
+        shininess=scene_meta.shininess,
+        transparency=scene_meta.transparency,
+        roughness=scene_meta.roughness,
+        ior=scene_meta.ior,
+    )
+    scene_objects.shapes.append(new_plane)
+
+def _add_triangle(line: "list[str]", scene_objects: scene.SceneObjects, scene_meta: scene.SceneMata) -> None:
+    p0, p1, p2 = (get_vertex_by_index(scene_meta.vertices, index) for index in line[1:4])
+    new_triangle = shapes.Triangle(
+        p0=np.array([p0.x, p0.y, p0.z]),
+        p1=np.array([p1.x, p1.y, p1.z]),
+        p2=np.array([p2.x, p2.y, p2.z]),
+        color=scene_meta.color,
+        shininess=scene_meta.shininess,
+        transparency=scene_meta.transparency,
+        roughness=scene_meta.roughness,
+        ior=scene_meta.ior,
+    )
+    scene_objects.shapes.append(new_triangle)
+
+def _add_sun(line: "list[str]", scene_objects: scene.SceneObjects, scene_meta: scene.SceneMata) -> None:
+    new_sun = light.Sun(point=_point(line), color=scene_meta.color)
+    scene_objects.lights.append(new_sun)
+
+def _add_bulb(line: "list[str]", scene_objects: scene.SceneObjects, scene_meta: scene.SceneMata) -> None:
+    new_bulb = light.Bulb(point=_point(line), color=scene_meta.color)
+    scene_objects.lights.append(new_bulb)
+
+def _add_sphere_light(line: "list[str]", scene_objects: scene.SceneObjects, scene_meta: scene.SceneMata) -> None:
+    new_light = light.SphereLight(point=_point(line), color=scene_meta.color, samples=scene_meta.light_samples,
+                                  radius=float(line[4]))
+    scene_objects.lights.append(new_light)
+
+def _add_area_light(line: "list[str]", scene_objects: scene.SceneObjects, scene_meta: scene.SceneMata) -> None:
+    new_light = light.AreaLight(point=_point(line), color=scene_meta.color, samples=scene_meta.light_samples,
+                                edge1=np.array([float(v) for v in line[4:7]]),
+                                edge2=np.array([float(v) for v in line[7:10]]))
+    scene_objects.lights.append(new_light)
+
+OBJECT_KEYWORDS = {
+    "sphere": _add_sphere,
+    "trif": _add_triangle,
+    "box": _add_box,
+    "plane": _add_plane,
+    "sun": _add_sun,
+    "bulb": _add_bulb,
+    "spherelight": _add_sphere_light,
+    "arealight": _add_area_light,
+}
+
 def parse_line(line: "list[str]", scene_objects: scene.SceneObjects, scene_meta: scene.SceneMata) -> None:
     """
     parse keywords:
     \b color r g b:
+    \b sphere x y z r:
+    \b xyz x y z: a vertex for later triangles
+    \b trif i j k: a triangle through vertices i, j and k, counting from 1, or back from the last one when negative
+    \b box x0 y0 z0 x1 y1 z1: an axis-aligned box with opposite corners (x0, y0, z0) and (x1, y1, z1)
+    \b plane A B C D: the infinite plane of the points with Ax + By + Cz + D = 0
+    \b sun x y z:
+    \b bulb x y z:
+    \b spherelight x y z r: a bulb that is a ball of radius r, and casts soft shadows
+    \b arealight x y z ux uy uz vx vy vz: a parallelogram of light centered on (x, y, z) with sides u and v
+    \b expose v:
+    \b fisheye:
+    \b panorama:
+    \b shininess s:
+    \b bounces d:
+    \b roughness r:
+    \b transparency t: how much of the light that is not reflected goes through later objects
+    \b ior r: the index of refraction of later objects
+    \b samples n:
+    \b lightsamples n: the number of shadow rays of later soft lights
+    Unknown keywords are ignored.
     """
     keyword: str = line[0]
-    ### DRAW DATA UPDATES ###
-    if keyword == "color":
-        r = float(line[1])
-        g = float(line[2])
-        b = float(line[3])
-        scene_meta.color = colors.RGBLinear(r, g, b)
-    
-    elif keyword == "sphere":
-        x = float(line[1])
-        y = float(line[2])
-        z = float(line[3])
-        r = float(line[4])
-        center = np.array([x, y, z])
-        new_sphere = shapes.Sphere(
-            center=center,
-            radius=r,
-            color=scene_meta.color,
-            shininess=scene_meta.shininess,
-            transparency=scene_meta.transparency,
-            roughness=scene_meta.roughness,
-        )
-        scene_objects.shapes.append(new_sphere)
-    
-    elif keyword == "sun":
-        x = float(line[1])
-        y = float(line[2])
-        z = float(line[3])
-        center = np.array([x, y, z])
-        new_sun = light.Sun(point=center, color=scene_meta.color)
-        scene_objects.lights.append(new_sun)
-   
-    elif keyword == "bulb":
-        x = float(line[1])
-        y = float(line[2])
-        z = float(line[3])
-        center = np.array([x, y, z])
-        new_bulb = light.Bulb(point=center, color=scene_meta.color)
-        scene_objects.lights.append(new_bulb)
-
-    elif keyword == "expose":
-        # Set the exposure function for the scene
-        v = float(line[1])
-        scene_meta.exposure_function = lambda x: 1-(math.e**(-x*v))
-    
-    elif keyword == "fisheye":
-        # Set lense type to fisheye
-        scene_meta.lense = scene.Lense.fisheye
-
-    elif keyword == "shininess":
-        shiny_level = float(line[1])
-        scene_meta.shininess = shiny_level
-    
-    elif keyword == "bounces":
-        bounce_num = int(line[1])
-        scene_meta.reflection_depth = bounce_num
-    
-    elif keyword == "roughness":
-        roughness = float(line[1])
-        scene_meta.roughness = roughness
\ No newline at end of file
+    if keyword in META_KEYWORDS:
+        META_KEYWORDS[keyword](line, scene_meta)
+    elif keyword in OBJECT_KEYWORDS:
+        OBJECT_KEYWORDS[keyword](line, scene_objects, scene_meta)
+
+def parse_file(file: TextIO) -> Tuple[utils.ImageInfo, scene.SceneMata, scene.SceneObjects]:
+    """Parses a scene file into dataclasses, one line at a time
+
+    Args:
+        file (TextIO): the open scene file
+
+    Returns:
+        Tuple[utils.ImageInfo, scene.SceneMata, scene.SceneObjects]: the image info from the first
+        line, and the scene described by the rest
+    """
+    image_info, scene_meta = _read_header(file)
+    scene_objects = scene.SceneObjects()
+    for raw_line in file:
+        line = utils.line_to_list(raw_line)
+        # If the line is empty, do nothing
+        if line:
+            parse_line(line, scene_objects, scene_meta)
+    return image_info, scene_meta, scene_objects
+
+def _read_header(file: TextIO) -> Tuple[utils.ImageInfo, scene.SceneMata]:
+    first_line = file.readline()
+    if not first_line:
+        raise Exception("Not Enough Lines")
+    # Get the image info from the first line
+    image_info = get_image_info(first_line)
+    scene_meta = scene.SceneMata(
+        height=image_info.height,
+        width=image_info.width
+    )
+    return image_info, scene_meta
+
+### STREAMING ###
+# Lines of one kind of object are parsed together in batches of up to this many lines
+SPHERE_BATCH_SIZE = 1 << 16
+
+def _add_stream_light(light_type: int) -> Callable[["list[str]", compiled.SceneBuilder, scene.SceneMata], None]:
+    def add_light(line: "list[str]", builder: compiled.SceneBuilder, scene_meta: scene.SceneMata) -> None:
+        builder.add_light(light_type, _point(line), scene_meta)
+    return add_light
+
+def _add_stream_sphere_light(line: "list[str]", builder: compiled.SceneBuilder, scene_meta: scene.SceneMata) -> None:
+    builder.add_light(compiled.SPHERE_LIGHT, _point(line), scene_meta, radius=float(line[4]))
+
+def _add_stream_area_light(line: "list[str]", builder: compiled.SceneBuilder, scene_meta: scene.SceneMata) -> None:
+    builder.add_light(compiled.AREA_LIGHT, _point(line), scene_meta, edges=np.array([float(v) for v in line[4:10]]))
+
+STREAM_OBJECT_KEYWORDS = {
+    "sun": _add_stream_light(compiled.SUN),
+    "bulb": _add_stream_light(compiled.BULB),
+    "spherelight": _add_stream_sphere_light,
+    "arealight": _add_stream_area_light,
+}
+
+def _parse_rows(lines: "list[str]", keyword: str, width: int) -> np.ndarray:
+    """Parses lines of `keyword` followed by `width` numbers into an (N, width) array in one call
+
+    Raises:
+        IndexError: if a line has fewer than `width` numbers, like the `_add_sphere` family
+    """
+    # the total alone would let a short line and a long one shift every later row
+    fields = [len(line.split()) for line in lines]
+    if min(fields) < width + 1:
+        raise IndexError(f"A {keyword} line needs {width} values", lines[fields.index(min(fields))].strip())
+    numbers = np.fromstring(" ".join(lines).replace(keyword, " "), sep=" ")
+    if max(fields) > width + 1 or numbers.size != width * len(lines):
+        # a line with extra fields, parse one line at a time to keep only the first `width`
+        numbers = np.array([[float(v) for v in line.split()[1:width + 1]] for line in lines])
+    return numbers.reshape(-1, width)
+
+# Object keywords whose lines become one row each: the number of values after the keyword, and
+# the `compiled.SceneBuilder` method the rows go to
+BATCHED_KEYWORDS = {
+    "sphere": (4, compiled.SceneBuilder.add_spheres),
+    "box": (6, compiled.SceneBuilder.add_boxes),
+    "plane": (4, compiled.SceneBuilder.add_planes),
+}
+
+def _parse_triangles(lines: "list[str]", n_vertices: np.ndarray) -> np.ndarray:
+    """Parses `trif i j k` lines into an (N, 3) array of vertex numbers counting from 0. Negative
+    indices count back from `n_vertices`, the number of vertices there were when each line was read.
+
+    Raises:
+        IndexError: if a line uses vertex 0 or a vertex that was not read before it, like `get_vertex_by_index`
+    """
+    indices = _parse_rows(lines, "trif", 3).astype(np.intp)
+    n_vertices = n_vertices[:, np.newaxis]
+    # checked against each line's own count, a vertex read later in the same batch does not count
+    missing = (indices == 0) | (np.abs(indices) > n_vertices)
+    if missing.any():
+        raise IndexError("A triangle uses a vertex that does not exist", int(indices[missing][0]))
+    return np.where(indices > 0, indices - 1, indices + n_vertices)
+
+def _stream_into(lines: Iterator[str], builder: compiled.SceneBuilder, scene_meta: scene.SceneMata) -> None:
+    """Adds the objects described by `lines` to `builder`, stopping at the first `frame` line"""
+    # object lines waiting to be parsed, the index into `materials` of the state each was read under,
+    # and the position of each among the primitives of the scene
+    pending: "dict[str, Tuple[list[str], list[int], list[int]]]" = {
+        keyword: ([], [], []) for keyword in BATCHED_KEYWORDS
+    }
+    triangle_lines: "list[str]" = []
+    triangle_material_ids: "list[int]" = []
+    triangle_orders: "list[int]" = []
+    # the number of vertices there were when each waiting triangle line was read
+    triangle_vertex_counts: "list[int]" = []
+    vertex_lines: "list[str]" = []
+    materials: "list[list[float]]" = []
+    material_changed = True
+    n_primitives = 0
+
+    def flush() -> None:
+        for keyword, (object_lines, material_ids, orders) in pending.items():
+            if object_lines:
+                width, add = BATCHED_KEYWORDS[keyword]
+                add(builder, _parse_rows(object_lines, keyword, width), np.array(materials)[material_ids],
+                    np.array(orders))
+                object_lines.clear()
+                material_ids.clear()
+                orders.clear()
+        if vertex_lines:
+            builder.add_vertices(_parse_rows(vertex_lines, "xyz", 3))
+            vertex_lines.clear()
+        if triangle_lines:
+            builder.add_triangles(_parse_triangles(triangle_lines, np.array(triangle_vertex_counts)),
+                                  np.array(materials)[triangle_material_ids], np.array(triangle_orders))
+            triangle_lines.clear()
+            triangle_material_ids.clear()
+            triangle_orders.clear()
+            triangle_vertex_counts.clear()
+
+    def material_id() -> int:
+        nonlocal material_changed
+        if material_changed:
+            materials.append(builder.material(scene_meta))
+            material_changed = False
+        return len(materials) - 1
+
+    for raw_line in lines:
+        # only the keyword is split off, object lines are split when their batch is parsed
+        line = raw_line.split(None, 1)
+        if not line:
+            continue
+        keyword = line[0]
+        if keyword in BATCHED_KEYWORDS:
+            object_lines, material_ids, orders = pending[keyword]
+            object_lines.append(raw_line)
+            material_ids.append(material_id())
+            orders.append(n_primitives)
+            n_primitives += 1
+            if len(object_lines) >= SPHERE_BATCH_SIZE:
+                flush()
+        elif keyword == "xyz":
+            vertex_lines.append(raw_line)
+            if len(vertex_lines) >= SPHERE_BATCH_SIZE:
+                flush()
+        elif keyword == "trif":
+            triangle_lines.append(raw_line)
+            triangle_material_ids.append(material_id())
+            triangle_orders.append(n_primitives)
+            n_primitives += 1
+            triangle_vertex_counts.append(builder.n_vertices + len(vertex_lines))
+            if len(triangle_lines) >= SPHERE_BATCH_SIZE:
+                flush()
+        elif keyword in META_KEYWORDS:
+            META_KEYWORDS[keyword](raw_line.split(), scene_meta)
+            material_changed = True
+        elif keyword in STREAM_OBJECT_KEYWORDS:
+            STREAM_OBJECT_KEYWORDS[keyword](raw_line.split(), builder, scene_meta)
+        elif keyword == "frame":
+            break
+    flush()
+
+def stream_scene(file: TextIO, accel: str = "auto") -> Tuple[utils.ImageInfo, scene.SceneMata, compiled.CompiledScene]:
+    """Parses a scene file straight into a `compiled.CompiledScene`. The file is read one line at a time
+    and no dataclass is made per object: object and vertex lines are parsed in batches into growing arrays, each
+    tagged with the `color`, `shininess`, `roughness` and `transparency` in effect when it was read.
+    Reading stops at the first `frame` line, see `frame_sections` for the rest of an animation.
+
+    Args:
+        file (TextIO): the open scene file
+        accel (str): "bvh", "none", or "auto", see `compiled.compile_scene`
+
+    Returns:
+        Tuple[utils.ImageInfo, scene.SceneMata, compiled.CompiledScene]: the image info from the first
+        line, and the scene described by the rest
+    """
+    image_info, scene_meta = _read_header(file)
+    builder = compiled.SceneBuilder()
+    _stream_into(file, builder, scene_meta)
+    return image_info, scene_meta, builder.build(accel)
+
+def stream_frame(lines: "list[str]", scene_meta: scene.SceneMata, shared_vertices: int = 0) -> compiled.CompiledScene:
+    """Parses the lines of one frame section into a scene without an acceleration structure.
+    `scene_meta` is updated by the section's state keywords. Triangles can use the `shared_vertices`
+    vertices of the scene the frame is appended to, see `compiled.append_scene`.
+    """
+    builder = compiled.SceneBuilder(shared_vertices)
+    _stream_into(iter(lines), builder, scene_meta)
+    return builder.build("none")
+
+### ANIMATION ###
+
+def frame_sections(file: TextIO, number_of_images: int) -> "list[list[str]]":
+    """Collects the lines of each frame of an animation. A `frame n` line starts the section of
+    frame n (counting from 0), and every line up to the next `frame` line belongs to it. The lines
+    before the first `frame` line are shared by every frame and are not returned.
+
+    Args:
+        file (TextIO): the open scene file, read from the start
+        number_of_images (int): the number of frames given in the `pngs` line
+
+    Returns:
+        list[list[str]]: the raw lines of each frame's section, indexed by frame number
+    """
+    sections: "list[list[str]]" = [[] for _ in range(number_of_images)]
+    current = None
+    for raw_line in file:
+        line = raw_line.split()
+        if not line:
+            continue
+        if line[0] == "frame":
+            index = int(line[1])
+            if not 0 <= index < number_of_images:
+                raise Exception("Frame number out of range", index)
+            current = sections[index]
+        elif current is not None:
+            current.append(raw_line)
+    return sections
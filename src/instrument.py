@@ -0,0 +1,144 @@
+"""Optional counters and stage timers for the renderers. Nothing is recorded until `enable` is called.
+
+The per-pixel renderer is measured by wrapping its hot functions (`raytracer.trace_ray`,
+`Sphere.intersection`, `shapes.any_occluder`, the `lambert` methods, ...) when instrumentation is
+enabled, so while it is disabled those functions are the original ones and cost nothing extra.
+The array renderers call `count` and `stage` directly, once per batch of rays, which is a single
+flag check while disabled.
+
+Stage times are inclusive. In the per-pixel renderer "trace" contains "intersect", "shadow" and
+"lambert", and in the array renderers "trace" contains "intersect" and "shade", which contains
+"shadow". A stage that calls itself, like the reflection recursion of "trace", is only timed for
+the outermost call.
+"""
+import collections
+import contextlib
+import functools
+import json
+from typing import Callable, Dict, Optional
+
+from timeit import default_timer as timer
+
+enabled = False
+counters: "collections.Counter[str]" = collections.Counter()
+times: Dict[str, float] = collections.defaultdict(float)
+# How many calls of each stage are running, so recursive calls are timed once
+_running: "collections.Counter[str]" = collections.Counter()
+
+def count(name: str, amount: int = 1) -> None:
+    if enabled:
+        counters[name] += int(amount)
+
+class _Stage():
+    def __init__(self, name: str):
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self):
+        _running[self.name] += 1
+        if _running[self.name] == 1:
+            self.start = timer()
+
+    def __exit__(self, *exception):
+        _running[self.name] -= 1
+        if _running[self.name] == 0:
+            times[self.name] += timer() - self.start
+
+_NO_STAGE = contextlib.nullcontext()
+
+def stage(name: str):
+    """A context manager that adds the time spent inside it to the stage `name`"""
+    return _Stage(name) if enabled else _NO_STAGE
+
+### WRAPPERS FOR THE PER-PIXEL RENDERER ###
+
+def _timed(name: str) -> Callable[[Callable], Callable]:
+    def wrap(function: Callable) -> Callable:
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            with _Stage(name):
+                return function(*args, **kwargs)
+        return timed
+    return wrap
+
+def _counted(name: str, hit_name: Optional[str] = None) -> Callable[[Callable], Callable]:
+    """Counts the calls of a function as `name`, and the calls that return something truthy as `hit_name`"""
+    def wrap(function: Callable) -> Callable:
+        @functools.wraps(function)
+        def counted(*args, **kwargs):
+            result = function(*args, **kwargs)
+            counters[name] += 1
+            if hit_name is not None and result:
+                counters[hit_name] += 1
+            return result
+        return counted
+    return wrap
+
+def _patches() -> "list[tuple]":
+    """(owner, attribute, wrapper) for every function wrapped by `enable`. The renderer modules are
+    imported here because they import this module themselves.
+    """
+    import src.light as light
+    import src.raytracer as raytracer
+    import src.shapes as shapes
+    return [
+        (raytracer, "make_eye_ray", _counted("pixels", "primary rays")),
+        (raytracer, "trace_ray", _timed("trace")),
+        (raytracer, "closest_intersection", _timed("intersect")),
+        (raytracer, "make_reflection_ray", _counted("reflection rays")),
+        (raytracer, "make_refraction_ray", _counted("refraction rays")),
+        (shapes, "any_occluder", lambda function: _counted("shadow rays", "shadow rays blocked")(_timed("shadow")(function))),
+        (shapes.Sphere, "intersection", _counted("intersection tests", "intersection hits")),
+        (shapes.Triangle, "intersection", _counted("intersection tests", "intersection hits")),
+        (shapes.Plane, "intersection", _counted("intersection tests", "intersection hits")),
+        (shapes.Box, "intersection", _counted("intersection tests", "intersection hits")),
+        (light.Sun, "lambert", _timed("lambert")),
+        (light.Bulb, "lambert", _timed("lambert")),
+    ]
+
+_originals: "list[tuple]" = []
+
+def enable() -> None:
+    """Starts recording, wrapping the hot functions of the per-pixel renderer"""
+    global enabled
+    if enabled:
+        return
+    for owner, attribute, wrap in _patches():
+        original = vars(owner)[attribute]
+        _originals.append((owner, attribute, original))
+        setattr(owner, attribute, wrap(original))
+    enabled = True
+
+def disable() -> None:
+    """Stops recording and puts the original functions back. What was recorded is kept."""
+    global enabled
+    while _originals:
+        owner, attribute, original = _originals.pop()
+        setattr(owner, attribute, original)
+    enabled = False
+
+def reset() -> None:
+    counters.clear()
+    times.clear()
+
+### RESULTS ###
+
+def snapshot() -> dict:
+    return {"counters": dict(counters), "times": dict(times)}
+
+def merge(recorded: dict) -> None:
+    """Adds a `snapshot`, for example one taken in a worker process"""
+    counters.update(recorded["counters"])
+    for name, seconds in recorded["times"].items():
+        times[name] += seconds
+
+def report() -> str:
+    lines = ["Ray counts:"]
+    lines += [f"  {name}: {value}" for name, value in sorted(counters.items())]
+    lines.append("Stage times (inclusive):")
+    lines += [f"  {name}: {seconds:.4f}s" for name, seconds in sorted(times.items(), key=lambda item: -item[1])]
+    return "\n".join(lines)
+
+def write_json(path: str) -> None:
+    with open(path, "w") as file:
+        json.dump(snapshot(), file, indent=2)
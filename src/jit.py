@@ -0,0 +1,82 @@
+"""Optional compiled kernels for the array renderers, built with Numba when it is installed.
+Nothing changes until `enable` is called. From then on `batch` sends the linear sphere scans
+(`shapes.sphere_distances` over every ray and sphere), the light loop of scenes made only of
+spheres without a BVH, and the reflection of rays to the loops of `kernels`. They work on the flat arrays
+of `compiled.CompiledScene` one ray at a time, so the (rays, spheres) and (points, lights)
+temporaries of the NumPy path are never made. In the main process they run on every core with
+`numba.prange`, while the workers of `tiles` and `animation`, which already use one process per
+core, run them as plain loops.
+
+The kernels repeat the arithmetic of the NumPy path step by step. Only the order in which `np.einsum`
+adds up the terms of a dot product can differ, which moves a distance by a rounding error at most,
+so they give the same image. While they are in use `instrument` still counts rays, but not the ray/sphere tests, since
+shadow rays stop at the first sphere in the way.
+
+Numba is only imported, along with `kernels`, by the first call of `enable`, so renders without
+the kernels never pay for it.
+"""
+import importlib.util
+from typing import Tuple
+
+import numpy as np
+
+# Whether Numba is installed
+AVAILABLE = importlib.util.find_spec("numba") is not None
+enabled = False
+# Whether the kernels spread their loops over threads
+threaded = True
+# `kernels` once it has been imported
+_kernels = None
+
+def enable(threads: bool = True) -> bool:
+    """Switches the array renderers to the compiled kernels if Numba is installed
+
+    Args:
+        threads (bool): whether to use threads, which a process forked from one that already has must not
+
+    Returns:
+        bool: whether the kernels are in use
+    """
+    global enabled, threaded, _kernels
+    if AVAILABLE and _kernels is None:
+        import src.kernels as kernels
+        _kernels = kernels
+    enabled = AVAILABLE
+    threaded = threads
+    return enabled
+
+def disable() -> None:
+    global enabled
+    enabled = False
+
+### ENTRY POINTS ###
+# Arrays are passed on as plain ndarrays, since Numba does not take `np.memmap` views of a `cache` file
+
+def closest_spheres(origins: np.ndarray, directions: np.ndarray, centers: np.ndarray, radii: np.ndarray,
+                    fudge = 10e-5) -> Tuple[np.ndarray, np.ndarray]:
+    """See `batch.closest_hits`"""
+    return _kernels.closest_spheres(np.asarray(origins), np.asarray(directions), np.asarray(centers),
+                                    np.asarray(radii), fudge)
+
+def occluded_spheres(origins: np.ndarray, directions: np.ndarray, max_distances: np.ndarray,
+                     centers: np.ndarray, radii: np.ndarray, fudge = 10e-5) -> np.ndarray:
+    """See `batch.occluded`. Each ray stops at the first sphere in the way."""
+    return _kernels.occluded_spheres(np.asarray(origins), np.asarray(directions), np.asarray(max_distances),
+                                     np.asarray(centers), np.asarray(radii), fudge)
+
+def shade_spheres(points: np.ndarray, normals: np.ndarray, surface_colors: np.ndarray, light_points: np.ndarray,
+                  light_colors: np.ndarray, is_sun: np.ndarray, centers: np.ndarray, radii: np.ndarray,
+                  fudge = 10e-5) -> Tuple[np.ndarray, int]:
+    """See `batch.shade`, for scenes whose only primitives are the spheres given
+
+    Returns:
+        Tuple[np.ndarray, int]: (N, 3) linear color from direct lighting, and the number of shadow rays that were blocked
+    """
+    colors, blocked = _kernels.shade_spheres(np.asarray(points), np.asarray(normals), np.asarray(surface_colors),
+                                             np.asarray(light_points), np.asarray(light_colors), np.asarray(is_sun),
+                                             np.asarray(centers), np.asarray(radii), fudge)
+    return colors, int(blocked)
+
+def reflect(incident: np.ndarray, normals: np.ndarray) -> np.ndarray:
+    """See `batch.reflect`"""
+    return _kernels.reflect(np.asarray(incident), np.asarray(normals))
@@ -0,0 +1,125 @@
+"""The Numba kernels behind `jit`. This module imports Numba, which takes longer than the rest of
+the renderer, so `jit.enable` imports it the first time the kernels are wanted.
+"""
+import math
+import os
+import types
+
+import numba
+import numpy as np
+
+import src.jit as jit
+
+if "NUMBA_THREADING_LAYER" not in os.environ:
+    # The worker pools fork the main process. With TBB the main process then hangs when it exits.
+    numba.config.THREADING_LAYER = "workqueue"
+
+def _kernel(function):
+    """Compiles `function` once with its `numba.prange` loops spread over threads and once as plain
+    loops, and calls the one `jit.threaded` asks for
+    """
+    spread = numba.njit(parallel=True, cache=True)(function)
+    # Numba names cache files after the function, so the plain build is made from a renamed copy
+    copy = types.FunctionType(function.__code__, function.__globals__, function.__name__ + "_plain",
+                              function.__defaults__, function.__closure__)
+    copy.__qualname__ = function.__qualname__ + "_plain"
+    plain = numba.njit(cache=True)(copy)
+    def call(*args):
+        return (spread if jit.threaded else plain)(*args)
+    return call
+
+@numba.njit(cache=True)
+def _sphere_distance(origin: np.ndarray, direction: np.ndarray, center: np.ndarray, radius: float,
+                     fudge: float) -> float:
+    """`shapes.sphere_distances` for one ray and one sphere"""
+    length_of_direction = math.sqrt(direction[0]*direction[0] + direction[1]*direction[1] + direction[2]*direction[2])
+    r_sqr = radius**2
+    to_center_x = center[0] - origin[0]
+    to_center_y = center[1] - origin[1]
+    to_center_z = center[2] - origin[2]
+    is_inside = (to_center_x*to_center_x + to_center_y*to_center_y + to_center_z*to_center_z) < r_sqr
+    t_c = (to_center_x*direction[0] + to_center_y*direction[1] + to_center_z*direction[2])/length_of_direction
+    offset_x = origin[0] + t_c * direction[0] - center[0]
+    offset_y = origin[1] + t_c * direction[1] - center[1]
+    offset_z = origin[2] + t_c * direction[2] - center[2]
+    d_sqr = offset_x*offset_x + offset_y*offset_y + offset_z*offset_z
+    if not is_inside and (t_c < 0 or d_sqr > r_sqr):
+        return np.inf
+    t_offset = math.sqrt(max(r_sqr - d_sqr, 0.0))/length_of_direction
+    distance = t_c + t_offset if is_inside else t_c - t_offset
+    if distance <= fudge:
+        return np.inf
+    return distance
+
+@_kernel
+def closest_spheres(origins, directions, centers, radii, fudge):
+    n_rays = len(origins)
+    indices = np.full(n_rays, -1, dtype=np.intp)
+    distances = np.full(n_rays, np.inf)
+    for ray in numba.prange(n_rays):
+        for sphere in range(len(radii)):
+            t = _sphere_distance(origins[ray], directions[ray], centers[sphere], radii[sphere], fudge)
+            # strictly closer, so ties go to the lower index like in `batch.closest_hits`
+            if t < distances[ray]:
+                distances[ray] = t
+                indices[ray] = sphere
+    return indices, distances
+
+@numba.njit(cache=True)
+def _blocked(origin, direction, max_distance, centers, radii, fudge):
+    for sphere in range(len(radii)):
+        if _sphere_distance(origin, direction, centers[sphere], radii[sphere], fudge) < max_distance:
+            return True
+    return False
+
+@_kernel
+def occluded_spheres(origins, directions, max_distances, centers, radii, fudge):
+    blocked = np.zeros(len(origins), dtype=np.bool_)
+    for ray in numba.prange(len(origins)):
+        blocked[ray] = _blocked(origins[ray], directions[ray], max_distances[ray], centers, radii, fudge)
+    return blocked
+
+@_kernel
+def shade_spheres(points, normals, surface_colors, light_points, light_colors, is_sun, centers, radii, fudge):
+    n_points = len(points)
+    colors = np.zeros((n_points, 3))
+    blocked_count = np.zeros(n_points, dtype=np.intp)
+    for point in numba.prange(n_points):
+        to_light = np.empty(3)
+        for light in range(len(light_points)):
+            for axis in range(3):
+                to_light[axis] = light_points[light, axis] - points[point, axis]
+            distance_to_light = math.sqrt(to_light[0]*to_light[0] + to_light[1]*to_light[1] + to_light[2]*to_light[2])
+            shadow_distance = distance_to_light
+            # suns are infinitely far away in the direction of their position
+            if is_sun[light]:
+                to_light[:] = light_points[light]
+                shadow_distance = np.inf
+            length = math.sqrt(to_light[0]*to_light[0] + to_light[1]*to_light[1] + to_light[2]*to_light[2])
+            for axis in range(3):
+                to_light[axis] = to_light[axis] / length
+            if _blocked(points[point], to_light, shadow_distance, centers, radii, fudge):
+                blocked_count[point] += 1
+                weight = 0.0
+            else:
+                lambert = max(to_light[0]*normals[point, 0] + to_light[1]*normals[point, 1]
+                              + to_light[2]*normals[point, 2], 0.0)
+                # bulbs fall off with the square of the distance
+                falloff = 1.0 if is_sun[light] else 1/(distance_to_light**2)
+                weight = lambert * falloff
+            for axis in range(3):
+                colors[point, axis] += surface_colors[point, axis] * light_colors[light, axis] * weight
+    return colors, blocked_count.sum()
+
+@_kernel
+def reflect(incident, normals):
+    reflected = np.empty_like(incident)
+    for ray in numba.prange(len(incident)):
+        along_normal = incident[ray, 0]*normals[ray, 0] + incident[ray, 1]*normals[ray, 1] + incident[ray, 2]*normals[ray, 2]
+        for axis in range(3):
+            reflected[ray, axis] = (-2 * along_normal * normals[ray, axis]) + incident[ray, axis]
+        length = math.sqrt(reflected[ray, 0]*reflected[ray, 0] + reflected[ray, 1]*reflected[ray, 1]
+                           + reflected[ray, 2]*reflected[ray, 2])
+        for axis in range(3):
+            reflected[ray, axis] = reflected[ray, axis] / length
+    return reflected
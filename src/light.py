@@ -1,9 +1,11 @@
 import abc
 import dataclasses
+from typing import Optional
 
 import numpy as np
 
 import src.colors as colors
+import src.sampling as sampling
 import src.shapes as shapes
 import src.utils as utils
 
@@ -35,4 +37,94 @@ class Bulb(Light):
         new_color_as_vector: np.ndarray = shape_color_as_vector * light_color_as_vector * max(np.dot(ray.direction, normal), 0)
         distance_to_bulb = np.linalg.norm(self.point - ray.origin)
         new_color_as_vector *= 1/(distance_to_bulb**2)
-        return colors.RGBLinear(*(new_color_as_vector.tolist()))
\ No newline at end of file
+        return colors.RGBLinear(*(new_color_as_vector.tolist()))
+
+@dataclasses.dataclass
+class SoftLight(Bulb):
+    """A bulb with a size, which casts soft shadows. It lights a point like a bulb at `point`
+    would, dimmed by the share of `samples` shadow rays, aimed at points spread over the light,
+    that reach it.
+    """
+    samples: int = 16
+
+    @abc.abstractmethod
+    def targets(self, points: np.ndarray, uv: np.ndarray) -> np.ndarray:
+        """(N, S, 3) points on the light for shadow rays from (N, 3) `points`, given (N, S, 2) `uv` in the unit square"""
+        raise NotImplementedError
+
+    def visibility(self, point: np.ndarray, shapes_in_scene: "list[shapes.Shape]",
+                   rng: Optional[np.random.Generator] = None, fudge = 10e-5) -> float:
+        """The share of the light seen from `point`. A point is taken to be fully lit or fully in
+        shadow without more shadow rays when the `sampling.PROBES` first ones agree.
+
+        Args:
+            point (np.ndarray): the point being lit
+            shapes_in_scene (list[shapes.Shape]): everything that can cast a shadow
+            rng (np.random.Generator): where the samples come from, the global random state when None
+
+        Returns:
+            float: from 0 in full shadow to 1 when all of the light is seen
+        """
+        def reached(uv: np.ndarray) -> int:
+            seen = 0
+            for target in self.targets(point[np.newaxis], uv)[0]:
+                distance = np.linalg.norm(target - point)
+                if not shapes.any_occluder(shapes_in_scene, shapes.Ray(point, target - point), distance, fudge):
+                    seen += 1
+            return seen
+
+        seen, rest = 0, self.samples
+        if self.samples > sampling.PROBES:
+            seen = reached(sampling.quadrant_samples(rng, 1))
+            if seen in (0, sampling.PROBES):
+                return seen / sampling.PROBES
+            rest -= sampling.PROBES
+        return (seen + reached(sampling.stratified_samples(rng, 1, rest))) / self.samples
+
+@dataclasses.dataclass
+class SphereLight(SoftLight):
+    """A ball of light with center `point`. Shadow rays go to the disk through the center of the
+    ball that faces the point being lit.
+    """
+    radius: float = 0.0
+
+    def targets(self, points: np.ndarray, uv: np.ndarray) -> np.ndarray:
+        return disk_targets(points, self.point, self.radius, uv)
+
+@dataclasses.dataclass
+class AreaLight(SoftLight):
+    """A parallelogram of light centered on `point`, with sides `edge1` and `edge2`"""
+    edge1: np.ndarray = dataclasses.field(default_factory=lambda: np.zeros(3))
+    edge2: np.ndarray = dataclasses.field(default_factory=lambda: np.zeros(3))
+
+    def targets(self, points: np.ndarray, uv: np.ndarray) -> np.ndarray:
+        return parallelogram_targets(self.point, self.edge1, self.edge2, uv)
+
+### SAMPLE POINTS ###
+# Shared by `SoftLight.visibility` and the array renderers
+
+def disk_targets(points: np.ndarray, center: np.ndarray, radius: float, uv: np.ndarray) -> np.ndarray:
+    """Spreads (N, S, 2) `uv` evenly over the disk of a sphere light facing each of (N, 3) `points`
+
+    Returns:
+        np.ndarray: (N, S, 3) points on the disks
+    """
+    towards = center - points
+    towards = towards / np.linalg.norm(towards, axis=-1, keepdims=True)
+    # any direction not along `towards` gives the plane of the disk
+    helper = np.where(np.abs(towards[:, :1]) < 0.9, [[1.0, 0, 0]], [[0, 1.0, 0]])
+    first = np.cross(towards, helper)
+    first = first / np.linalg.norm(first, axis=-1, keepdims=True)
+    second = np.cross(towards, first)
+    distance = radius * np.sqrt(uv[..., 0])
+    angle = 2 * np.pi * uv[..., 1]
+    return (center + (distance * np.cos(angle))[..., np.newaxis] * first[:, np.newaxis, :]
+            + (distance * np.sin(angle))[..., np.newaxis] * second[:, np.newaxis, :])
+
+def parallelogram_targets(center: np.ndarray, edge1: np.ndarray, edge2: np.ndarray, uv: np.ndarray) -> np.ndarray:
+    """Spreads (N, S, 2) `uv` evenly over an area light
+
+    Returns:
+        np.ndarray: (N, S, 3) points on the light
+    """
+    return center + (uv[..., :1] - 0.5) * edge1 + (uv[..., 1:] - 0.5) * edge2
@@ -0,0 +1,66 @@
+"""Blending and refraction shared by the recursive renderer in `raytracer` and the array renderer in
+`batch`. The functions take arrays and broadcast, so one surface and a whole wavefront of hits use the
+same formulas.
+"""
+from typing import Tuple
+
+import numpy as np
+
+def lerp(p1: np.ndarray, p2: np.ndarray, t: float) -> np.ndarray:
+    """performs linear interpolation between two np.ndarrays
+    Args:
+        p1 (np.ndarray): point containing some collection of values
+        p2 (np.ndarray): point containing some collection of values
+        t (float): goes from 0.0 to 1.0
+    Returns:
+        np.ndarray: [description]
+    """
+    return p1 + ((p2 - p1) * t)
+
+def refract(incident: np.ndarray, normals: np.ndarray, ior, thin) -> Tuple[np.ndarray, np.ndarray]:
+    """Bends normalized rays through the surfaces they hit. A ray enters the surface where it meets the
+    outside of the normal and leaves it otherwise. Two sided shapes are thin sheets, so rays go
+    straight through them. The arguments broadcast against each other like those of `shapes.sphere_distances`.
+
+    Args:
+        incident (np.ndarray): normalized ray directions
+        normals (np.ndarray): normalized normals where the rays hit
+        ior: index of refraction of each surface
+        thin: true for the surfaces of two sided shapes
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: the direction of each refracted ray, not normalized, and Schlick's
+        approximation of the Fresnel reflectance of each surface, 1 for total internal reflection
+    """
+    thin = np.asarray(thin, dtype=bool)
+    cos_in = -np.einsum("...i,...i->...", incident, normals)
+    leaving = (cos_in < 0) & ~thin
+    eta = np.where(leaving, ior, 1/ior)
+    facing = np.where(leaving[..., np.newaxis], -normals, normals)
+    cos_in = np.abs(cos_in)
+    k = 1 - eta**2 * (1 - cos_in**2)
+    total = (k < 0) & ~thin
+    cos_out = np.sqrt(np.maximum(k, 0))
+    bent = eta[..., np.newaxis] * incident + (eta*cos_in - cos_out)[..., np.newaxis] * facing
+    directions = np.where(thin[..., np.newaxis], incident, bent)
+    # the angle on the outside of the surface decides how much is reflected
+    r_0 = ((ior - 1)/(ior + 1))**2
+    cos_outside = np.where(leaving, cos_out, cos_in)
+    reflectance = np.where(total, 1.0, r_0 + (1 - r_0)*(1 - cos_outside)**5)
+    return directions, reflectance
+
+def fresnel_weights(shininess, transparency, reflectance) -> Tuple[np.ndarray, np.ndarray]:
+    """How a transparent surface mixes its own color with what is seen through it and what it
+    reflects. The color seen through it is blended in first, then the reflection:
+    `lerp(lerp(color, refracted, transmission), reflected, shininess)`. Of the light that gets
+    past the shininess, `transparency` goes through the surface, less what the Fresnel
+    `reflectance` turns into reflection.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: the shininess and the transmission to blend with
+    """
+    reflected = transparency * reflectance
+    mirror = shininess + (1 - shininess) * reflected
+    # without the clamp a fully transparent surface reflecting everything would divide 0 by 0
+    transmission = (transparency - reflected) / np.maximum(1 - reflected, 1e-12)
+    return mirror, transmission
@@ -0,0 +1,161 @@
+"""Progressive rendering. The image is rendered in interleaved passes: the first pass shoots one
+ray per `first_step` x `first_step` block of pixels, and every later pass halves the step and fills
+in the pixels the earlier passes skipped. After any number of chunks there is a full size preview,
+with each pixel not rendered yet copied from the nearest rendered pixel above and to its left.
+"""
+import dataclasses
+import os
+from typing import Callable, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+from timeit import default_timer as timer
+
+import src.batch as batch
+import src.compiled as compiled_scene
+import src.instrument as instrument
+import src.sampling as sampling
+import src.scene as scene
+
+# Step of the first pass, one ray per FIRST_STEP x FIRST_STEP block
+FIRST_STEP = 16
+# Pixels rendered between checks of the time budget and the preview interval
+CHUNK_PIXELS = 4096
+
+@dataclasses.dataclass
+class Pass():
+    """The pixels first rendered at one step
+    \b step: pixels on the grid of this step are done once the pass is
+    \b xs, ys: the column and row of each pixel of the pass, in the order they are rendered
+    """
+    step: int
+    xs: np.ndarray
+    ys: np.ndarray
+
+def make_passes(width: int, height: int, first_step: int = FIRST_STEP) -> "list[Pass]":
+    """Splits the pixels of the image into passes from coarse to fine. Each pass holds the pixels
+    on the grid of its step that are not on the grid of the pass before it. The pixels of a pass
+    are shuffled, so a pass stopped early has refined the whole image evenly.
+    """
+    steps = []
+    step = max(1, first_step)
+    while step > 1:
+        steps.append(step)
+        step //= 2
+    steps.append(1)
+    xs, ys = np.meshgrid(np.arange(width), np.arange(height), indexing="ij")
+    xs, ys = xs.ravel(), ys.ravel()
+    # always the same shuffle, so partial renders are repeatable
+    rng = np.random.default_rng(0)
+    passes = []
+    previous = None
+    for step in steps:
+        on_grid = (xs % step == 0) & (ys % step == 0)
+        new = on_grid if previous is None else on_grid & ~((xs % previous == 0) & (ys % previous == 0))
+        order = rng.permutation(np.flatnonzero(new))
+        passes.append(Pass(step, xs[order], ys[order]))
+        previous = step
+    return passes
+
+def fill_preview(frame: np.ndarray, done: np.ndarray, steps: "list[int]") -> np.ndarray:
+    """Fills the pixels that are not done from the closest grid pixel that is
+
+    Args:
+        frame (np.ndarray): (height, width, 4) pixels, only meaningful where `done`
+        done (np.ndarray): (height, width) mask of the rendered pixels
+        steps (list[int]): the steps of the passes from coarse to fine
+
+    Returns:
+        np.ndarray: (height, width, 4) the preview, transparent where no grid pixel above and to the left is done
+    """
+    height, width = done.shape
+    ys, xs = np.meshgrid(np.arange(height), np.arange(width), indexing="ij")
+    preview = np.zeros_like(frame)
+    for step in steps:
+        source_y, source_x = ys - ys % step, xs - xs % step
+        usable = done[source_y, source_x]
+        preview[usable] = frame[source_y[usable], source_x[usable]]
+    preview[done] = frame[done]
+    return preview
+
+def save_frame(frame: np.ndarray, filename: str) -> None:
+    """Saves sRGBA pixels under a temporary name and renames the file, so a reader never sees
+    a half written image
+    """
+    root, extension = os.path.splitext(filename)
+    partial = root + ".partial" + extension
+    Image.fromarray(frame, "RGBA").save(partial)
+    os.replace(partial, filename)
+
+def render_progressive(compiled: compiled_scene.CompiledScene, meta: scene.SceneMata,
+                       first_step: int = FIRST_STEP, time_budget: Optional[float] = None,
+                       preview_interval: Optional[float] = None,
+                       on_preview: Optional[Callable[[np.ndarray], None]] = None,
+                       seed: int = 0, chunk_pixels: int = CHUNK_PIXELS) -> Tuple[np.ndarray, bool]:
+    """Renders the scene pass by pass
+
+    Args:
+        first_step (int): the step of the first pass
+        time_budget (float): stop after the chunk that goes past this many seconds, None to render every pass
+        preview_interval (float): the least number of seconds between two calls of `on_preview`
+        on_preview (Callable[[np.ndarray], None]): called with the sRGBA preview after the first pass,
+        and then whenever `preview_interval` seconds have gone by since the last call
+        seed (int): seed for the random numbers used by rough surfaces
+
+    Returns:
+        Tuple[np.ndarray, bool]: (height, width, 4) linear framebuffer of the best image so far,
+        see `batch.encode`, and whether every pixel was rendered
+    """
+    start = timer()
+    passes = make_passes(meta.width, meta.height, first_step)
+    steps = [render_pass.step for render_pass in passes]
+    frame = np.zeros((meta.height, meta.width, 4), dtype=batch.FRAME_DTYPE)
+    done = np.zeros((meta.height, meta.width), dtype=bool)
+    last_preview = None
+    for pass_index, render_pass in enumerate(passes):
+        for chunk_index, first in enumerate(range(0, len(render_pass.xs), chunk_pixels)):
+            xs = render_pass.xs[first:first + chunk_pixels]
+            ys = render_pass.ys[first:first + chunk_pixels]
+            frame[ys, xs] = batch.trace_pixels(xs, ys, compiled, meta,
+                                                  sampling.make_rng(seed, pass_index, chunk_index))
+            done[ys, xs] = True
+            now = timer()
+            if time_budget is not None and now - start >= time_budget and not done.all():
+                return fill_preview(frame, done, steps), False
+            if on_preview is not None and last_preview is not None and preview_interval is not None \
+                    and now - last_preview >= preview_interval:
+                on_preview(batch.encode(fill_preview(frame, done, steps), meta))
+                last_preview = now
+        if pass_index == 0 and on_preview is not None:
+            on_preview(batch.encode(fill_preview(frame, done, steps), meta))
+            last_preview = timer()
+    return frame, True
+
+def raytrace_scene(compiled: compiled_scene.CompiledScene, meta: scene.SceneMata, image: Image,
+                   filename: Optional[str] = None, first_step: int = FIRST_STEP,
+                   time_budget: Optional[float] = None, preview_interval: Optional[float] = None,
+                   seed: int = 0) -> None:
+    """Renders the scene progressively into `image`
+
+    Args:
+        filename (str): where previews are written while rendering, None for no previews
+        first_step (int): the step of the first pass
+        time_budget (float): the seconds after which the best image so far is kept, None for no limit
+        preview_interval (float): the least number of seconds between two previews, None for only the first pass
+        seed (int): seed for the random numbers used by rough surfaces
+    """
+    start = timer()
+    on_preview = None
+    if filename is not None:
+        on_preview = lambda preview: save_frame(preview, filename)
+    frame, complete = render_progressive(compiled, meta, first_step, time_budget, preview_interval, on_preview, seed)
+    image.paste(Image.fromarray(batch.encode(frame, meta), "RGBA"))
+    end = timer()
+    print(f"Elapsed raytracing time = {end-start}s")
+    if not complete:
+        print(f"Stopped after the time budget of {time_budget}s, the image is a preview")
+    print(compiled.summary())
+    for tree in compiled.trees():
+        print(tree.summary())
+    if instrument.enabled:
+        print(instrument.report())
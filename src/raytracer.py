@@ -11,6 +11,9 @@ import src.colors as colors
 import src.scene as scene
 import src.shapes as shapes
 import src.light as light
+import src.optics as optics
+import src.instrument as instrument
+import src.sampling as sampling
 
 def make_eye_ray(x: float, y: float, meta: scene.SceneMata) -> Optional[shapes.Ray]:
     """Makes a ray starting at the eye
@@ -23,6 +26,14 @@ def make_eye_ray(x: float, y: float, meta: scene.SceneMata) -> Optional[shapes.R
     Returns:
         shapes.Ray: A ray with normalized direction
     """
+    if meta.lense == scene.Lense.panorama:
+        # x is the longitude all the way around the eye, y the latitude from straight down to straight up
+        longitude = (2*x - meta.width)/meta.width * math.pi
+        latitude = (meta.height - 2*y)/meta.height * (math.pi/2)
+        forward = meta.forward / np.linalg.norm(meta.forward)
+        ray_direction = math.cos(latitude) * (math.sin(longitude) * meta.right + math.cos(longitude) * forward) \
+            + math.sin(latitude) * meta.up
+        return shapes.Ray(meta.eye, ray_direction)
     s_x, s_y = make_flat_projection(x, y, meta)
     if meta.lense == scene.Lense.normal:
         ray_direction = meta.forward + s_x * meta.right + s_y * meta.up
@@ -39,8 +50,6 @@ def make_eye_ray(x: float, y: float, meta: scene.SceneMata) -> Optional[shapes.R
             return None
         # 4) otherwise, use s_x * right, s_y * up, and sqrt(1-r^2)*forward
         ray_direction = math.sqrt(1-r_sqr) * meta.forward + s_x * meta.right + s_y * meta.up
-    elif meta.lense == scene.Lense.panorama:
-        raise NotImplementedError
     return shapes.Ray(meta.eye, ray_direction)
 
 def make_flat_projection(x: float, y: float, meta: scene.SceneMata) -> Tuple[float, float]:
@@ -59,24 +68,34 @@ def make_flat_projection(x: float, y: float, meta: scene.SceneMata) -> Tuple[flo
     s_y = (meta.height- 2*y) / h_w_max
     return s_x, s_y
 
-def lerp(p1: np.ndarray, p2: np.ndarray, t: float) -> np.ndarray:
-    """performs linear interpolation between two np.ndarrays
-    Args:
-        p1 (np.ndarray): point containing some collection of values
-        p2 (np.ndarray): point containing some collection of values
-        t (float): goes from 0.0 to 1.0
-    Returns:
-        np.ndarray: [description]
-    """
-    return p1 + ((p2 - p1) * t)
-
 def make_reflection_ray(incident: np.ndarray, normal: np.ndarray, origin: np.ndarray) -> shapes.Ray:
     direction = (-2 * np.dot(incident, normal) * normal) + incident
     return shapes.Ray(origin, direction)
 
-def trace_ray(ray: shapes.Ray, origin: np.ndarray,
-              objects: scene.SceneObjects, meta: scene.SceneMata,
-              depth = 0, fudge = 10e-5) -> Optional[colors.RGBLinear]:
+def make_refraction_ray(incident: np.ndarray, normal: np.ndarray, origin: np.ndarray, ior: float,
+                        thin: bool) -> shapes.Ray:
+    direction, _ = optics.refract(incident, normal, ior, thin)
+    return shapes.Ray(origin, direction)
+
+def start_past_surface(ray: shapes.Ray, fudge = 10e-5) -> shapes.Ray:
+    """Moves the start of a ray leaving a transparent surface `fudge` along the ray. Rounding puts a
+    point on a sphere inside it as often as outside, and a ray going into the sphere from the
+    outside would miss its far side.
+    """
+    return shapes.Ray(ray.origin + fudge * ray.direction, ray.direction)
+
+def closest_intersection(ray: shapes.Ray, objects: scene.SceneObjects,
+                         fudge = 10e-5) -> Tuple[Optional[shapes.Shape], float]:
+    """Finds the closest shape hit by a ray
+
+    Args:
+        ray (shapes.Ray): the ray being traced
+        objects (scene.SceneObjects): the things in the scene
+        fudge (float): hits closer than this are ignored to avoid self intersection
+
+    Returns:
+        Tuple[Optional[shapes.Shape], float]: the closest shape and the distance to it
+    """
     closest_shape = None
     distance_to_closest_shape = math.inf
     for shape in objects.shapes:
@@ -85,66 +104,121 @@ def trace_ray(ray: shapes.Ray, origin: np.ndarray,
             if distance_to_shape < distance_to_closest_shape and distance_to_shape > fudge:
                 distance_to_closest_shape = distance_to_shape
                 closest_shape = shape
+    return closest_shape, distance_to_closest_shape
+
+def shade_hit(ray: shapes.Ray, origin: np.ndarray, closest_shape: shapes.Shape, distance_to_closest_shape: float,
+              objects: scene.SceneObjects, meta: scene.SceneMata,
+              depth = 0, fudge = 10e-5, rng: Optional[np.random.Generator] = None) -> colors.RGBLinear:
+    """Computes the color seen along a ray that hits `closest_shape`
+
+    Args:
+        ray (shapes.Ray): the ray being traced
+        origin (np.ndarray): the origin of the ray
+        closest_shape (shapes.Shape): the shape the ray hit first
+        distance_to_closest_shape (float): the distance from `origin` to the hit
+        objects (scene.SceneObjects): the things in the scene
+        meta (scene.SceneMata): Metadata about the scene
+        depth (int): how many reflections deep this ray is
+        rng (np.random.Generator): random numbers for rough surfaces and soft shadows, the global random state when None
+
+    Returns:
+        colors.RGBLinear: the linear color of the hit
+    """
     pixel_color = colors.RGBLinear(0.0, 0.0, 0.0)
+    # calculate the point of intersection
+    point_of_intersection = origin + (distance_to_closest_shape*ray.direction)
+    # find the normal of the shape at the point of intersection
+    normal = closest_shape.normal_at_point(point_of_intersection, rng)
+    if closest_shape.two_sided and np.dot(normal, ray.direction) > 0:
+        normal = -normal
+    for light_source in objects.lights:
+        # make a ray to the light source 
+        ray_to_light_direction = light_source.point - point_of_intersection
+        distance_to_light = np.linalg.norm(ray_to_light_direction)
+        if type(light_source) is light.Sun:
+            # TODO: draw attention to the fact that the direction for the sun in the sun's position
+            distance_to_light = math.inf
+            ray_to_light_direction = light_source.point
+        ray_to_light = shapes.Ray(point_of_intersection, ray_to_light_direction)
+        if isinstance(light_source, light.SoftLight):
+            # soft lights send their own shadow rays, but only to points that face them
+            color_from_light = light_source.lambert(
+                ray=ray_to_light,
+                normal=normal,
+                object_color=closest_shape.color,
+            )
+            if np.dot(ray_to_light.direction, normal) > 0:
+                visibility = light_source.visibility(point_of_intersection, objects.shapes, rng, fudge)
+                color_from_light *= colors.RGBLinear(visibility, visibility, visibility)
+            pixel_color += color_from_light
+            continue
+        # check for shadows
+        has_shadow = shapes.any_occluder(objects.shapes, ray_to_light, distance_to_light, fudge)
+
+        if not has_shadow:
+            color_from_light = light_source.lambert(
+                ray=ray_to_light,
+                normal=normal,
+                object_color=closest_shape.color,
+            )
+        else:
+            color_from_light = colors.RGBLinear()
+        # add the color from the light to the current pixel color
+        if color_from_light:
+            pixel_color += color_from_light
+    shininess = closest_shape.shininess
+    # Check for refraction, which shares the depth budget with reflection
+    if closest_shape.transparency > 0.0 and depth < meta.reflection_depth:
+        _, reflectance = optics.refract(ray.direction, normal, closest_shape.ior, closest_shape.two_sided)
+        shininess, transmission = optics.fresnel_weights(shininess, closest_shape.transparency, float(reflectance))
+        if transmission > 0.0:
+            refraction_ray = start_past_surface(make_refraction_ray(
+                ray.direction, normal, point_of_intersection, closest_shape.ior, closest_shape.two_sided), fudge)
+            color_from_refraction = trace_ray(refraction_ray, refraction_ray.origin, objects, meta, depth + 1, fudge, rng)
+            if not color_from_refraction:
+                color_from_refraction = colors.RGBLinear()
+            pixel_color = colors.color_from_ndarray(
+                optics.lerp(pixel_color.as_ndarray(), color_from_refraction.as_ndarray(), transmission)
+            )
+    # Check for reflection
+    if shininess > 0.0 and depth < meta.reflection_depth:
+        reflection_ray = make_reflection_ray(ray.direction, normal, point_of_intersection)
+        if closest_shape.transparency > 0.0:
+            reflection_ray = start_past_surface(reflection_ray, fudge)
+        color_from_reflection = trace_ray(reflection_ray, reflection_ray.origin, objects, meta, depth + 1, fudge, rng)
+        # Calculate the mix of the color from the standard light and the color from reflection
+        if color_from_reflection:
+            pixel_color = colors.color_from_ndarray(
+                optics.lerp(pixel_color.as_ndarray(), color_from_reflection.as_ndarray(), shininess)
+            )
+        else:
+            pixel_color = colors.color_from_ndarray(
+                optics.lerp(pixel_color.as_ndarray(), colors.RGBLinear().as_ndarray(), shininess)
+            )
+    return pixel_color
+
+def trace_ray(ray: shapes.Ray, origin: np.ndarray,
+              objects: scene.SceneObjects, meta: scene.SceneMata,
+              depth = 0, fudge = 10e-5, rng: Optional[np.random.Generator] = None) -> Optional[colors.RGBLinear]:
+    closest_shape, distance_to_closest_shape = closest_intersection(ray, objects, fudge)
     if closest_shape:
-        # calculate the point of intersection
-        point_of_intersection = origin + (distance_to_closest_shape*ray.direction)
-        # find the normal of the shape at the point of intersection
-        normal = closest_shape.normal_at_point(point_of_intersection)
-        for light_source in objects.lights:
-            # make a ray to the light source 
-            ray_to_light_direction = light_source.point - point_of_intersection
-            distance_to_light = np.linalg.norm(ray_to_light_direction)
-            if type(light_source) is light.Sun:
-                # TODO: draw attention to the fact that the direction for the sun in the sun's position
-                distance_to_light = math.inf
-                ray_to_light_direction = light_source.point
-            ray_to_light = shapes.Ray(point_of_intersection, ray_to_light_direction)
-            # check for shadows
-            has_shadow = False
-            for shape in objects.shapes:
-                shape_distance = shape.intersection(ray_to_light)
-                if shape_distance:
-                    if shape_distance < distance_to_light and shape_distance > fudge:
-                        has_shadow = True
-
-            if not has_shadow:
-                color_from_light = light_source.lambert(
-                    ray=ray_to_light,
-                    normal=normal,
-                    object_color=closest_shape.color,
-                )
-            else:
-                color_from_light = colors.RGBLinear()
-            # add the color from the light to the current pixel color
-            if color_from_light:
-                pixel_color += color_from_light
-        # Check for reflection
-        if closest_shape.shininess > 0.0 and depth < meta.reflection_depth:
-            reflection_ray = make_reflection_ray(ray.direction, normal, point_of_intersection)
-            color_from_reflection = trace_ray(reflection_ray, point_of_intersection, objects, meta, depth + 1)
-            # Calculate the mix of the color from the standard light and the color from reflection
-            if color_from_reflection:
-                pixel_color = colors.color_from_ndarray(
-                    lerp(pixel_color.as_ndarray(), color_from_reflection.as_ndarray(), closest_shape.shininess)
-                )
-            else:
-                pixel_color = colors.color_from_ndarray(
-                    lerp(pixel_color.as_ndarray(), colors.RGBLinear().as_ndarray(), closest_shape.shininess)
-                )
-        return pixel_color
+        return shade_hit(ray, origin, closest_shape, distance_to_closest_shape, objects, meta, depth, fudge, rng)
     
 
-def raytrace_scene(objects: scene.SceneObjects, meta: scene.SceneMata, image: Image) -> None:
+def raytrace_scene(objects: scene.SceneObjects, meta: scene.SceneMata, image: Image, seed: Optional[int] = None) -> None:
+    """Renders the scene one pixel at a time. Rough surfaces draw from a generator made from `seed`,
+    or from the global random state when it is None.
+    """
     start = timer()
-    
+    rng = None if seed is None else sampling.make_rng(seed)
+
     for x in range(meta.width):
         for y in range(meta.height):
             # Make the ray
             ray_from_eye = make_eye_ray(x, y, meta)
             if not ray_from_eye:
                 continue
-            pixel_color = trace_ray(ray_from_eye, meta.eye, objects, meta)
+            pixel_color = trace_ray(ray_from_eye, meta.eye, objects, meta, rng=rng)
             if not pixel_color:
                 continue
             # Apply the exposure function to the linear color
@@ -154,4 +228,6 @@ def raytrace_scene(objects: scene.SceneObjects, meta: scene.SceneMata, image: Im
             image.im.putpixel((x, y), (converted_color.r, converted_color.g, converted_color.b, converted_color.a))
     end = timer()
     print(f"Elapsed raytracing time = {end-start}s")
+    if instrument.enabled:
+        print(instrument.report())
 
@@ -0,0 +1,50 @@
+"""Random numbers for rough surfaces and soft shadows. Every unit of work, a tile, a chunk of a progressive pass or a
+whole reference render, gets its own `np.random.Generator` made from the render seed and a key
+that names the unit. Results then only depend on the seed and on how the image is divided, never on
+which process did the work or in which order.
+"""
+from typing import Optional
+
+import numpy as np
+
+# Soft lights first send this many shadow rays, one to each quarter of the light
+PROBES = 4
+
+def make_rng(seed: int, *key: int) -> np.random.Generator:
+    """A generator for one unit of work
+
+    Args:
+        seed (int): the seed of the whole render
+        key (int): names the unit of work, for example the frame and tile index
+
+    Returns:
+        np.random.Generator: a generator independent from the ones of every other key
+    """
+    return np.random.Generator(np.random.PCG64(np.random.SeedSequence(seed, spawn_key=key)))
+
+def quadrant_samples(rng: Optional[np.random.Generator], count: int) -> np.ndarray:
+    """`PROBES` points in the unit square for each of `count` shadow tests, one in each quarter
+
+    Args:
+        rng (np.random.Generator): where the jitter comes from, the global random state when None
+
+    Returns:
+        np.ndarray: (count, PROBES, 2) points
+    """
+    corners = np.array([[0, 0], [0.5, 0], [0, 0.5], [0.5, 0.5]])
+    return corners + 0.5 * (np.random if rng is None else rng).random((count, PROBES, 2))
+
+def stratified_samples(rng: Optional[np.random.Generator], count: int, n: int) -> np.ndarray:
+    """`n` points in the unit square for each of `count` shadow tests. Each of the `n` columns and
+    each of the `n` rows of the square holds one point, so any number of samples is stratified.
+
+    Args:
+        rng (np.random.Generator): where the jitter comes from, the global random state when None
+
+    Returns:
+        np.ndarray: (count, n, 2) points
+    """
+    random = (np.random if rng is None else rng).random
+    rows = random((count, n)).argsort(axis=1)
+    strata = np.stack([np.broadcast_to(np.arange(n), (count, n)), rows], axis=-1)
+    return (strata + random((count, n, 2))) / n
@@ -5,6 +5,7 @@ from src.shapes import Shape
 import numpy as np
 import src.colors as colors
 import src.light as light
+import src.vertex as vertex
 import enum
 
 class Lense(enum.Enum):
@@ -14,6 +15,16 @@ class Lense(enum.Enum):
     panorama = "panorama"
     fisheye = "fisheye"
 
+def no_exposure(x: float) -> float:
+    """The default exposure function, leaves the color unchanged"""
+    return x
+
+def expose(v: float, x: float) -> float:
+    """The exposure function set by `expose v`. Used through `functools.partial` so that
+    `SceneMata` can be pickled and sent to worker processes.
+    """
+    return 1-(math.e**(-x*v))
+
 @dataclasses.dataclass
 class SceneMata():
     """contains information that will need to last for the lifecycle of the image
@@ -21,6 +32,10 @@ class SceneMata():
     \b forward: . A vector, but not normalized: longer forward vectors make for a narrow field of view.
     \b right: A normalized vector.
     \b up: A normalized vector.
+    \b ior: the index of refraction of the objects made from now on, 1.458 like glass by default
+    \b samples: how many times the array renderers trace a pixel whose color depends on a rough surface
+    \b light_samples: how many shadow rays each soft light made from now on sends, see `light.SoftLight`
+    \b vertices: the `xyz` points read so far, for `trif` triangles to use
     """
     height: int
     width: int
@@ -29,12 +44,16 @@ class SceneMata():
     forward: np.ndarray = np.array([0,0,-1])
     right: np.ndarray = np.array([1,0,0])
     up: np.ndarray = np.array([0,1,0])
-    exposure_function: Callable[[float], float] = lambda x: x
+    exposure_function: Callable[[float], float] = no_exposure
     lense: Lense = Lense.normal
     reflection_depth: int = 4
     shininess: float = 0.0
     transparency: float = 0.0
     roughness: float = 0.0
+    ior: float = 1.458
+    samples: int = 1
+    light_samples: int = 16
+    vertices: "list[vertex.Vertex]" = dataclasses.field(default_factory=list)
     def clear(self):
         """Used to wipe info that will not cary over to the next image in the animation
         """
@@ -0,0 +1,504 @@
+"""A long running render service. Scene files come in as text and go back as PNG images, rendered
+on a pool of worker processes that stay up between requests, so no request pays for starting
+Python, importing NumPy or compiling kernels. Each worker also keeps the scenes it compiled last,
+keyed by the SHA-256 of their text, so a scene sent again skips parsing and building its BVH.
+
+At most `workers` scenes render at once and at most `queue_size` more wait for a worker. Requests
+past that are turned away instead of piling up. Every request is timed, and the totals are kept in
+`Metrics`.
+
+Usage: python -m src.server [--port 8000 | --socket PATH | --stdio] [--workers N] [--queue-size N]
+
+Over HTTP, POST a scene file to /render, with an optional ?seed=, to get image/png back with the
+timings in X-*-Time headers. GET /metrics returns the totals as JSON. A full queue answers 503, a
+scene that does not parse 400 and a render over --timeout 504.
+
+With --stdio every line of stdin is a JSON object with the scene text as "scene" or its path as
+"file", and optionally "id", "seed" and "output", a path to save the PNG to. One JSON line is
+written to stdout for every request as it finishes, with the same "id", the timings, and the PNG
+in base64 as "png" when there is no "output", or "error" if it failed.
+"""
+import argparse
+import base64
+import collections
+import concurrent.futures
+import dataclasses
+import functools
+import hashlib
+import http.server
+import io
+import json
+import os
+import socketserver
+import sys
+import threading
+import time
+import urllib.parse
+from typing import Dict, Iterable, Optional, TextIO, Tuple
+
+from PIL import Image
+from timeit import default_timer as timer
+
+import src.batch as batch
+import src.compiled as compiled_scene
+import src.file_parse as file_parse
+import src.jit as jit
+import src.scene as scene
+import src.tiles as tiles
+import src.utils as utils
+
+QUEUE_SIZE = 16
+CACHE_SIZE = 8
+# The largest scene file accepted over HTTP, in bytes
+MAX_BYTES = 64 * 2**20
+# Rendered by every worker as it starts, so the first request finds it warm
+WARM_UP_SCENE = "png 4 4 warm-up.png\nsun 1 1 1\nsphere 0 0 -1 0.5\n"
+
+class QueueFull(Exception):
+    """Raised by `RenderService.submit` when every worker is busy and the queue has no room"""
+
+class SceneError(ValueError):
+    """Raised for a scene that could not be parsed, or that the service cannot render"""
+
+@dataclasses.dataclass
+class Timings():
+    """How long one request took, in seconds
+    \b queued: from being submitted until a worker took it
+    \b parse: parsing and compiling the scene, 0 when the worker had it already
+    \b render: tracing the rays
+    \b encode: converting to sRGB and compressing the PNG
+    \b total: from being submitted until the PNG was back in the service
+    \b cached: whether the worker had compiled the scene already
+    """
+    queued: float = 0.0
+    parse: float = 0.0
+    render: float = 0.0
+    encode: float = 0.0
+    total: float = 0.0
+    cached: bool = False
+
+TIMED = ("queued", "parse", "render", "encode", "total")
+
+@dataclasses.dataclass
+class Metrics():
+    """Totals over every request since the service started
+    \b completed: requests that returned an image
+    \b failed: requests whose scene could not be rendered
+    \b rejected: requests turned away because the queue was full
+    \b timed_out: requests whose caller stopped waiting, they still count as completed or failed
+    \b cache_hits: completed requests whose scene the worker had compiled already
+    \b seconds: the sum of each of the `TIMED` timings over the completed requests
+    \b max_seconds: the longest of each of the `TIMED` timings
+    """
+    completed: int = 0
+    failed: int = 0
+    rejected: int = 0
+    timed_out: int = 0
+    cache_hits: int = 0
+    seconds: Dict[str, float] = dataclasses.field(default_factory=lambda: dict.fromkeys(TIMED, 0.0))
+    max_seconds: Dict[str, float] = dataclasses.field(default_factory=lambda: dict.fromkeys(TIMED, 0.0))
+
+    def add(self, timings: Timings) -> None:
+        self.completed += 1
+        self.cache_hits += timings.cached
+        for name in TIMED:
+            seconds = getattr(timings, name)
+            self.seconds[name] += seconds
+            self.max_seconds[name] = max(self.max_seconds[name], seconds)
+
+    def as_dict(self) -> dict:
+        values = dataclasses.asdict(self)
+        values["mean_seconds"] = {name: total / self.completed if self.completed else 0.0
+                                  for name, total in self.seconds.items()}
+        return values
+
+### RENDERING ###
+
+def compile_text(text: str, accel: str = "auto") -> Tuple[scene.SceneMata, compiled_scene.CompiledScene]:
+    """Parses a scene file given as text
+
+    Raises:
+        SceneError: if it does not parse, or is an animation
+    """
+    try:
+        image_info, meta, compiled = file_parse.stream_scene(io.StringIO(text), accel)
+    except Exception as error:
+        raise SceneError(f"The scene could not be parsed: {error!r}") from None
+    if not image_info.is_single_file:
+        raise SceneError("The render server renders single images only")
+    return meta, compiled
+
+def encode_png(pixels, meta: scene.SceneMata) -> bytes:
+    output = io.BytesIO()
+    Image.fromarray(batch.encode(pixels, meta), "RGBA").save(output, "PNG")
+    return output.getvalue()
+
+### WORKER PROCESSES ###
+# The scenes each worker compiled last, the most recently used at the end
+_worker_scenes: "collections.OrderedDict[str, Tuple[scene.SceneMata, compiled_scene.CompiledScene]]" = \
+    collections.OrderedDict()
+_worker_cache_size: int = CACHE_SIZE
+_worker_accel: str = "auto"
+
+def _init_worker(accel: str, cache_size: int, jitted: bool = False) -> None:
+    global _worker_cache_size, _worker_accel
+    if jitted:
+        # one worker runs on each core already
+        jit.enable(threads=False)
+    _worker_accel = accel
+    _worker_cache_size = 0
+    _render_in_worker(WARM_UP_SCENE, 0, time.time())
+    _worker_cache_size = cache_size
+
+def _worker_scene(text: str) -> Tuple[scene.SceneMata, compiled_scene.CompiledScene, bool]:
+    """The compiled scene of `text`, from the worker's cache when it is there, and whether it was"""
+    digest = hashlib.sha256(text.encode()).hexdigest()
+    if digest in _worker_scenes:
+        _worker_scenes.move_to_end(digest)
+        return (*_worker_scenes[digest], True)
+    meta, compiled = compile_text(text, _worker_accel)
+    if _worker_cache_size > 0:
+        _worker_scenes[digest] = (meta, compiled)
+        while len(_worker_scenes) > _worker_cache_size:
+            _worker_scenes.popitem(last=False)
+    return meta, compiled, False
+
+def _render_in_worker(text: str, seed: int, submitted: float) -> Tuple[bytes, Timings]:
+    """Renders a scene to PNG bytes. `submitted` is the `time.time` of the request, since the clocks
+    of `timer` in different processes cannot be compared.
+    """
+    timings = Timings(queued=max(time.time() - submitted, 0.0))
+    start = timer()
+    meta, compiled, timings.cached = _worker_scene(text)
+    parsed = timer()
+    pixels = tiles.render_frame(compiled, meta, workers=1, seed=seed)
+    rendered = timer()
+    png = encode_png(pixels, meta)
+    timings.parse = parsed - start
+    timings.render = rendered - parsed
+    timings.encode = timer() - rendered
+    return png, timings
+
+def _started() -> int:
+    return os.getpid()
+
+### SERVICE ###
+
+class RenderService():
+    """A pool of warm workers with a bounded queue in front of it. It can be used from many threads."""
+
+    def __init__(self, workers: int = 1, queue_size: int = QUEUE_SIZE, cache_size: int = CACHE_SIZE,
+                 accel: str = "auto", jitted: bool = False):
+        """
+        Args:
+            workers (int): the number of worker processes, 0 for one per cpu
+            queue_size (int): how many requests may wait for a worker
+            cache_size (int): how many compiled scenes each worker keeps
+            accel (str): "bvh", "none", or "auto", see `compiled.compile_scene`
+            jitted (bool): whether the workers use the compiled kernels of `jit`
+        """
+        if workers <= 0:
+            workers = tiles.default_workers()
+        self.workers = workers
+        self.queue_size = queue_size
+        self.metrics = Metrics()
+        self.in_flight = 0
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+        self._pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_worker, initargs=(accel, cache_size, jitted))
+        # start every worker now, before any request is waiting on one
+        concurrent.futures.wait([self._pool.submit(_started) for _ in range(workers)])
+
+    def submit(self, text: str, seed: int = 0, block: bool = False) -> concurrent.futures.Future:
+        """Queues a scene to be rendered
+
+        Args:
+            text (str): the scene file
+            seed (int): seed for the random numbers of rough surfaces and soft shadows
+            block (bool): wait for room in the queue instead of raising `QueueFull`
+
+        Returns:
+            concurrent.futures.Future: resolves to the PNG bytes and the `Timings`, once they are in `metrics`
+        """
+        if not self._slots.acquire(blocking=block):
+            with self._lock:
+                self.metrics.rejected += 1
+            raise QueueFull(f"{self.workers} scenes are rendering and {self.queue_size} are waiting")
+        with self._lock:
+            self.in_flight += 1
+        result = concurrent.futures.Future()
+        start = timer()
+        try:
+            rendering = self._pool.submit(_render_in_worker, text, seed, time.time())
+        except BaseException:
+            self._finish(None)
+            raise
+        rendering.add_done_callback(functools.partial(self._resolve, result, start))
+        return result
+
+    def _finish(self, timings: Optional[Timings]) -> None:
+        with self._lock:
+            self.in_flight -= 1
+            if timings is None:
+                self.metrics.failed += 1
+            else:
+                self.metrics.add(timings)
+        self._slots.release()
+
+    def _resolve(self, result: concurrent.futures.Future, start: float, rendering: concurrent.futures.Future) -> None:
+        error = rendering.exception()
+        if error is not None:
+            self._finish(None)
+            result.set_exception(error)
+            return
+        png, timings = rendering.result()
+        timings.total = timer() - start
+        self._finish(timings)
+        result.set_result((png, timings))
+
+    def render(self, text: str, seed: int = 0, timeout: Optional[float] = None,
+               block: bool = False) -> Tuple[bytes, Timings]:
+        """Renders a scene and waits for it, see `submit`
+
+        Raises:
+            QueueFull: if there is no room in the queue and `block` is False
+            SceneError: if the scene could not be rendered
+            concurrent.futures.TimeoutError: if it took more than `timeout` seconds, the render still finishes in the background
+        """
+        future = self.submit(text, seed, block)
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            with self._lock:
+                self.metrics.timed_out += 1
+            raise
+
+    def report(self) -> dict:
+        with self._lock:
+            values = self.metrics.as_dict()
+            values["in_flight"] = self.in_flight
+        values["workers"] = self.workers
+        values["queue_size"] = self.queue_size
+        return values
+
+    def close(self) -> None:
+        self._pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+### HTTP ###
+
+def timing_headers(timings: Timings) -> "dict[str, str]":
+    headers = {f"X-{name.capitalize()}-Time": f"{getattr(timings, name):.6f}" for name in TIMED}
+    headers["X-Cache-Hit"] = str(int(timings.cached))
+    return headers
+
+class RenderHandler(http.server.BaseHTTPRequestHandler):
+    """Serves /render, /metrics and /health for the `RenderService` of its server"""
+    server_version = "RaytracerRender/1.0"
+
+    def _reply(self, status: int, body: bytes, content_type: str, headers: Optional["dict[str, str]"] = None) -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _error(self, status: int, message: str, headers: Optional["dict[str, str]"] = None) -> None:
+        self._reply(status, (message + "\n").encode(), "text/plain; charset=utf-8", headers)
+
+    def do_GET(self):
+        path = urllib.parse.urlsplit(self.path).path
+        if path == "/metrics":
+            self._reply(200, json.dumps(self.server.service.report()).encode(), "application/json")
+        elif path == "/health":
+            self._reply(200, b"ok\n", "text/plain; charset=utf-8")
+        else:
+            self._error(404, "Not found")
+
+    def do_POST(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path != "/render":
+            self._error(404, "Not found")
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            if length < 0:
+                raise ValueError("Negative Content-Length", length)
+        except ValueError:
+            self._error(400, "Content-Length must be a number of bytes")
+            return
+        if length > self.server.max_bytes:
+            self._error(413, f"Scene files may be at most {self.server.max_bytes} bytes")
+            return
+        try:
+            text = self.rfile.read(length).decode()
+            seed = int(urllib.parse.parse_qs(url.query).get("seed", ["0"])[0])
+        except (UnicodeDecodeError, ValueError):
+            self._error(400, "Send the scene file as UTF-8 text, with an integer seed")
+            return
+        try:
+            png, timings = self.server.service.render(text, seed, self.server.timeout_seconds)
+        except QueueFull as error:
+            self._error(503, str(error), {"Retry-After": "1"})
+        except SceneError as error:
+            self._error(400, str(error))
+        except concurrent.futures.TimeoutError:
+            self._error(504, f"The render took more than {self.server.timeout_seconds}s")
+        except Exception as error:
+            self._error(500, f"The render failed: {error!r}")
+        else:
+            self._reply(200, png, "image/png", timing_headers(timings))
+
+    def log_message(self, format: str, *args) -> None:
+        if self.server.log_requests:
+            super().log_message(format, *args)
+
+    def address_string(self) -> str:
+        # clients of a Unix socket have no address
+        return self.client_address[0] if self.client_address else "unix"
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def make_server(service: RenderService, host: str = "127.0.0.1", port: int = 8000,
+                socket_path: Optional[str] = None, timeout: Optional[float] = None,
+                max_bytes: int = MAX_BYTES, log_requests: bool = True) -> socketserver.BaseServer:
+    """An HTTP server for `service` on localhost, or on a Unix socket if `socket_path` is given.
+    Each connection gets its own thread, which waits for its render.
+
+    Args:
+        port (int): the TCP port, 0 for any free one
+        timeout (float): seconds a request waits for its render before getting a 504, None for no limit
+        max_bytes (int): the largest scene file accepted
+        log_requests (bool): whether to log every request to stderr
+    """
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        server = _UnixHTTPServer(socket_path, RenderHandler)
+    else:
+        server = http.server.ThreadingHTTPServer((host, port), RenderHandler)
+    server.service = service
+    server.timeout_seconds = timeout
+    server.max_bytes = max_bytes
+    server.log_requests = log_requests
+    return server
+
+### STDIN AND STDOUT ###
+
+def serve_stdio(service: RenderService, lines: Iterable[str], output: TextIO) -> int:
+    """Renders a request for every JSON line of `lines`, see the module docstring. Requests wait
+    for room in the queue, and their responses are written in the order they finish.
+
+    Returns:
+        int: the number of requests that failed
+    """
+    write_lock = threading.Lock()
+    answered = threading.Semaphore(0)
+    failures = 0
+
+    def respond(response: dict) -> None:
+        nonlocal failures
+        with write_lock:
+            failures += "error" in response
+            output.write(json.dumps(response) + "\n")
+            output.flush()
+
+    def finished(request: dict, future: concurrent.futures.Future) -> None:
+        response = {"id": request.get("id")}
+        try:
+            error = future.exception()
+            if error is not None:
+                response["error"] = str(error)
+            else:
+                png, timings = future.result()
+                response["timings"] = dataclasses.asdict(timings)
+                if request.get("output"):
+                    try:
+                        with open(request["output"], "wb") as file:
+                            file.write(png)
+                        response["output"] = request["output"]
+                    except OSError as write_error:
+                        response["error"] = f"Could not write the image: {write_error!r}"
+                else:
+                    response["png"] = base64.b64encode(png).decode()
+            respond(response)
+        finally:
+            # `serve_stdio` waits for every request to be answered
+            answered.release()
+
+    pending = 0
+    for number, line in enumerate(lines):
+        if not line.strip():
+            continue
+        request = {"id": number}
+        try:
+            request.update(json.loads(line))
+            if "scene" in request:
+                text = request["scene"]
+            else:
+                with open(request["file"]) as file:
+                    text = file.read()
+            seed = int(request.get("seed", 0))
+        except (ValueError, TypeError, KeyError, OSError) as error:
+            respond({"id": request["id"], "error": f"Bad request: {error!r}"})
+            continue
+        future = service.submit(text, seed, block=True)
+        future.add_done_callback(functools.partial(finished, request))
+        pending += 1
+    for _ in range(pending):
+        answered.acquire()
+    return failures
+
+### COMMAND LINE ###
+
+def main(args: "list[str]") -> int:
+    parser = argparse.ArgumentParser(prog="python -m src.server", description=__doc__.split("\n\n")[0])
+    where = parser.add_mutually_exclusive_group()
+    where.add_argument("--port", type=int, default=8000, help="localhost port to serve HTTP on (default: %(default)s)")
+    where.add_argument("--socket", help="serve HTTP on this Unix socket instead")
+    where.add_argument("--stdio", action="store_true", help="read JSON requests from stdin, one per line")
+    parser.add_argument("--host", default="127.0.0.1", help="address to serve HTTP on (default: %(default)s)")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="number of render processes, 0 for one per cpu (default: %(default)s)")
+    parser.add_argument("--queue-size", type=int, default=QUEUE_SIZE,
+                        help="requests that may wait for a worker before more are turned away (default: %(default)s)")
+    parser.add_argument("--cache-size", type=int, default=CACHE_SIZE,
+                        help="compiled scenes each worker keeps (default: %(default)s)")
+    parser.add_argument("--accel", choices=utils.ACCELS, default="auto",
+                        help="acceleration structure (default: %(default)s)")
+    parser.add_argument("--timeout", type=float, help="seconds an HTTP request waits for its render")
+    parser.add_argument("--jit", action="store_true", help="render with the compiled kernels if Numba is installed")
+    parsed = parser.parse_args(args)
+    if parsed.queue_size < 0:
+        parser.error("--queue-size must be at least 0")
+    if parsed.jit and not jit.AVAILABLE:
+        print("Numba is not installed, rendering without --jit", file=sys.stderr)
+
+    with RenderService(parsed.workers, parsed.queue_size, parsed.cache_size, parsed.accel,
+                       parsed.jit and jit.AVAILABLE) as service:
+        if parsed.stdio:
+            return 1 if serve_stdio(service, sys.stdin, sys.stdout) else 0
+        server = make_server(service, parsed.host, parsed.port, parsed.socket, parsed.timeout)
+        where = parsed.socket or "http://{}:{}".format(*server.server_address[:2])
+        print(f"Rendering on {service.workers} workers, serving {where}", file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            if parsed.socket is not None:
+                os.unlink(parsed.socket)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
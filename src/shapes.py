@@ -2,7 +2,7 @@
 import abc
 import dataclasses
 import math
-from typing import Optional
+from typing import ClassVar, Optional
 
 import numpy as np
 
@@ -20,20 +20,170 @@ class Ray():
 @dataclasses.dataclass
 class _ShapeBase:
     color: colors.RGBLinear
-    shininess: float
-    transparency: float
-    roughness: float
+    shininess: float = 0.0
+    transparency: float = 0.0
+    roughness: float = 0.0
+    ior: float = 1.458
 
 @dataclasses.dataclass
 class Shape(abc.ABC, _ShapeBase):
+    # Shapes seen from both sides have their normal turned towards the ray that hits them
+    two_sided: ClassVar[bool] = False
+
     @abc.abstractmethod
     def intersection(self, ray: Ray) -> Optional[float]:
         pass
     
     @abc.abstractmethod
-    def normal_at_point(self, point: np.ndarray) -> np.ndarray:
+    def normal_at_point(self, point: np.ndarray, rng: Optional[np.random.Generator] = None) -> np.ndarray:
         pass
 
+    def occludes(self, ray: Ray, max_distance: float, fudge = 10e-5) -> bool:
+        """Checks if the shape blocks the ray somewhere between `fudge` and `max_distance`
+
+        Args:
+            ray (Ray): the shadow ray
+            max_distance (float): the distance to the light, `math.inf` for suns
+            fudge (float): hits closer than this are ignored to avoid self intersection
+
+        Returns:
+            bool: true if the shape is in the way
+        """
+        distance = self.intersection(ray)
+        return bool(distance) and fudge < distance < max_distance
+
+    def occludes_many(self, origins: np.ndarray, directions: np.ndarray, max_distances: np.ndarray,
+                      fudge = 10e-5) -> np.ndarray:
+        """Batched version of `occludes`
+
+        Args:
+            origins (np.ndarray): (N, 3) ray origins
+            directions (np.ndarray): (N, 3) normalized ray directions
+            max_distances (np.ndarray): (N,) distance to the light along each ray
+
+        Returns:
+            np.ndarray: (N,) true where the shape is in the way
+        """
+        return np.array([
+            self.occludes(Ray(origin, direction), max_distance, fudge)
+            for origin, direction, max_distance in zip(origins, directions, max_distances)
+        ], dtype=bool)
+
+def any_occluder(shapes: "list[Shape]", ray: Ray, max_distance: float, fudge = 10e-5) -> bool:
+    """Checks if any of the shapes blocks the ray, stopping at the first one that does"""
+    for shape in shapes:
+        if shape.occludes(ray, max_distance, fudge):
+            return True
+    return False
+
+def sphere_distances(origins: np.ndarray, directions: np.ndarray,
+                     centers: np.ndarray, radii: np.ndarray, fudge = 10e-5) -> np.ndarray:
+    """Follows `shapes.Sphere.intersection` step by step, so the distances match the per-ray path.
+    The arguments broadcast against each other, the last axis of the vectors being x, y, z.
+
+    Args:
+        origins (np.ndarray): ray origins
+        directions (np.ndarray): normalized ray directions
+        centers (np.ndarray): sphere centers
+        radii (np.ndarray): sphere radii
+        fudge (float): hits closer than this are ignored to avoid self intersection
+
+    Returns:
+        np.ndarray: distance along each ray to each sphere, `np.inf` where there is no hit
+    """
+    length_of_direction = np.sqrt(np.einsum("...i,...i->...", directions, directions))
+    r_sqr = radii**2
+    to_center = centers - origins
+    is_inside = np.einsum("...i,...i->...", to_center, to_center) < r_sqr
+    t_c = np.einsum("...i,...i->...", to_center, directions)/length_of_direction
+    offset = origins + t_c[..., np.newaxis] * directions - centers
+    d_sqr = np.einsum("...i,...i->...", offset, offset)
+    miss = ~is_inside & ((t_c < 0) | (d_sqr > r_sqr))
+    t_offset = np.sqrt(np.maximum(r_sqr - d_sqr, 0))/length_of_direction
+    distances = np.where(is_inside, t_c + t_offset, t_c - t_offset)
+    distances[miss | (distances <= fudge)] = np.inf
+    return distances
+
+def triangle_distances(origins: np.ndarray, directions: np.ndarray, corners: np.ndarray,
+                       edges1: np.ndarray, edges2: np.ndarray, fudge = 10e-5) -> np.ndarray:
+    """Möller–Trumbore intersection of rays with triangles. The arguments broadcast against each
+    other like those of `sphere_distances`.
+
+    Args:
+        origins (np.ndarray): ray origins
+        directions (np.ndarray): normalized ray directions
+        corners (np.ndarray): the first corner of each triangle
+        edges1, edges2 (np.ndarray): the second and third corner minus the first
+        fudge (float): hits closer than this are ignored to avoid self intersection
+
+    Returns:
+        np.ndarray: distance along each ray to each triangle, `np.inf` where there is no hit
+    """
+    p = np.cross(directions, edges2)
+    determinant = np.einsum("...i,...i->...", edges1, p)
+    to_origin = origins - corners
+    q = np.cross(to_origin, edges1)
+    # rays parallel to a triangle have a determinant of 0 and give infinities or nans, which miss below
+    with np.errstate(divide="ignore", invalid="ignore"):
+        inverse = 1 / determinant
+        u = np.einsum("...i,...i->...", to_origin, p) * inverse
+        v = np.einsum("...i,...i->...", directions, q) * inverse
+        t = np.einsum("...i,...i->...", edges2, q) * inverse
+        hit = (determinant != 0) & (u >= 0) & (v >= 0) & (u + v <= 1) & (t > fudge)
+    return np.where(hit, t, np.inf)
+
+def plane_distances(origins: np.ndarray, directions: np.ndarray, normals: np.ndarray, offsets: np.ndarray,
+                    fudge = 10e-5) -> np.ndarray:
+    """Intersection of rays with the planes `normal . x + offset = 0`. The arguments broadcast
+    against each other like those of `sphere_distances`.
+
+    Returns:
+        np.ndarray: distance along each ray to each plane, `np.inf` where there is no hit
+    """
+    along_normal = np.einsum("...i,...i->...", directions, normals)
+    # rays parallel to a plane never reach it
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = -(np.einsum("...i,...i->...", origins, normals) + offsets) / along_normal
+        hit = (along_normal != 0) & (t > fudge)
+    return np.where(hit, t, np.inf)
+
+def box_distances(origins: np.ndarray, directions: np.ndarray, lows: np.ndarray, highs: np.ndarray,
+                  fudge = 10e-5) -> np.ndarray:
+    """Slab intersection of rays with axis-aligned boxes. Like `sphere_distances`, a ray that starts
+    inside a box hits it where it leaves. The arguments broadcast against each other like those of
+    `sphere_distances`.
+
+    Args:
+        lows, highs (np.ndarray): the corners of each box with the smallest and largest coordinates
+
+    Returns:
+        np.ndarray: distance along each ray to each box, `np.inf` where there is no hit
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        inverse = 1 / directions
+        to_low = (lows - origins) * inverse
+        to_high = (highs - origins) * inverse
+    # a ray is inside every slab between where it enters the last one and leaves the first one
+    enter = np.minimum(to_low, to_high).max(axis=-1)
+    leave = np.maximum(to_low, to_high).min(axis=-1)
+    distances = np.where(enter > fudge, enter, leave)
+    return np.where((enter <= leave) & (distances > fudge), distances, np.inf)
+
+def box_normals(points: np.ndarray, lows: np.ndarray, highs: np.ndarray) -> np.ndarray:
+    """The outward normal of the face of each box closest to each point, broadcasting like `box_distances`"""
+    # distance to the low faces, then to the high faces
+    to_faces = np.concatenate([np.abs(points - lows), np.abs(points - highs)], axis=-1)
+    face = np.argmin(to_faces, axis=-1)
+    normals = np.zeros(np.shape(face) + (3,))
+    np.put_along_axis(normals, (face % 3)[..., np.newaxis], np.where(face < 3, -1.0, 1.0)[..., np.newaxis], axis=-1)
+    return normals
+
+def _rough_normal(normal: np.ndarray, roughness: float, rng: Optional[np.random.Generator]) -> np.ndarray:
+    """Normalizes `normal` and applies gausian roughness to it, see `Sphere.normal_at_point`"""
+    normalized_normal = normal / np.linalg.norm(normal)
+    gausian_normal = (np.random if rng is None else rng).normal(normalized_normal, roughness)
+    return gausian_normal / np.linalg.norm(gausian_normal)
+
 @dataclasses.dataclass
 class _SphereFields:
     center: np.ndarray
@@ -68,12 +218,114 @@ class Sphere(Shape, _SphereFields):
         else:
             return t_c - t_offset
 
-    def normal_at_point(self, point: np.ndarray) -> np.ndarray:
+    def occludes(self, ray: Ray, max_distance: float, fudge = 10e-5) -> bool:
+        """See `Shape.occludes`. Rays that point away from the sphere or only reach it past
+        `max_distance` are rejected before the full intersection is worked out.
+        """
+        to_center = self.center - ray.origin
+        if np.dot(to_center, to_center) >= self.radius ** 2:
+            t_c = np.dot(to_center, ray.direction)
+            # a ray from outside enters the sphere no sooner than t_c - radius
+            if t_c < 0 or t_c - self.radius > max_distance:
+                return False
+        return super().occludes(ray, max_distance, fudge)
+
+    def occludes_many(self, origins: np.ndarray, directions: np.ndarray, max_distances: np.ndarray,
+                      fudge = 10e-5) -> np.ndarray:
+        """See `Shape.occludes_many`"""
+        return sphere_distances(origins, directions, self.center, self.radius, fudge) < max_distances
+
+    def normal_at_point(self, point: np.ndarray, rng: Optional[np.random.Generator] = None) -> np.ndarray:
+        """The normal at `point` with gausian roughness applied, drawn from `rng` or from the
+        global random state when it is None
+        """
         # TODO: Figure out a better way to ensure point shape
         assert point.shape == (3,)
         normal = point - self.center
         normalized_normal = normal / np.linalg.norm(normal)
         # apply gausian roughness
-        gausian_normal = np.random.normal(normalized_normal, self.roughness)
+        gausian_normal = (np.random if rng is None else rng).normal(normalized_normal, self.roughness)
         # Renormalize
-        return gausian_normal / np.linalg.norm(gausian_normal)
\ No newline at end of file
+        return gausian_normal / np.linalg.norm(gausian_normal)
+
+@dataclasses.dataclass
+class _TriangleFields:
+    p0: np.ndarray
+    p1: np.ndarray
+    p2: np.ndarray
+
+@dataclasses.dataclass
+class Triangle(Shape, _TriangleFields):
+    """A flat triangle with corners `p0`, `p1` and `p2`, seen from both sides
+    """
+    two_sided: ClassVar[bool] = True
+
+    def intersection(self, ray: Ray) -> Optional[float]:
+        """Will find an intersection or fail, see `triangle_distances`
+
+        Returns:
+            float: distance to intersection point from origin
+        """
+        distance = triangle_distances(ray.origin, ray.direction, self.p0, self.p1 - self.p0, self.p2 - self.p0, -math.inf)
+        if math.isinf(distance):
+            return
+        return float(distance)
+
+    def normal_at_point(self, point: np.ndarray, rng: Optional[np.random.Generator] = None) -> np.ndarray:
+        """The normal of the plane of the triangle, following the right hand rule from `p0` to `p1`
+        to `p2`, with gausian roughness applied like `Sphere.normal_at_point`
+        """
+        return _rough_normal(np.cross(self.p1 - self.p0, self.p2 - self.p0), self.roughness, rng)
+
+@dataclasses.dataclass
+class _PlaneFields:
+    normal: np.ndarray
+    offset: float
+
+@dataclasses.dataclass
+class Plane(Shape, _PlaneFields):
+    """The infinite plane of the points x with `normal . x + offset = 0`, seen from both sides
+    """
+    two_sided: ClassVar[bool] = True
+
+    def intersection(self, ray: Ray) -> Optional[float]:
+        """Will find an intersection or fail, see `plane_distances`
+
+        Returns:
+            float: distance to intersection point from origin
+        """
+        distance = plane_distances(ray.origin, ray.direction, self.normal, self.offset, -math.inf)
+        if math.isinf(distance):
+            return
+        return float(distance)
+
+    def normal_at_point(self, point: np.ndarray, rng: Optional[np.random.Generator] = None) -> np.ndarray:
+        """`normal`, with gausian roughness applied like `Sphere.normal_at_point`"""
+        return _rough_normal(self.normal, self.roughness, rng)
+
+@dataclasses.dataclass
+class _BoxFields:
+    low: np.ndarray
+    high: np.ndarray
+
+@dataclasses.dataclass
+class Box(Shape, _BoxFields):
+    """An axis-aligned box from the corner `low` to the corner `high`
+    """
+
+    def intersection(self, ray: Ray) -> Optional[float]:
+        """Will find an intersection or fail, see `box_distances`. Hits closer than the default
+        fudge are skipped here already, so a ray leaving the surface of the box does not hit it again
+        where it left.
+
+        Returns:
+            float: distance to intersection point from origin
+        """
+        distance = box_distances(ray.origin, ray.direction, self.low, self.high)
+        if math.isinf(distance):
+            return
+        return float(distance)
+
+    def normal_at_point(self, point: np.ndarray, rng: Optional[np.random.Generator] = None) -> np.ndarray:
+        """The outward normal of the face `point` is on, with gausian roughness applied like `Sphere.normal_at_point`"""
+        return _rough_normal(box_normals(point, self.low, self.high), self.roughness, rng)
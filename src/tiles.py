@@ -0,0 +1,186 @@
+"""Splits the image into tiles and renders them on a pool of worker processes.
+Workers write their tiles straight into a linear framebuffer in shared memory, which is
+converted to sRGB in one go once every tile is done. `antialias` and `cache` are only imported
+when a render uses them.
+"""
+import concurrent.futures
+import dataclasses
+import os
+from multiprocessing import shared_memory
+from typing import TYPE_CHECKING, Optional, Tuple, Union
+
+import numpy as np
+from PIL import Image
+from timeit import default_timer as timer
+
+import src.batch as batch
+import src.bvh as bvh
+import src.compiled as compiled_scene
+import src.instrument as instrument
+import src.jit as jit
+import src.sampling as sampling
+import src.scene as scene
+
+if TYPE_CHECKING:
+    import src.antialias as antialias
+
+TILE_SIZE = 32
+
+@dataclasses.dataclass
+class Tile():
+    """A rectangle of pixels rendered as one unit of work
+    \b index: position of the tile in the image, part of the key of its random numbers
+    \b x0, y0: the first column and row of the tile
+    \b x1, y1: one past the last column and row of the tile
+    """
+    index: int
+    x0: int
+    y0: int
+    x1: int
+    y1: int
+
+def make_tiles(width: int, height: int, tile_size: int = TILE_SIZE) -> "list[Tile]":
+    """Covers a width x height image with tiles of at most tile_size x tile_size pixels.
+    The layout only depends on the image size, never on the number of workers.
+    """
+    tiles = []
+    for x0 in range(0, width, tile_size):
+        for y0 in range(0, height, tile_size):
+            x1 = min(x0 + tile_size, width)
+            y1 = min(y0 + tile_size, height)
+            tiles.append(Tile(len(tiles), x0, y0, x1, y1))
+    return tiles
+
+def render_tile(tile: Tile, compiled: compiled_scene.CompiledScene, meta: scene.SceneMata, seed: int = 0,
+                frame: int = 0) -> np.ndarray:
+    """Renders one tile. Its random numbers come from a generator keyed by the frame and the tile
+    index, so rough surfaces come out the same no matter which process renders the tile.
+
+    Returns:
+        np.ndarray: (y1 - y0, x1 - x0, 4) linear pixels of the tile, see `batch.trace_pixels`
+    """
+    xs, ys = np.meshgrid(np.arange(tile.x0, tile.x1), np.arange(tile.y0, tile.y1), indexing="ij")
+    xs, ys = xs.ravel(), ys.ravel()
+    pixels = np.zeros((tile.y1 - tile.y0, tile.x1 - tile.x0, 4), dtype=batch.FRAME_DTYPE)
+    rng = sampling.make_rng(seed, frame, tile.index)
+    pixels[ys - tile.y0, xs - tile.x0] = batch.trace_pixels(xs, ys, compiled, meta, rng)
+    return pixels
+
+### WORKER PROCESSES ###
+# State given to each worker once by `_init_worker`, instead of with every tile
+_worker_scene: Optional[compiled_scene.CompiledScene] = None
+_worker_meta: Optional[scene.SceneMata] = None
+_worker_seed: int = 0
+_worker_frame_index: int = 0
+_worker_memory: Optional[shared_memory.SharedMemory] = None
+_worker_frame: Optional[np.ndarray] = None
+
+def _init_worker(compiled: Union[compiled_scene.CompiledScene, str], meta: scene.SceneMata, seed: int, frame: int,
+                 memory_name: str, instrumented: bool = False, jitted: bool = False) -> None:
+    """`compiled` is either the scene or the path of a cache file to map it from"""
+    global _worker_scene, _worker_meta, _worker_seed, _worker_frame_index, _worker_memory, _worker_frame
+    if instrumented:
+        instrument.enable()
+        instrument.reset()
+    if jitted:
+        # one worker runs on each core already
+        jit.enable(threads=False)
+    if isinstance(compiled, str):
+        import src.cache as cache
+        _, _, compiled = cache.read(compiled)
+    _worker_scene = compiled
+    _worker_meta = meta
+    _worker_seed = seed
+    _worker_frame_index = frame
+    _worker_memory = shared_memory.SharedMemory(name=memory_name)
+    _worker_frame = np.ndarray((meta.height, meta.width, 4), dtype=batch.FRAME_DTYPE, buffer=_worker_memory.buf)
+
+def _render_tile_in_worker(tile: Tile) -> Tuple[int, "list[Tuple[bvh.QueryStats, bvh.QueryStats]]", Optional[dict]]:
+    """Renders a tile into the shared frame
+
+    Returns:
+        the tile index, the statistics of the tile for each BVH of the scene, and what
+        `instrument` recorded for the tile if it is enabled
+    """
+    trees = _worker_scene.trees()
+    for tree in trees:
+        tree.reset_stats()
+    pixels = render_tile(tile, _worker_scene, _worker_meta, _worker_seed, _worker_frame_index)
+    _worker_frame[tile.y0:tile.y1, tile.x0:tile.x1] = pixels
+    recorded = None
+    if instrument.enabled:
+        recorded = instrument.snapshot()
+        instrument.reset()
+    return tile.index, [(tree.closest_stats, tree.any_stats) for tree in trees], recorded
+
+def render_frame(compiled: compiled_scene.CompiledScene, meta: scene.SceneMata,
+                 workers: int = 1, tile_size: int = TILE_SIZE, seed: int = 0, frame: int = 0) -> np.ndarray:
+    """Renders every tile of the image, on `workers` processes when there is more than one.
+    The result only depends on `seed` and `frame`, never on the number of workers.
+    When the scene has BVHs, the query statistics of every worker are added into them, and so is
+    what `instrument` recorded in the workers when it is enabled.
+    Scenes loaded from a cache file are mapped by each worker instead of being copied to it.
+
+    Returns:
+        np.ndarray: (height, width, 4) linear framebuffer of the image, see `batch.encode`
+    """
+    tiles = make_tiles(meta.width, meta.height, tile_size)
+    shape = (meta.height, meta.width, 4)
+    if workers <= 1:
+        pixels = np.zeros(shape, dtype=batch.FRAME_DTYPE)
+        for tile in tiles:
+            pixels[tile.y0:tile.y1, tile.x0:tile.x1] = render_tile(tile, compiled, meta, seed, frame)
+        return pixels
+
+    memory = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)) * np.dtype(batch.FRAME_DTYPE).itemsize)
+    try:
+        shared_frame = np.ndarray(shape, dtype=batch.FRAME_DTYPE, buffer=memory.buf)
+        shared_frame[:] = 0
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_worker,
+            initargs=(compiled.cache_path or compiled, meta, seed, frame, memory.name, instrument.enabled, jit.enabled),
+        ) as pool:
+            for _, stats, recorded in pool.map(_render_tile_in_worker, tiles):
+                for tree, (closest_stats, any_stats) in zip(compiled.trees(), stats):
+                    tree.closest_stats += closest_stats
+                    tree.any_stats += any_stats
+                if recorded is not None:
+                    instrument.merge(recorded)
+        pixels = shared_frame.copy()
+        del shared_frame
+    finally:
+        memory.close()
+        memory.unlink()
+    return pixels
+
+def default_workers() -> int:
+    return os.cpu_count() or 1
+
+def raytrace_scene(compiled: compiled_scene.CompiledScene, meta: scene.SceneMata, image: Image,
+                   workers: int = 1, tile_size: int = TILE_SIZE, seed: int = 0,
+                   antialias_settings: Optional["antialias.Settings"] = None) -> None:
+    """Renders the scene tile by tile into `image`
+
+    Args:
+        compiled (compiled_scene.CompiledScene): the scene, with its BVH already built if it uses one
+        workers (int): the number of processes to render with, 0 for one per cpu
+        tile_size (int): the width and height of a tile in pixels
+        seed (int): seed for the random numbers used by rough surfaces
+        antialias_settings (antialias.Settings): refine the edges of the image this way, None for one ray per pixel
+    """
+    start = timer()
+    if workers <= 0:
+        workers = default_workers()
+    frame = render_frame(compiled, meta, workers, tile_size, seed)
+    if antialias_settings is not None:
+        import src.antialias as antialias
+        refined = antialias.refine(frame, compiled, meta, antialias_settings, seed)
+        print(f"Anti-aliased {refined} edge pixels")
+    image.paste(Image.fromarray(batch.encode(frame, meta), "RGBA"))
+    end = timer()
+    print(f"Elapsed raytracing time = {end-start}s")
+    print(compiled.summary())
+    for tree in compiled.trees():
+        print(tree.summary())
+    if instrument.enabled:
+        print(instrument.report())
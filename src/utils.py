@@ -1,7 +1,10 @@
+import argparse
 import dataclasses
-from typing import Any
+import os
+from typing import TYPE_CHECKING, Any, Optional
 
-from PIL import Image
+if TYPE_CHECKING:
+    from PIL import Image
 
 
 @dataclasses.dataclass
@@ -40,10 +43,114 @@ def object_to_list(object) -> "list[Any]":
 ### STUFF FOR ARG PARSING ###
 @dataclasses.dataclass
 class CmdLineArgs():
-    file: str
+    """Options given on the command line
+    \b files: the scene files to render, or directories of them
+    \b engine: which renderer to use. `reference` is the original per-pixel renderer.
+    \b workers: the number of processes the batch renderer uses, 0 for one per cpu
+    \b accel: acceleration structure for the batch renderer, `auto` builds a BVH for larger scenes
+    \b cache_dir: directory of compiled scene caches for the batch renderer, None to always parse
+    \b progressive: render in coarse to fine passes, writing previews to the output file
+    \b time_budget: seconds after which a progressive render keeps the best image so far, None for no limit
+    \b preview_interval: the least number of seconds between two previews of a progressive render
+    \b stats: print ray counts and stage times after rendering
+    \b stats_json: also write the ray counts and stage times to this JSON file
+    \b seed: seed for the random numbers of rough surfaces, the same seed always gives the same image
+    \b samples: samples per pixel on rough surfaces, None to use the `samples` line of the scene file
+    \b antialias: fire extra jittered rays into the pixels on edges, see `antialias`
+    \b aa_threshold: the contrast between neighbors, as a fraction of 255, above which a pixel is on an edge
+    \b aa_samples: extra rays for each edge pixel
+    \b aa_max_samples: the most extra rays for the whole image, None for one per pixel
+    \b jit: use the compiled kernels of `jit` in the batch renderer when Numba is installed
+    \b output_dir: directory to write the images of every scene to, None to write them where the scene files say
+    """
+    files: "list[str]"
+    engine: str = "batch"
+    workers: int = 1
+    accel: str = "auto"
+    cache_dir: Optional[str] = None
+    progressive: bool = False
+    time_budget: Optional[float] = None
+    preview_interval: float = 1.0
+    stats: bool = False
+    stats_json: Optional[str] = None
+    seed: int = 0
+    samples: Optional[int] = None
+    antialias: bool = False
+    aa_threshold: float = 0.1
+    aa_samples: int = 4
+    aa_max_samples: Optional[int] = None
+    jit: bool = False
+    output_dir: Optional[str] = None
+
+    @property
+    def file(self) -> str:
+        return self.files[0]
+
+    @property
+    def is_many(self) -> bool:
+        """Whether the scenes are rendered one per worker by `corpus`, instead of one scene over every worker"""
+        return len(self.files) > 1 or os.path.isdir(self.files[0]) or self.output_dir is not None
+
+ENGINES = ("batch", "reference")
+ACCELS = ("auto", "bvh", "none")
 
 def parse_args(args: list) -> CmdLineArgs:
-    return CmdLineArgs(file = args[1])
+    parser = argparse.ArgumentParser(prog=args[0] if args else None)
+    parser.add_argument("files", nargs="+", metavar="file",
+                        help="the scene file to render, or several of them, or directories of them")
+    parser.add_argument("--engine", choices=ENGINES, default=CmdLineArgs.engine,
+                        help="renderer to use (default: %(default)s)")
+    parser.add_argument("--workers", type=int, default=CmdLineArgs.workers,
+                        help="number of render processes, 0 for one per cpu (default: %(default)s). "
+                             "With many scenes each process renders whole scenes")
+    parser.add_argument("--output-dir", default=CmdLineArgs.output_dir,
+                        help="write the images of every scene, and a summary.json of their timings, to this directory")
+    parser.add_argument("--accel", choices=ACCELS, default=CmdLineArgs.accel,
+                        help="acceleration structure for the batch renderer (default: %(default)s)")
+    parser.add_argument("--cache-dir", default=CmdLineArgs.cache_dir,
+                        help="keep compiled scenes in this directory and reuse them while the scene file is unchanged")
+    parser.add_argument("--progressive", action="store_true",
+                        help="render coarse to fine, writing previews to the output file as it goes")
+    parser.add_argument("--time-budget", type=float, default=CmdLineArgs.time_budget,
+                        help="stop a progressive render after this many seconds with the best image so far (implies --progressive)")
+    parser.add_argument("--preview-interval", type=float, default=CmdLineArgs.preview_interval,
+                        help="seconds between previews of a progressive render (default: %(default)s)")
+    parser.add_argument("--stats", action="store_true",
+                        help="count rays and time the render stages, printing a report at the end")
+    parser.add_argument("--stats-json", default=CmdLineArgs.stats_json,
+                        help="write the ray counts and stage times to this JSON file (implies --stats)")
+    parser.add_argument("--seed", type=int, default=CmdLineArgs.seed,
+                        help="seed for the random numbers of rough surfaces (default: %(default)s)")
+    parser.add_argument("--samples", type=int, default=CmdLineArgs.samples,
+                        help="samples per pixel on rough surfaces, overriding the scene file")
+    parser.add_argument("--antialias", action="store_true",
+                        help="fire extra jittered rays into the pixels on edges")
+    parser.add_argument("--aa-threshold", type=float, default=CmdLineArgs.aa_threshold,
+                        help="contrast between neighbors, as a fraction of 255, that makes an edge (default: %(default)s)")
+    parser.add_argument("--aa-samples", type=int, default=CmdLineArgs.aa_samples,
+                        help="extra rays for each edge pixel (default: %(default)s)")
+    parser.add_argument("--aa-max-samples", type=int, default=CmdLineArgs.aa_max_samples,
+                        help="the most extra rays for the whole image (default: one per pixel)")
+    parser.add_argument("--jit", action="store_true",
+                        help="run the batch renderer's sphere, light and reflection loops as compiled kernels, "
+                             "if Numba is installed")
+    parsed = parser.parse_args(args[1:])
+    if parsed.stats_json is not None:
+        parsed.stats = True
+    if parsed.time_budget is not None:
+        parsed.progressive = True
+    if parsed.progressive and parsed.engine == "reference":
+        parser.error("--progressive needs the batch engine")
+    if parsed.samples is not None and parsed.samples < 1:
+        parser.error("--samples must be at least 1")
+    if parsed.antialias and (parsed.engine == "reference" or parsed.progressive):
+        parser.error("--antialias needs the batch engine without --progressive")
+    if parsed.jit and parsed.engine == "reference":
+        parser.error("--jit needs the batch engine")
+    cmnd_line_args = CmdLineArgs(**vars(parsed))
+    if cmnd_line_args.is_many and (parsed.engine == "reference" or parsed.progressive):
+        parser.error("Rendering many scenes needs the batch engine without --progressive")
+    return cmnd_line_args
 
 def make_filename_list(image_info: ImageInfo) -> "list[str]":
     # List of names for image files
@@ -58,5 +165,7 @@ def make_filename_list(image_info: ImageInfo) -> "list[str]":
 
 
 ### MAKING IMAGES ###
-def make_images(image_info: ImageInfo) -> Image.Image:
+def make_images(image_info: ImageInfo) -> "Image.Image":
+    # PIL is imported here so the command line starts without it
+    from PIL import Image
     return Image.new("RGBA", (image_info.width, image_info.height), (0,0,0,0))
@@ -1,11 +1,47 @@
+import base64
+import contextlib
+import copy
+import functools
+import http.client
+import io
+import json
+import math
+import os
+import subprocess
+import sys
+import tempfile
+import threading
 import unittest
+import unittest.mock
+import urllib.error
+import urllib.request
 
 import numpy as np
+from PIL import Image
 import src.utils as utils
 import src.vertex as vertex
 import src.colors as colors
 import src.scene as scene
 import src.shapes as shapes
+import src.light as light
+import src.optics as optics
+import src.raytracer as raytracer
+import src.batch as batch
+import src.bvh as bvh
+import src.compiled as compiled
+import src.tiles as tiles
+import src.file_parse as file_parse
+import src.cache as cache
+import src.animation as animation
+import src.progressive as progressive
+import src.benchmark as benchmark
+import src.instrument as instrument
+import src.sampling as sampling
+import src.antialias as antialias
+import src.jit as jit
+import src.camera as camera
+import src.corpus as corpus
+import src.server as server
 class TestVertex(unittest.TestCase):
     def test_convert_vertex_to_list(self):
         r = 255
@@ -152,6 +188,1203 @@ class TestShapes(unittest.TestCase):
         self.assertEqual(sphere_2.shininess, shine)
         self.assertEqual(sphere_2.roughness, rough)
         self.assertEqual(sphere_2.transparency, trans)
+
+    def test_occludes_matches_intersection(self):
+        sphere = shapes.Sphere(np.array([0, 0, -1]), 0.3, colors.RGBLinear())
+        rng = np.random.default_rng(0)
+        origins = rng.uniform(-1, 1, (200, 3))
+        directions = batch.normalize(rng.normal(size=(200, 3)))
+        max_distances = rng.uniform(0, 2, 200)
+        expected = []
+        for origin, direction, max_distance in zip(origins, directions, max_distances):
+            ray = shapes.Ray(origin, direction)
+            distance = sphere.intersection(ray)
+            expected.append(bool(distance) and 10e-5 < distance < max_distance)
+            self.assertEqual(sphere.occludes(ray, max_distance), expected[-1])
+        np.testing.assert_array_equal(sphere.occludes_many(origins, directions, max_distances), expected)
+
+    def test_any_occluder_stops_at_first_blocker(self):
+        blocker = shapes.Sphere(np.array([0, 0, -1]), 0.3, colors.RGBLinear())
+        other = shapes.Sphere(np.array([0, 0, -3]), 0.3, colors.RGBLinear())
+        ray = shapes.Ray(np.array([0, 0, 0]), np.array([0, 0, -1]))
+        with unittest.mock.patch.object(other, "occludes") as other_occludes:
+            self.assertTrue(shapes.any_occluder([blocker, other], ray, math.inf))
+            other_occludes.assert_not_called()
+        self.assertFalse(shapes.any_occluder([blocker, other], ray, 0.5))
         
 
 
+
+def make_test_scene(width: int = 20, height: int = 16):
+    """A small scene with overlapping spheres, a sun, a bulb and a reflective surface"""
+    meta = scene.SceneMata(height=height, width=width)
+    objects = scene.SceneObjects()
+    objects.shapes.append(shapes.Sphere(np.array([0, 0, -1]), 0.3, colors.RGBLinear(1, 0.5, 0.2)))
+    objects.shapes.append(shapes.Sphere(np.array([0.5, 0.3, -1.5]), 0.5, colors.RGBLinear(0.2, 1, 1), shininess=0.4))
+    objects.shapes.append(shapes.Sphere(np.array([0, -101, -1]), 100, colors.RGBLinear(1, 1, 1)))
+    objects.lights.append(light.Sun(np.array([1, 1, 1]), colors.RGBLinear(1, 1, 1)))
+    objects.lights.append(light.Bulb(np.array([-1, 1, 0]), colors.RGBLinear(0.5, 0.5, 0.2)))
+    return objects, meta
+
+def render_compiled(objects, meta, image):
+    batch.raytrace_scene(compiled.compile_scene(objects), meta, image)
+
+def render(renderer, objects, meta) -> np.ndarray:
+    """Renders without the throughput cutoff of the array renderers, so they match the reference exactly"""
+    image = utils.make_images(utils.ImageInfo(filename="", width=meta.width, height=meta.height))
+    with contextlib.redirect_stdout(io.StringIO()), unittest.mock.patch.object(batch, "MIN_THROUGHPUT", 0):
+        renderer(objects, meta, image)
+    return np.asarray(image)
+
+def count_intersections(shape: shapes.Shape, ray: shapes.Ray) -> dict:
+    """What `instrument` counted for one call of `shape.intersection`"""
+    instrument.enable()
+    try:
+        shape.intersection(ray)
+        return dict(instrument.counters)
+    finally:
+        instrument.disable()
+        instrument.reset()
+
+class TestBatch(unittest.TestCase):
+    def test_intersect_spheres_matches_sphere_intersection(self):
+        objects, meta = make_test_scene()
+        scene_arrays = compiled.compile_scene(objects)
+        rng = np.random.default_rng(0)
+        origins = rng.uniform(-1, 1, (50, 3))
+        directions = batch.normalize(rng.normal(size=(50, 3)))
+        distances = batch.intersect_spheres(origins, directions, scene_arrays.centers, scene_arrays.radii)
+        for i in range(len(origins)):
+            ray = shapes.Ray(origins[i], directions[i])
+            for j, sphere in enumerate(objects.shapes):
+                expected = sphere.intersection(ray)
+                if expected and expected > 10e-5:
+                    self.assertAlmostEqual(distances[i, j], expected)
+                else:
+                    self.assertEqual(distances[i, j], np.inf)
+
+    def test_matches_reference_renderer(self):
+        for lense in scene.Lense:
+            objects, meta = make_test_scene()
+            meta.lense = lense
+            expected = render(raytracer.raytrace_scene, objects, meta)
+            actual = render(render_compiled, objects, meta)
+            np.testing.assert_array_equal(expected, actual)
+
+    def test_shade_matches_lambert(self):
+        objects, meta = make_test_scene()
+        # a point on top of the first sphere, lit by both lights with nothing in the way
+        point = np.array([0, 0.3, -1.0])
+        normal = np.array([0, 1.0, 0])
+        expected = np.zeros(3)
+        for light_source in objects.lights:
+            direction = light_source.point if type(light_source) is light.Sun else light_source.point - point
+            ray = shapes.Ray(point, direction)
+            expected += light_source.lambert(ray, normal, objects.shapes[0].color).as_ndarray()
+        actual = batch.shade(point[np.newaxis], normal[np.newaxis], np.array([[1, 0.5, 0.2]]),
+                             compiled.compile_scene(objects))
+        np.testing.assert_allclose(actual[0], expected)
+
+    def test_deep_bounces_match_reference_renderer(self):
+        meta = scene.SceneMata(height=12, width=16)
+        meta.reflection_depth = 12
+        objects = scene.SceneObjects()
+        for x in (-1.2, 1.2):
+            objects.shapes.append(shapes.Sphere(np.array([x, 0, -2]), 1.0, colors.RGBLinear(0.6, 0.8, 1), shininess=0.9))
+        objects.shapes.append(shapes.Sphere(np.array([0, 0.8, -2.5]), 0.4, colors.RGBLinear(1, 0.2, 0.2), shininess=0.5))
+        objects.lights.append(light.Sun(np.array([0, 1, 1]), colors.RGBLinear(1, 1, 1)))
+        np.testing.assert_array_equal(render(raytracer.raytrace_scene, objects, meta), render(render_compiled, objects, meta))
+
+    def test_weak_reflections_are_not_traced(self):
+        objects, meta = make_test_scene()
+        scene_arrays = compiled.compile_scene(objects)
+        xs, ys = batch.pixel_grid(meta)
+        directions = camera.eye_rays(xs, ys, meta)[0]
+        origins = np.zeros_like(directions)
+        # the only shiny sphere has a shininess of 0.4
+        skipped, _, _ = batch.trace_rays(origins, directions, scene_arrays, meta, min_throughput=0.5)
+        meta.reflection_depth = 0
+        flat, _, _ = batch.trace_rays(origins, directions, scene_arrays, meta)
+        np.testing.assert_array_equal(skipped, flat)
+
+    def test_linear_to_srgb_matches_per_pixel_conversion(self):
+        rng = np.random.default_rng(4)
+        linear = np.concatenate([rng.uniform(-0.5, 3, (500, 3)), rng.integers(0, 2, (500, 1))], axis=1)
+        # values on both sides of the gamma curve's knee and of a rounding step
+        linear[0, :3] = [0.0031308, 0.0031309, 0]
+        linear[1, :3] = [np.nan, np.inf, -np.inf]
+        linear[2, :3] = 0.5 / 255 / 12.92
+        for exposure in (scene.no_exposure, functools.partial(scene.expose, 2.5)):
+            expected = []
+            for pixel in linear:
+                color = colors.color_from_ndarray(pixel)
+                color.a = pixel[3]
+                color.apply_exposure(exposure)
+                converted = color.as_rgb(rounded=True)
+                expected.append([converted.r, converted.g, converted.b, converted.a])
+            with np.errstate(invalid="ignore"):
+                np.testing.assert_array_equal(colors.linear_to_srgb(linear, exposure), expected)
+
+    def test_occluded(self):
+        objects, meta = make_test_scene()
+        scene_arrays = compiled.compile_scene(objects)
+        origins = np.array([[0, 0, 0], [0, 0, 0], [0, 0, 0]], dtype=float)
+        directions = np.array([[0, 0, -1], [0, 0, -1], [0, 0, 1]], dtype=float)
+        # the first sphere is 0.7 away along -z, nothing is along +z
+        max_distances = np.array([np.inf, 0.5, np.inf])
+        np.testing.assert_array_equal(batch.find_occluded(scene_arrays, origins, directions, max_distances),
+                                      [True, False, False])
+
+class TestTiles(unittest.TestCase):
+    def test_make_tiles_covers_image(self):
+        covered = np.zeros((37, 70), dtype=int)
+        for tile in tiles.make_tiles(70, 37, 16):
+            covered[tile.y0:tile.y1, tile.x0:tile.x1] += 1
+        np.testing.assert_array_equal(covered, 1)
+
+    def test_worker_count_does_not_change_rough_image(self):
+        objects, meta = make_test_scene(24, 20)
+        for shape in objects.shapes:
+            shape.roughness = 0.1
+        file_parse.parse_line(["expose", "2"], objects, meta)
+        scene_arrays = compiled.compile_scene(objects)
+        single = tiles.render_frame(scene_arrays, meta, workers=1, tile_size=8, seed=3)
+        pooled = tiles.render_frame(scene_arrays, meta, workers=2, tile_size=8, seed=3)
+        np.testing.assert_array_equal(single, pooled)
+        self.assertTrue(single[..., 3].any())
+
+class TestSampling(unittest.TestCase):
+    def rough_scene(self, samples: int = 1):
+        objects, meta = make_test_scene(24, 20)
+        for shape in objects.shapes:
+            shape.roughness = 0.1
+        file_parse.parse_line(["samples", str(samples)], objects, meta)
+        return compiled.compile_scene(objects), meta
+
+    def test_generators_depend_only_on_seed_and_key(self):
+        np.testing.assert_array_equal(sampling.make_rng(3, 1, 2).random(5), sampling.make_rng(3, 1, 2).random(5))
+        self.assertFalse(np.array_equal(sampling.make_rng(3, 1, 2).random(5), sampling.make_rng(3, 2, 1).random(5)))
+        self.assertFalse(np.array_equal(sampling.make_rng(3, 1, 2).random(5), sampling.make_rng(4, 1, 2).random(5)))
+
+    def test_rough_render_is_reproducible(self):
+        scene_arrays, meta = self.rough_scene(samples=3)
+        first = tiles.render_frame(scene_arrays, meta, tile_size=8, seed=5)
+        np.random.seed(0)
+        second = tiles.render_frame(scene_arrays, meta, tile_size=8, seed=5)
+        other_seed = tiles.render_frame(scene_arrays, meta, tile_size=8, seed=6)
+        np.testing.assert_array_equal(first, second)
+        self.assertFalse(np.array_equal(first, other_seed))
+
+    def test_samples_do_not_change_smooth_surfaces(self):
+        objects, meta = make_test_scene()
+        scene_arrays = compiled.compile_scene(objects)
+        xs, ys = batch.pixel_grid(meta)
+        single = batch.trace_pixels(xs, ys, scene_arrays, meta, sampling.make_rng(0))
+        meta.samples = 8
+        np.testing.assert_array_equal(batch.trace_pixels(xs, ys, scene_arrays, meta, sampling.make_rng(0)), single)
+
+    def test_more_samples_reduce_noise(self):
+        scene_arrays, meta = self.rough_scene()
+        xs, ys = batch.pixel_grid(meta)
+        def spread(samples: int) -> float:
+            meta.samples = samples
+            renders = [batch.trace_pixels(xs, ys, scene_arrays, meta, sampling.make_rng(seed)) for seed in range(6)]
+            return np.std(renders, axis=0).mean()
+        self.assertLess(spread(8), spread(1) / 2)
+
+class TestAntialias(unittest.TestCase):
+    def test_find_edges_marks_both_sides(self):
+        srgba = np.zeros((4, 6, 4), dtype=np.uint8)
+        srgba[:, 3:] = 255
+        contrast = antialias.find_edges(srgba)
+        np.testing.assert_array_equal(contrast > 0, np.repeat([[False, False, True, True, False, False]], 4, axis=0))
+
+    def test_cap_keeps_strongest_edges(self):
+        contrast = np.array([[0.5, 0.2, 0.9], [0.0, 0.3, 0.05]])
+        xs, ys = antialias.select_pixels(contrast, antialias.Settings(threshold=0.1, samples=2, max_samples=5))
+        np.testing.assert_array_equal(contrast[ys, xs], [0.5, 0.9])
+
+    def test_refines_only_edges_towards_supersampled_image(self):
+        objects, meta = make_test_scene()
+        scene_arrays = compiled.compile_scene(objects)
+        frame = tiles.render_frame(scene_arrays, meta)
+        single = frame.copy()
+        settings = antialias.Settings(samples=8)
+        refined = antialias.refine(frame, scene_arrays, meta, settings, seed=1)
+        changed = (frame != single).any(axis=-1)
+        self.assertGreater(refined, 0)
+        self.assertLessEqual(changed.sum(), refined)
+        self.assertLess(refined, meta.width * meta.height / 2)
+
+        # 8x8 samples in every pixel, around the corner the first ray goes through
+        offsets = (np.arange(8) + 0.5) / 8 - 0.5
+        xs, ys = batch.pixel_grid(meta)
+        samples = np.zeros((meta.height, meta.width, 4))
+        for dx in offsets:
+            for dy in offsets:
+                samples[ys, xs] += batch.trace_pixels(xs + dx, ys + dy, scene_arrays, meta)
+        coverage = samples[..., 3:]
+        supersampled = np.concatenate([samples[..., :3] / np.maximum(coverage, 1), coverage / 64], axis=-1)
+        def error(image: np.ndarray) -> float:
+            return np.abs(batch.encode(image, meta).astype(int) - batch.encode(supersampled, meta)).mean()
+        self.assertLess(error(frame), error(single) * 0.8)
+
+    def test_refine_is_reproducible(self):
+        objects, meta = make_test_scene()
+        scene_arrays = compiled.compile_scene(objects)
+        first = tiles.render_frame(scene_arrays, meta)
+        second = first.copy()
+        antialias.refine(first, scene_arrays, meta, antialias.Settings(), seed=2)
+        antialias.refine(second, scene_arrays, meta, antialias.Settings(), seed=2)
+        np.testing.assert_array_equal(first, second)
+
+class TestCamera(unittest.TestCase):
+    def test_bundle_matches_make_eye_ray(self):
+        for lense in scene.Lense:
+            meta = scene.SceneMata(height=12, width=24, lense=lense)
+            xs, ys = batch.pixel_grid(meta)
+            directions, valid = camera.eye_rays(xs, ys, meta)
+            for x, y, direction, shoots in zip(xs, ys, directions, valid):
+                ray = raytracer.make_eye_ray(x, y, meta)
+                self.assertEqual(ray is not None, shoots)
+                if ray is not None:
+                    np.testing.assert_allclose(direction, ray.direction, atol=1e-12)
+            if lense == scene.Lense.fisheye:
+                self.assertFalse(valid.all())
+
+    def test_bundles_are_cached_per_camera_and_resolution(self):
+        meta = scene.SceneMata(height=8, width=10)
+        bundle = camera.frame_rays(camera.Camera.from_meta(meta), 10, 8)
+        self.assertIs(camera.frame_rays(camera.Camera.from_meta(copy.deepcopy(meta)), 10, 8), bundle)
+        self.assertIsNot(camera.frame_rays(camera.Camera.from_meta(meta), 10, 9), bundle)
+        meta.lense = scene.Lense.panorama
+        self.assertIsNot(camera.frame_rays(camera.Camera.from_meta(meta), 10, 8), bundle)
+
+    def test_jittered_positions_between_pixels(self):
+        meta = scene.SceneMata(height=8, width=10)
+        xs, ys = np.array([3, 3.5]), np.array([2, 2.25])
+        directions, valid = camera.eye_rays(xs, ys, meta)
+        np.testing.assert_array_equal(directions[0], camera.eye_rays(np.array([3]), np.array([2]), meta)[0][0])
+        self.assertTrue(valid.all())
+        self.assertFalse(np.array_equal(directions[0], directions[1]))
+
+class TestBVH(unittest.TestCase):
+    def make_spheres(self, count: int = 300) -> "compiled.CompiledScene":
+        rng = np.random.default_rng(1)
+        objects = scene.SceneObjects()
+        for center, radius in zip(rng.uniform(-5, 5, (count, 3)), rng.uniform(0.05, 0.4, count)):
+            objects.shapes.append(shapes.Sphere(center, radius, colors.RGBLinear()))
+        return compiled.compile_scene(objects, accel="none")
+
+    def test_leaves_hold_every_shape_once(self):
+        spheres = self.make_spheres()
+        tree = spheres.build_bvh()
+        leaves = np.flatnonzero(tree.left < 0)
+        held = np.concatenate([tree.order[tree.start[l]:tree.start[l] + tree.count[l]] for l in leaves])
+        np.testing.assert_array_equal(np.sort(held), np.arange(spheres.n_spheres))
+        self.assertTrue((tree.count[leaves] <= bvh.LEAF_SIZE).all())
+
+    def test_queries_match_linear_scan(self):
+        spheres = self.make_spheres()
+        rng = np.random.default_rng(2)
+        origins = rng.uniform(-6, 6, (500, 3))
+        directions = batch.normalize(rng.normal(size=(500, 3)))
+        max_distances = rng.uniform(0, 8, 500)
+        expected_index, expected_distance = batch.find_closest(spheres, origins, directions)
+        expected_blocked = batch.find_occluded(spheres, origins, directions, max_distances)
+        spheres.build_bvh()
+        index, distance = batch.find_closest(spheres, origins, directions)
+        np.testing.assert_array_equal(index, expected_index)
+        np.testing.assert_array_equal(distance, expected_distance)
+        np.testing.assert_array_equal(batch.find_occluded(spheres, origins, directions, max_distances), expected_blocked)
+        self.assertLess(spheres.tree.closest_stats.primitive_tests, 500 * spheres.n_spheres)
+
+    def test_spheres_after_the_tree_are_still_hit(self):
+        spheres = self.make_spheres()
+        rng = np.random.default_rng(3)
+        origins = rng.uniform(-6, 6, (500, 3))
+        directions = batch.normalize(rng.normal(size=(500, 3)))
+        max_distances = rng.uniform(0, 8, 500)
+        expected_index, expected_distance = batch.find_closest(spheres, origins, directions)
+        expected_blocked = batch.find_occluded(spheres, origins, directions, max_distances)
+        # a BVH over only the first 200 spheres
+        spheres.tree = bvh.build(spheres.centers[:200] - spheres.radii[:200, np.newaxis],
+                                 spheres.centers[:200] + spheres.radii[:200, np.newaxis])
+        index, distance = batch.find_closest(spheres, origins, directions)
+        np.testing.assert_array_equal(index, expected_index)
+        np.testing.assert_array_equal(distance, expected_distance)
+        np.testing.assert_array_equal(batch.find_occluded(spheres, origins, directions, max_distances), expected_blocked)
+
+class TestTriangles(unittest.TestCase):
+    SCENE = "\n".join([
+        "png 30 20 out.png",
+        "xyz -1 -1 -2",
+        "xyz 1 -1 -2",
+        "xyz 0 1 -2",
+        "sun 1 1 1",
+        "color 1 0 0",
+        "trif 1 2 3",
+        "sphere 0 0 -1 0.25",
+        "xyz 2 1 -3",
+        "shininess 0.5",
+        "trif -1 3 -2",
+        "sphere 1 1 -2 0.5",
+    ])
+
+    def make_scene(self):
+        """`make_test_scene` with a mirror behind the spheres and a triangle facing away from the eye"""
+        objects, meta = make_test_scene()
+        objects.shapes.append(shapes.Triangle(np.array([-2, -1, -3]), np.array([2, -1, -3]), np.array([0, 2, -3]),
+                                              colors.RGBLinear(0.8, 0.8, 0.8), shininess=0.5))
+        objects.shapes.append(shapes.Triangle(np.array([-0.6, 0.4, -1.2]), np.array([-0.3, 0.7, -1.2]),
+                                              np.array([-0.9, 0.7, -1.2]), colors.RGBLinear(0.2, 0.4, 1)))
+        return objects, meta
+
+    def test_instrument_counts_triangle_hits(self):
+        triangle = shapes.Triangle(np.array([0, 0, -2]), np.array([1, 0, -2]), np.array([0, 1, -2]),
+                                   colors.RGBLinear())
+        counts = count_intersections(triangle, shapes.Ray(np.zeros(3), np.array([0.25, 0.25, -2])))
+        self.assertEqual((counts["intersection tests"], counts["intersection hits"]), (1, 1))
+
+    def test_triangle_distances(self):
+        corner, edge1, edge2 = np.array([0, 0, -2]), np.array([1, 0, 0]), np.array([0, 1, 0])
+        origins = np.zeros((3, 3))
+        directions = batch.normalize(np.array([[0.25, 0.25, -2], [1, 1, -2], [0, 0, 1]]))
+        distances = shapes.triangle_distances(origins, directions, corner, edge1, edge2)
+        self.assertAlmostEqual(distances[0], np.linalg.norm([0.25, 0.25, -2]))
+        np.testing.assert_array_equal(distances[1:], [np.inf, np.inf])
+
+    def test_matches_reference_renderer(self):
+        objects, meta = self.make_scene()
+        expected = render(raytracer.raytrace_scene, objects, meta)
+        actual = render(render_compiled, objects, meta)
+        np.testing.assert_array_equal(expected, actual)
+
+    def test_queries_match_linear_scan(self):
+        rng = np.random.default_rng(4)
+        objects = scene.SceneObjects()
+        for corner in rng.uniform(-5, 5, (300, 3)):
+            p1, p2 = corner + rng.uniform(-0.5, 0.5, (2, 3))
+            objects.shapes.append(shapes.Triangle(corner, p1, p2, colors.RGBLinear()))
+        triangles = compiled.compile_scene(objects, accel="none")
+        origins = rng.uniform(-6, 6, (500, 3))
+        directions = batch.normalize(rng.normal(size=(500, 3)))
+        max_distances = rng.uniform(0, 8, 500)
+        expected_index, expected_distance = batch.find_closest(triangles, origins, directions)
+        expected_blocked = batch.find_occluded(triangles, origins, directions, max_distances)
+        triangles.build_bvh()
+        index, distance = batch.find_closest(triangles, origins, directions)
+        np.testing.assert_array_equal(index, expected_index)
+        np.testing.assert_array_equal(distance, expected_distance)
+        np.testing.assert_array_equal(batch.find_occluded(triangles, origins, directions, max_distances), expected_blocked)
+        self.assertLess(triangles.triangle_tree.closest_stats.primitive_tests, 500 * triangles.n_triangles)
+
+    def test_stream_scene_matches_dataclass_parse(self):
+        _, _, objects = file_parse.parse_file(io.StringIO(self.SCENE))
+        expected = compiled.compile_scene(objects)
+        for batch_size in (1, 2, 1 << 16):
+            with unittest.mock.patch.object(file_parse, "SPHERE_BATCH_SIZE", batch_size):
+                _, _, actual = file_parse.stream_scene(io.StringIO(self.SCENE))
+            self.assertEqual(len(actual.vertices), 4)
+            np.testing.assert_array_equal(actual.vertices[actual.triangles], expected.vertices[expected.triangles])
+            for field in compiled.SPHERE_FIELDS + compiled.MATERIAL_FIELDS + compiled.ORDER_FIELDS:
+                np.testing.assert_array_equal(getattr(actual, field), getattr(expected, field), field)
+
+    def test_missing_vertex(self):
+        with self.assertRaises(IndexError):
+            file_parse.stream_scene(io.StringIO("png 1 1 out.png\nxyz 0 0 0\ntrif 1 1 2"))
+        vertices = "xyz 0 0 0\nxyz 1 0 0\nxyz 0 1 0\n"
+        # vertex 0, and vertices that only come after the triangle in the same batch
+        for text in (vertices + "trif 0 1 2", vertices + "trif 1 2 4\nxyz 1 1 0", vertices + "trif -4 1 2\nxyz 1 1 0"):
+            text = "png 1 1 out.png\n" + text
+            with self.assertRaises(IndexError, msg=text):
+                file_parse.stream_scene(io.StringIO(text))
+            with self.assertRaises(IndexError, msg=text):
+                file_parse.parse_file(io.StringIO(text))
+
+    def test_cache_round_trip(self):
+        with tempfile.TemporaryDirectory() as directory:
+            scene_path = os.path.join(directory, "scene.txt")
+            with open(scene_path, "w") as file:
+                file.write(self.SCENE)
+            with open(scene_path) as file:
+                _, _, expected = file_parse.stream_scene(file, "bvh")
+            cache_dir = os.path.join(directory, "cache")
+            cache.load_scene(scene_path, cache_dir, "bvh")
+            _, _, actual = cache.load_scene(scene_path, cache_dir, "bvh")
+            for field in compiled.ARRAY_FIELDS:
+                np.testing.assert_array_equal(getattr(actual, field), getattr(expected, field), field)
+            np.testing.assert_array_equal(actual.triangle_tree.order, expected.triangle_tree.order)
+
+class TestPlanesAndBoxes(unittest.TestCase):
+    SCENE = "\n".join([
+        "png 30 20 out.png",
+        "sun 1 1 1",
+        "color 0.5 0.5 0.5",
+        "plane 0 1 0 1",
+        "sphere 0 0 -2 0.5",
+        "color 1 0 0",
+        "shininess 0.3",
+        "box 1 1 -3 0.5 -1 -2",
+        "plane 1 0 0 4",
+        "sphere 1 1 -2 0.25",
+    ])
+
+    def test_instrument_counts_plane_and_box_hits(self):
+        ray = shapes.Ray(np.zeros(3), np.array([0, 0, -1.0]))
+        for shape in (shapes.Plane(np.array([0, 0, 1]), 2, colors.RGBLinear()),
+                      shapes.Box(np.array([-1, -1, -3]), np.array([1, 1, -2]), colors.RGBLinear())):
+            counts = count_intersections(shape, ray)
+            self.assertEqual((counts["intersection tests"], counts["intersection hits"]), (1, 1), shape)
+
+    def make_scene(self):
+        """`make_test_scene` with a shiny floor plane in place of the huge sphere, and a box"""
+        objects, meta = make_test_scene()
+        del objects.shapes[2]
+        objects.shapes.append(shapes.Plane(np.array([0, 1, 0]), 1, colors.RGBLinear(1, 1, 1), shininess=0.3))
+        objects.shapes.append(shapes.Box(np.array([-1, -0.9, -2.5]), np.array([-0.4, 0.2, -1.5]),
+                                         colors.RGBLinear(0.3, 1, 0.3)))
+        return objects, meta
+
+    def test_distances(self):
+        origins = np.zeros((3, 3))
+        directions = batch.normalize(np.array([[0, -1, -1], [0, 1, 0], [1, 0, 0]]))
+        np.testing.assert_allclose(shapes.plane_distances(origins, directions, np.array([0, 2, 0]), 2),
+                                   [math.sqrt(2), np.inf, np.inf])
+        box = np.array([-1, -1, -3]), np.array([1, 1, -2])
+        np.testing.assert_allclose(shapes.box_distances(origins, batch.normalize(np.array([[0, 0, -1], [0, 0, 1], [1, 0, -1]])), *box),
+                                   [2, np.inf, np.inf])
+        # a ray from inside the box hits it where it leaves
+        self.assertAlmostEqual(float(shapes.box_distances(np.array([0, 0, -2.5]), np.array([0, 1, 0]), *box)), 1)
+        np.testing.assert_array_equal(shapes.box_normals(np.array([[0, 0, -2], [1, 0.5, -2.5]]), *box),
+                                      [[0, 0, 1], [1, 0, 0]])
+
+    def test_matches_reference_renderer(self):
+        objects, meta = self.make_scene()
+        expected = render(raytracer.raytrace_scene, objects, meta)
+        actual = render(render_compiled, objects, meta)
+        np.testing.assert_array_equal(expected, actual)
+
+    def test_coplanar_ties_follow_scene_order(self):
+        # the top of the box lies in the plane, so rays reach both at the same distance
+        plane = "color 0.2 0.2 1\nplane 0 1 0 1"
+        box = "color 1 0.2 0.2\nbox -1 -1.5 -3 1 -1 -1"
+        images = []
+        for objects_text in (plane + "\n" + box, box + "\n" + plane):
+            text = "png 20 16 out.png\nsun 1 1 1\n" + objects_text
+            _, meta, objects = file_parse.parse_file(io.StringIO(text))
+            expected = render(raytracer.raytrace_scene, objects, meta)
+            np.testing.assert_array_equal(render(render_compiled, objects, meta), expected)
+            _, meta, streamed = file_parse.stream_scene(io.StringIO(text))
+            np.testing.assert_array_equal(
+                render(lambda objects, meta, image: batch.raytrace_scene(streamed, meta, image), objects, meta),
+                expected)
+            images.append(expected)
+        self.assertFalse(np.array_equal(*images))
+
+    def test_planes_stay_out_of_bvh(self):
+        rng = np.random.default_rng(5)
+        objects = scene.SceneObjects()
+        for low, size in zip(rng.uniform(-5, 5, (200, 3)), rng.uniform(0.05, 0.5, (200, 3))):
+            objects.shapes.append(shapes.Box(low, low + size, colors.RGBLinear()))
+        objects.shapes.append(shapes.Plane(np.array([0, 1, 0]), 6, colors.RGBLinear()))
+        boxes = compiled.compile_scene(objects, accel="none")
+        origins = rng.uniform(-6, 6, (500, 3))
+        directions = batch.normalize(rng.normal(size=(500, 3)))
+        max_distances = rng.uniform(0, 8, 500)
+        expected_index, expected_distance = batch.find_closest(boxes, origins, directions)
+        expected_blocked = batch.find_occluded(boxes, origins, directions, max_distances)
+        boxes.build_bvh()
+        self.assertEqual(boxes.box_tree.n_primitives, 200)
+        index, distance = batch.find_closest(boxes, origins, directions)
+        np.testing.assert_array_equal(index, expected_index)
+        np.testing.assert_array_equal(distance, expected_distance)
+        np.testing.assert_array_equal(batch.find_occluded(boxes, origins, directions, max_distances), expected_blocked)
+        self.assertIn(boxes.n_primitives - 1, index)
+
+    def test_stream_scene_matches_dataclass_parse(self):
+        _, _, objects = file_parse.parse_file(io.StringIO(self.SCENE))
+        expected = compiled.compile_scene(objects)
+        _, _, actual = file_parse.stream_scene(io.StringIO(self.SCENE))
+        self.assertEqual((actual.n_spheres, actual.n_boxes, actual.n_planes), (2, 1, 2))
+        np.testing.assert_array_equal(actual.box_lows, [[0.5, -1, -3]])
+        for field in compiled.ARRAY_FIELDS:
+            np.testing.assert_array_equal(getattr(actual, field), getattr(expected, field), field)
+
+class TestRefraction(unittest.TestCase):
+    SCENE = "\n".join([
+        "png 30 20 out.png",
+        "sun 1 1 1",
+        "sphere 0 0 -2 0.5",
+        "transparency 0.8",
+        "ior 1.3",
+        "box 1 1 -3 0.5 -1 -2",
+        "xyz 0 0 -1",
+        "xyz 1 0 -1",
+        "xyz 0 1 -1",
+        "trif 1 2 3",
+        "transparency 0",
+        "sphere 1 1 -2 0.25",
+    ])
+
+    def make_scene(self):
+        """`make_test_scene` with a glass ball in front, a glass sheet, and a floor to see through them"""
+        objects, meta = make_test_scene(width=24, height=20)
+        objects.shapes.append(shapes.Sphere(np.array([-0.3, 0.1, -0.8]), 0.25, colors.RGBLinear(0.9, 0.9, 1),
+                                            shininess=0.1, transparency=0.9, ior=1.5))
+        objects.shapes.append(shapes.Triangle(np.array([0.1, -0.5, -0.7]), np.array([0.6, -0.5, -0.7]),
+                                              np.array([0.3, 0.2, -0.6]), colors.RGBLinear(1, 1, 1),
+                                              transparency=0.6))
+        objects.shapes.append(shapes.Plane(np.array([0, 0, 1]), 4, colors.RGBLinear(0.4, 0.4, 1)))
+        meta.reflection_depth = 6
+        return objects, meta
+
+    def test_refract(self):
+        incident = batch.normalize(np.array([[1.0, -1, 0], [0, -1, 0], [1, -1, 0], [1, -0.2, 0], [1, -1, 0]]))
+        normals = np.array([[0, 1.0, 0], [0, 1, 0], [0, -1, 0], [0, -1, 0], [0, 1, 0]])
+        thin = np.array([False, False, False, False, True])
+        directions, reflectance = optics.refract(incident, normals, 1.5, thin)
+        directions = batch.normalize(directions)
+        # Snell's law going in and coming out, the ray leaves the surface when it meets the inside of the normal
+        self.assertAlmostEqual(directions[0, 0], math.sqrt(0.5) / 1.5)
+        self.assertAlmostEqual(directions[2, 0], 1)
+        np.testing.assert_allclose(directions[1], [0, -1, 0])
+        # normal incidence reflects ((n - 1)/(n + 1))**2, and too steep a way out reflects everything
+        self.assertAlmostEqual(reflectance[1], 0.04)
+        self.assertEqual(reflectance[3], 1)
+        # thin sheets do not bend rays
+        np.testing.assert_allclose(directions[4], incident[4])
+        self.assertGreater(reflectance[0], reflectance[1])
+
+    def test_fresnel_weights(self):
+        shininess, transmission = optics.fresnel_weights(np.array([0.3, 0.3, 0.0]), np.array([0.0, 0.5, 1.0]),
+                                                            np.array([0.2, 0.2, 1.0]))
+        # opaque surfaces keep their shininess, and everything that is not reflected goes through glass
+        np.testing.assert_allclose(shininess, [0.3, 0.37, 1.0])
+        np.testing.assert_allclose(transmission, [0.0, 0.4 / 0.9, 0.0])
+        # the weights of the surface color, the refraction and the reflection add up to one
+        color = (1 - transmission) * (1 - shininess)
+        np.testing.assert_allclose(color + transmission * (1 - shininess) + shininess, 1)
+        np.testing.assert_allclose(color, [0.7, 0.35, 0.0])
+
+    def test_matches_reference_renderer(self):
+        objects, meta = self.make_scene()
+        instrument.enable()
+        try:
+            expected = render(raytracer.raytrace_scene, objects, meta)
+            reference = dict(instrument.counters)
+            instrument.reset()
+            actual = render(render_compiled, objects, meta)
+            counts = dict(instrument.counters)
+        finally:
+            instrument.disable()
+            instrument.reset()
+        np.testing.assert_array_equal(expected, actual)
+        self.assertGreater(counts["refraction rays"], 0)
+        # the array renderer skips only the rays too weak to matter
+        self.assertLessEqual(counts["refraction rays"], reference["refraction rays"])
+
+    def test_bounces_limit_refraction(self):
+        objects, meta = self.make_scene()
+        scene_arrays = compiled.compile_scene(objects)
+        xs, ys = batch.pixel_grid(meta)
+        directions = camera.eye_rays(xs, ys, meta)[0]
+        origins = np.zeros_like(directions)
+        instrument.enable()
+        try:
+            meta.reflection_depth = 1
+            batch.trace_rays(origins, directions, scene_arrays, meta)
+            shallow = dict(instrument.counters)
+            instrument.reset()
+            meta.reflection_depth = 0
+            flat, _, _ = batch.trace_rays(origins, directions, scene_arrays, meta)
+            self.assertNotIn("refraction rays", instrument.counters)
+        finally:
+            instrument.disable()
+            instrument.reset()
+        # one level of reflection and refraction together costs at most a ray per hit of each
+        self.assertLessEqual(shallow["reflection rays"] + shallow["refraction rays"], 2 * len(xs))
+        skipped, _, _ = batch.trace_rays(origins, directions, scene_arrays, meta, min_throughput=2)
+        np.testing.assert_array_equal(skipped, flat)
+
+    def test_stream_scene_matches_dataclass_parse(self):
+        _, meta, objects = file_parse.parse_file(io.StringIO(self.SCENE))
+        self.assertEqual([(shape.transparency, shape.ior) for shape in objects.shapes],
+                         [(0.0, 1.458), (0.8, 1.3), (0.8, 1.3), (0.0, 1.3)])
+        expected = compiled.compile_scene(objects)
+        _, _, actual = file_parse.stream_scene(io.StringIO(self.SCENE))
+        for field in compiled.ARRAY_FIELDS:
+            np.testing.assert_array_equal(getattr(actual, field), getattr(expected, field), field)
+
+class TestSoftShadows(unittest.TestCase):
+    SCENE = "\n".join([
+        "png 30 20 out.png",
+        "spherelight 1 2 0 0.5",
+        "lightsamples 8",
+        "color 1 0.5 0.5",
+        "arealight 0 3 -1 1 0 0 0 0 0.5",
+        "bulb 0 1 1",
+        "sphere 0 0 -2 0.5",
+    ])
+
+    def make_scene(self):
+        """An area light over a small ball, a big ball, and points on the ground in their shadows or away from them"""
+        objects = scene.SceneObjects()
+        objects.shapes.append(shapes.Sphere(np.array([0, 1, 0]), 0.2, colors.RGBLinear(1, 1, 1)))
+        objects.shapes.append(shapes.Sphere(np.array([5, 1, 0]), 0.9, colors.RGBLinear(1, 1, 1)))
+        objects.lights.append(light.AreaLight(np.array([0, 2, 0]), colors.RGBLinear(1, 1, 1),
+                                              edge1=np.array([1, 0, 0]), edge2=np.array([0, 0, 1])))
+        points = np.array([[0, 0, 0], [10, 0, 0], [-10, 0, 0]])
+        return objects, points
+
+    def test_samples_are_stratified(self):
+        rng = np.random.default_rng(0)
+        probes = sampling.quadrant_samples(rng, 5)
+        self.assertEqual(probes.shape, (5, sampling.PROBES, 2))
+        # one probe in each quarter of the unit square
+        np.testing.assert_array_equal(np.floor(probes * 2), np.broadcast_to([[0, 0], [1, 0], [0, 1], [1, 1]], probes.shape))
+        samples = sampling.stratified_samples(rng, 5, 12)
+        self.assertEqual(samples.shape, (5, 12, 2))
+        # one sample in each row and column of a 12 by 12 grid
+        for axis in range(2):
+            np.testing.assert_array_equal(np.sort(np.floor(samples[..., axis] * 12), axis=1),
+                                          np.broadcast_to(np.arange(12), (5, 12)))
+
+    def test_penumbra(self):
+        objects, points = self.make_scene()
+        scene_arrays = compiled.compile_scene(objects)
+        instrument.enable()
+        try:
+            visibility = batch.soft_visibility(points, 0, scene_arrays, np.random.default_rng(0))
+            counts = dict(instrument.counters)
+        finally:
+            instrument.disable()
+            instrument.reset()
+        self.assertTrue(0 < visibility[0] < 1)
+        np.testing.assert_array_equal(visibility[1:], [0, 1])
+        # the probes settle the points in full shadow or fully lit
+        self.assertEqual(counts["shadow rays"], 3 * sampling.PROBES + 16 - sampling.PROBES)
+        self.assertEqual(counts["soft shadows settled by probes"], 2)
+        soft_light = objects.lights[0]
+        expected = [soft_light.visibility(point, objects.shapes, np.random.default_rng(0)) for point in points]
+        self.assertTrue(0 < expected[0] < 1)
+        self.assertEqual(expected[1:], [0, 1])
+
+    def test_point_sized_lights_match_bulbs(self):
+        objects, meta = make_test_scene()
+        expected = render(raytracer.raytrace_scene, objects, meta)
+        bulb = objects.lights[1]
+        for soft_light in (light.SphereLight(bulb.point, bulb.color, radius=0.0),
+                           light.AreaLight(bulb.point, bulb.color)):
+            objects.lights[1] = soft_light
+            np.testing.assert_array_equal(render(raytracer.raytrace_scene, objects, meta), expected)
+            np.testing.assert_array_equal(render(render_compiled, objects, meta), expected)
+
+    def test_soft_render_is_reproducible(self):
+        objects, meta = make_test_scene(24, 20)
+        objects.lights.append(light.SphereLight(np.array([0, 2, 0]), colors.RGBLinear(1, 1, 1), radius=1.0))
+        scene_arrays = compiled.compile_scene(objects)
+        first = tiles.render_frame(scene_arrays, meta, tile_size=8, seed=5)
+        np.testing.assert_array_equal(tiles.render_frame(scene_arrays, meta, tile_size=8, seed=5), first)
+
+    def test_stream_scene_matches_dataclass_parse(self):
+        _, meta, objects = file_parse.parse_file(io.StringIO(self.SCENE))
+        self.assertEqual([type(source) for source in objects.lights], [light.SphereLight, light.AreaLight, light.Bulb])
+        self.assertEqual([source.samples for source in objects.lights[:2]], [16, 8])
+        with self.assertRaises(ValueError):
+            file_parse.parse_line(["lightsamples", "0"], objects, meta)
+        expected = compiled.compile_scene(objects)
+        np.testing.assert_array_equal(expected.light_samples, [16, 8, 1])
+        _, _, actual = file_parse.stream_scene(io.StringIO(self.SCENE))
+        for field in compiled.ARRAY_FIELDS:
+            np.testing.assert_array_equal(getattr(actual, field), getattr(expected, field), field)
+
+class TestJit(unittest.TestCase):
+    def tearDown(self):
+        jit.disable()
+
+    def test_falls_back_without_numba(self):
+        with unittest.mock.patch.object(jit, "AVAILABLE", False):
+            self.assertFalse(jit.enable())
+        self.assertFalse(jit.enabled)
+
+    @unittest.skipUnless(jit.AVAILABLE, "Numba is not installed")
+    def test_kernels_match_numpy(self):
+        spheres = TestBVH().make_spheres()
+        rng = np.random.default_rng(6)
+        origins = rng.uniform(-6, 6, (500, 3))
+        directions = batch.normalize(rng.normal(size=(500, 3)))
+        max_distances = rng.uniform(0, 8, 500)
+        expected_index, expected_distance = batch.find_closest(spheres, origins, directions)
+        expected_blocked = batch.find_occluded(spheres, origins, directions, max_distances)
+        expected_reflected = batch.reflect(directions, directions[::-1])
+        self.assertTrue(jit.enable())
+        index, distance = batch.find_closest(spheres, origins, directions)
+        np.testing.assert_array_equal(index, expected_index)
+        np.testing.assert_allclose(distance, expected_distance, rtol=1e-12)
+        np.testing.assert_array_equal(batch.find_occluded(spheres, origins, directions, max_distances), expected_blocked)
+        np.testing.assert_allclose(batch.reflect(directions, directions[::-1]), expected_reflected, rtol=1e-12, atol=1e-15)
+
+    @unittest.skipUnless(jit.AVAILABLE, "Numba is not installed")
+    def test_matches_reference_renderer(self):
+        for make_scene in (make_test_scene, TestPlanesAndBoxes().make_scene):
+            objects, meta = make_scene()
+            expected = render(raytracer.raytrace_scene, objects, meta)
+            jit.enable()
+            actual = render(render_compiled, objects, meta)
+            jit.disable()
+            np.testing.assert_array_equal(expected, actual)
+
+class TestCompiledScene(unittest.TestCase):
+    def test_compile_scene(self):
+        objects, meta = make_test_scene()
+        compiled_scene = compiled.compile_scene(objects, accel="none")
+        self.assertEqual(compiled_scene.n_spheres, len(objects.shapes))
+        self.assertEqual(compiled_scene.n_lights, len(objects.lights))
+        np.testing.assert_array_equal(compiled_scene.centers[1], objects.shapes[1].center)
+        np.testing.assert_array_equal(compiled_scene.colors[0], [1, 0.5, 0.2])
+        np.testing.assert_array_equal(compiled_scene.shininess, [0, 0.4, 0])
+        np.testing.assert_array_equal(compiled_scene.is_sun, [True, False])
+        self.assertIsNone(compiled_scene.tree)
+        self.assertTrue(compiled_scene.centers.flags.c_contiguous)
+
+    def test_memory_per_sphere(self):
+        objects, meta = make_test_scene()
+        compiled_scene = compiled.compile_scene(objects)
+        # center, radius, color, shininess, roughness, transparency and ior as float64
+        self.assertEqual(compiled_scene.bytes_per_sphere(), 8 * (3 + 1 + 3 + 1 + 1 + 1 + 1 + 1))
+        self.assertGreaterEqual(compiled_scene.nbytes(), 3 * compiled_scene.bytes_per_sphere())
+
+class TestFileParse(unittest.TestCase):
+    SCENE = "\n".join([
+        "png 30 20 out.png",
+        "color 1 0 0",
+        "sphere 0 0 -1 0.5",
+        "sphere 1 0 -1 0.25",
+        "",
+        "shininess 0.5",
+        "sun 1 1 1",
+        "color 0 0.5 1",
+        "roughness 0.1",
+        "sphere 0 1 -2 0.75",
+        "bulb 0 2 0",
+        "expose 2",
+        "bounces 3",
+        "sphere -1 -1 -3 1",
+    ])
+
+    def test_parse_file(self):
+        image_info, meta, objects = file_parse.parse_file(io.StringIO(self.SCENE))
+        self.assertEqual((image_info.width, image_info.height, image_info.filename), (30, 20, "out.png"))
+        self.assertEqual(len(objects.shapes), 4)
+        self.assertEqual(objects.shapes[1].color, colors.RGBLinear(1, 0, 0))
+        self.assertEqual(objects.shapes[2].shininess, 0.5)
+        self.assertEqual(objects.shapes[2].roughness, 0.1)
+        self.assertEqual(meta.reflection_depth, 3)
+        self.assertAlmostEqual(meta.exposure_function(1.0), 1 - math.e**-2)
+
+    def test_stream_scene_matches_dataclass_parse(self):
+        _, _, objects = file_parse.parse_file(io.StringIO(self.SCENE))
+        expected = compiled.compile_scene(objects)
+        for batch_size in (1, 2, 1 << 16):
+            with unittest.mock.patch.object(file_parse, "SPHERE_BATCH_SIZE", batch_size):
+                _, meta, actual = file_parse.stream_scene(io.StringIO(self.SCENE))
+            for field in compiled.ARRAY_FIELDS:
+                np.testing.assert_array_equal(getattr(actual, field), getattr(expected, field), field)
+            self.assertEqual(meta.reflection_depth, 3)
+
+    def test_stream_scene_empty_file(self):
+        with self.assertRaises(Exception):
+            file_parse.stream_scene(io.StringIO(""))
+
+    def test_short_line_next_to_long_line(self):
+        # together the two lines have the values of two spheres
+        text = "png 4 4 out.png\nsphere 1 2\nsphere 1 2 3 4 5 6\n"
+        with self.assertRaises(IndexError):
+            file_parse.parse_file(io.StringIO(text))
+        with self.assertRaises(IndexError):
+            file_parse.stream_scene(io.StringIO(text))
+        # extra values are ignored by both parsers
+        text = "png 4 4 out.png\nsphere 1 2 3 4 5\nsphere 5 6 7 8\n"
+        _, _, objects = file_parse.parse_file(io.StringIO(text))
+        _, _, streamed = file_parse.stream_scene(io.StringIO(text))
+        np.testing.assert_array_equal(streamed.centers, [[1, 2, 3], [5, 6, 7]])
+        np.testing.assert_array_equal(streamed.radii, compiled.compile_scene(objects).radii)
+
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.scene_path = os.path.join(self.directory.name, "scene.txt")
+        with open(self.scene_path, "w") as file:
+            file.write(TestFileParse.SCENE)
+        self.cache_dir = os.path.join(self.directory.name, "cache")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_round_trip(self):
+        with open(self.scene_path) as file:
+            image_info, meta, expected = file_parse.stream_scene(file, "bvh")
+        _, _, first = cache.load_scene(self.scene_path, self.cache_dir, "bvh")
+        cached_info, cached_meta, actual = cache.load_scene(self.scene_path, self.cache_dir, "bvh")
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+        self.assertEqual(cached_info, image_info)
+        self.assertEqual(cached_meta.reflection_depth, meta.reflection_depth)
+        self.assertEqual(cached_meta.color, meta.color)
+        self.assertEqual(cached_meta.exposure_function(0.5), meta.exposure_function(0.5))
+        self.assertIsInstance(actual.centers, np.memmap)
+        for field in compiled.ARRAY_FIELDS:
+            np.testing.assert_array_equal(getattr(actual, field), getattr(expected, field), field)
+        np.testing.assert_array_equal(actual.tree.order, expected.tree.order)
+
+    def test_changed_file_is_parsed_again(self):
+        cache.load_scene(self.scene_path, self.cache_dir)
+        with open(self.scene_path, "a") as file:
+            file.write("\nsphere 3 3 3 1\n")
+        _, _, actual = cache.load_scene(self.scene_path, self.cache_dir)
+        self.assertEqual(actual.n_spheres, 5)
+
+    def test_other_version_is_replaced(self):
+        cache.load_scene(self.scene_path, self.cache_dir)
+        with unittest.mock.patch.object(cache, "CACHE_VERSION", cache.CACHE_VERSION + 1):
+            with self.assertRaises(ValueError):
+                cache.read(cache.cache_path(self.cache_dir, cache.source_hash(self.scene_path)))
+            _, _, actual = cache.load_scene(self.scene_path, self.cache_dir)
+        self.assertEqual(actual.n_spheres, 4)
+
+class TestAnimation(unittest.TestCase):
+    SCENE = "\n".join([
+        "pngs 24 16 frame 3",
+        "sun 1 1 1",
+        "color 0.5 0.5 0.5",
+    ] + [f"sphere {x} -1 -4 0.3" for x in range(-20, 20)] + [
+        "frame 0",
+        "color 1 0 0",
+        "sphere -1 0 -3 0.5",
+        "frame 2",
+        "shininess 0.5",
+        "sphere 0.5 0 -3 0.5",
+        "bulb 0 2 -2",
+        "frame 1",
+        "sphere 0 0 -3 0.5",
+    ])
+
+    def test_frame_sections(self):
+        sections = file_parse.frame_sections(io.StringIO(self.SCENE), 3)
+        self.assertEqual([len(section) for section in sections], [2, 1, 3])
+        with self.assertRaises(Exception):
+            file_parse.frame_sections(io.StringIO(self.SCENE), 2)
+
+    def test_frames_match_single_images(self):
+        image_info, meta, shared = file_parse.stream_scene(io.StringIO(self.SCENE))
+        self.assertFalse(image_info.is_single_file)
+        self.assertIsNotNone(shared.tree)
+        sections = file_parse.frame_sections(io.StringIO(self.SCENE), image_info.number_of_images)
+        shared_lines = self.SCENE.split("frame 0")[0].splitlines()[1:]
+        for index, section in enumerate(sections):
+            frame_meta, frame = animation.compile_frame(shared, meta, section)
+            self.assertIs(frame.tree, shared.tree)
+            # the same frame written as a single image, with the color reset by `SceneMata.clear`
+            single = "\n".join(["png 24 16 out.png"] + shared_lines + ["color 1 1 1"] + section)
+            _, single_meta, expected = file_parse.stream_scene(io.StringIO(single))
+            for field in compiled.ARRAY_FIELDS:
+                np.testing.assert_array_equal(getattr(frame, field), getattr(expected, field), field)
+            np.testing.assert_array_equal(tiles.render_frame(frame, frame_meta), tiles.render_frame(expected, single_meta))
+        self.assertEqual(meta.color, colors.RGBLinear(0.5, 0.5, 0.5))
+
+    def test_progressive_is_rejected(self):
+        with tempfile.TemporaryDirectory() as directory:
+            scene_path = os.path.join(directory, "frames.txt")
+            with open(scene_path, "w") as file:
+                file.write(self.SCENE)
+            finished = subprocess.run([sys.executable, benchmark.MAIN, scene_path, "--time-budget", "1"],
+                                      cwd=directory, capture_output=True, text=True)
+            self.assertEqual(os.listdir(directory), ["frames.txt"])
+        self.assertEqual(finished.returncode, 1)
+        self.assertIn("--progressive renders single images only", finished.stderr)
+
+class TestProgressive(unittest.TestCase):
+    def test_passes_cover_image_once(self):
+        covered = np.zeros((21, 37), dtype=int)
+        passes = progressive.make_passes(37, 21, 8)
+        self.assertEqual([render_pass.step for render_pass in passes], [8, 4, 2, 1])
+        for render_pass in passes:
+            covered[render_pass.ys, render_pass.xs] += 1
+        np.testing.assert_array_equal(covered, 1)
+        np.testing.assert_array_equal(passes[0].xs % 8, 0)
+
+    def test_full_render_matches_tiles(self):
+        objects, meta = make_test_scene(30, 20)
+        scene_arrays = compiled.compile_scene(objects)
+        previews = []
+        frame, complete = progressive.render_progressive(scene_arrays, meta, first_step=4, preview_interval=0,
+                                                         on_preview=previews.append, chunk_pixels=50)
+        self.assertTrue(complete)
+        np.testing.assert_array_equal(frame, tiles.render_frame(scene_arrays, meta))
+        self.assertGreater(len(previews), 1)
+        # the first preview is the coarse pass blown up to full size
+        np.testing.assert_array_equal(previews[0][:4, :4], np.broadcast_to(batch.encode(frame[0, 0], meta), (4, 4, 4)))
+
+    def test_time_budget_keeps_preview(self):
+        objects, meta = make_test_scene(30, 20)
+        frame, complete = progressive.render_progressive(compiled.compile_scene(objects), meta, first_step=4,
+                                                         time_budget=0, chunk_pixels=10)
+        self.assertFalse(complete)
+        self.assertEqual(frame.shape, (20, 30, 4))
+        # the first chunk of the coarse pass already fills some blocks of the image
+        self.assertGreaterEqual(int(frame[..., 3].astype(bool).sum()), 16)
+
+class TestBenchmark(unittest.TestCase):
+    def test_mismatched_pixels(self):
+        expected = np.zeros((4, 5, 3), dtype=np.uint8)
+        actual = np.zeros((4, 5, 4), dtype=np.uint8)
+        actual[..., 3] = 255
+        actual[0, 0, 0] = 5
+        actual[1, 1, 1] = 6
+        self.assertEqual(benchmark.mismatched_pixels(actual, expected), 1)
+        self.assertEqual(benchmark.mismatched_pixels(actual, expected[:2]), 20)
+
+    def test_run_case_and_compare(self):
+        case = benchmark.Case("tiny", benchmark.synthetic_scene(spheres=5, lights=2, bounces=1, size=12))
+        result = benchmark.run_case(case, reference_dir=None)
+        self.assertEqual(result.ray_counts["primary rays"], 144)
+        self.assertGreater(result.rays, 144)
+        self.assertFalse(instrument.enabled)
+        self.assertGreater(result.peak_memory, 0)
+        self.assertIsNone(result.matches)
+        entry = result.as_dict()
+        slower = dict(entry, wall_time=entry["wall_time"] * 2)
+        self.assertEqual(benchmark.compare_results([entry], [entry]), [])
+        self.assertEqual(len(benchmark.compare_results([slower], [entry])), 1)
+
+    def test_unknown_accel_is_rejected(self):
+        with contextlib.redirect_stderr(io.StringIO()), self.assertRaises(SystemExit):
+            benchmark.main(["--accel", "bhv"])
+
+class TestStartup(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.scene_path = os.path.join(self.directory.name, "scene.txt")
+        with open(self.scene_path, "w") as file:
+            file.write(benchmark.synthetic_scene(spheres=3, size=8))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def imported(self, *args: str) -> "dict[str, float]":
+        times, total = benchmark.import_times(list(args), self.directory.name)
+        self.assertGreater(total, 0)
+        return times
+
+    def test_help_imports_no_renderer(self):
+        times = self.imported("--help")
+        self.assertNotIn("numpy", times)
+        self.assertNotIn("PIL", times)
+        self.assertEqual({name for name in times if name.startswith("src.")}, {"src.utils", "src.instrument"})
+
+    def test_engines_import_only_what_they_use(self):
+        batch_run = self.imported(self.scene_path)
+        self.assertIn("src.tiles", batch_run)
+        for name in ("numba", "src.kernels", "src.progressive", "src.animation", "src.corpus", "src.server",
+                     "src.raytracer", "src.antialias", "src.cache"):
+            self.assertNotIn(name, batch_run)
+        reference_run = self.imported(self.scene_path, "--engine", "reference")
+        self.assertIn("src.raytracer", reference_run)
+        for name in ("numba", "src.batch", "src.tiles", "src.progressive", "src.cache"):
+            self.assertNotIn(name, reference_run)
+
+    def test_parsing_imports_no_image_library(self):
+        loaded = subprocess.run([sys.executable, "-c", "import sys, src.file_parse; print('PIL' in sys.modules)"],
+                                capture_output=True, text=True, check=True, cwd=os.path.dirname(benchmark.MAIN))
+        self.assertEqual(loaded.stdout.strip(), "False")
+
+    @unittest.skipUnless(jit.AVAILABLE, "Numba is not installed")
+    def test_jit_imports_numba(self):
+        self.assertIn("src.kernels", self.imported(self.scene_path, "--jit"))
+
+class TestCorpus(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.scenes = os.path.join(self.directory.name, "scenes")
+        os.makedirs(self.scenes)
+        self.texts = {
+            "a.txt": benchmark.synthetic_scene(spheres=5, size=12).replace("synthetic.png", "a.png"),
+            "b.txt": benchmark.synthetic_scene(spheres=3, bounces=1, size=10).replace("synthetic.png", "b.png"),
+            "broken.txt": "png 4 4 broken.png\nsphere 1 2\n",
+            "notes.md": "not a scene",
+        }
+        for name, text in self.texts.items():
+            with open(os.path.join(self.scenes, name), "w") as file:
+                file.write(text)
+        self.output_dir = os.path.join(self.directory.name, "out")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_parse_args(self):
+        single = utils.parse_args(["main.py", "scene.txt"])
+        self.assertEqual(single.file, "scene.txt")
+        self.assertFalse(single.is_many)
+        self.assertTrue(utils.parse_args(["main.py", "a.txt", "b.txt"]).is_many)
+        self.assertTrue(utils.parse_args(["main.py", self.scenes]).is_many)
+        with contextlib.redirect_stderr(io.StringIO()), self.assertRaises(SystemExit):
+            utils.parse_args(["main.py", "a.txt", "b.txt", "--engine", "reference"])
+
+    def test_render_all(self):
+        scenes = corpus.find_scenes([self.scenes, os.path.join(self.scenes, "a.txt")])
+        self.assertEqual([os.path.basename(path) for path in scenes], ["a.txt", "b.txt", "broken.txt", "a.txt"])
+        settings = corpus.Settings(output_dir=self.output_dir, cache_dir=os.path.join(self.directory.name, "cache"))
+        with contextlib.redirect_stdout(io.StringIO()):
+            results = corpus.render_all(scenes, settings, workers=2)
+        self.assertEqual([result.path for result in results], scenes[:3])
+        self.assertIsNotNone(results[2].error)
+        for name, result in zip(("a", "b"), results):
+            self.assertIsNone(result.error)
+            self.assertEqual(result.outputs, [os.path.join(self.output_dir, name + ".png")])
+            _, meta, scene_arrays = file_parse.stream_scene(io.StringIO(self.texts[name + ".txt"]))
+            expected = batch.encode(tiles.render_frame(scene_arrays, meta), meta)
+            np.testing.assert_array_equal(np.asarray(Image.open(result.outputs[0])), expected)
+        self.assertIn("2 of 3 scenes", corpus.summary(results, 1.0))
+        summary_path = os.path.join(self.output_dir, corpus.SUMMARY)
+        corpus.write_summary(summary_path, results, 1.0, 2)
+        with open(summary_path) as file:
+            self.assertEqual(len(json.load(file)["scenes"]), 3)
+
+class TestServer(unittest.TestCase):
+    SCENE = benchmark.synthetic_scene(spheres=5, lights=2, bounces=1, size=12)
+
+    @classmethod
+    def setUpClass(cls):
+        cls.service = server.RenderService(workers=2)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.service.close()
+
+    def expected_png(self, text: str) -> np.ndarray:
+        _, meta, scene_arrays = file_parse.stream_scene(io.StringIO(text))
+        return batch.encode(tiles.render_frame(scene_arrays, meta), meta)
+
+    def decode(self, png: bytes) -> np.ndarray:
+        return np.asarray(Image.open(io.BytesIO(png)))
+
+    def test_render_reuses_compiled_scenes(self):
+        scene_text = self.SCENE + "sphere 0 0 -3 0.5\n"
+        first, first_timings = self.service.render(scene_text)
+        np.testing.assert_array_equal(self.decode(first), self.expected_png(scene_text))
+        self.assertFalse(first_timings.cached)
+        self.assertGreaterEqual(first_timings.total, first_timings.render)
+        # both workers see the scene once at most before it is cached
+        timings = [self.service.render(scene_text)[1] for _ in range(3)]
+        self.assertTrue(any(timing.cached for timing in timings))
+        report = self.service.report()
+        self.assertGreaterEqual(report["completed"], 4)
+        self.assertGreaterEqual(report["cache_hits"], 1)
+        self.assertEqual(report["in_flight"], 0)
+
+    def test_bad_scene(self):
+        with self.assertRaises(server.SceneError):
+            self.service.render("png 4 4 out.png\nsphere 1 2\n")
+        with self.assertRaises(server.SceneError):
+            self.service.render("pngs 4 4 frame 2\nframe 0\nframe 1\n")
+        self.assertGreaterEqual(self.service.report()["failed"], 2)
+
+    def test_full_queue_is_rejected(self):
+        with server.RenderService(workers=1, queue_size=0) as service:
+            slow = service.submit(benchmark.synthetic_scene(spheres=100, size=100))
+            with self.assertRaises(server.QueueFull):
+                service.submit(self.SCENE)
+            slow.result()
+            service.render(self.SCENE)
+            report = service.report()
+        self.assertEqual((report["completed"], report["rejected"]), (2, 1))
+
+    def test_http(self):
+        http_server = server.make_server(self.service, port=0, log_requests=False)
+        thread = threading.Thread(target=http_server.serve_forever)
+        thread.start()
+        try:
+            url = "http://{}:{}".format(*http_server.server_address)
+            with urllib.request.urlopen(url + "/render?seed=3", data=self.SCENE.encode()) as response:
+                self.assertEqual(response.headers["Content-Type"], "image/png")
+                self.assertGreater(float(response.headers["X-Render-Time"]), 0)
+                np.testing.assert_array_equal(self.decode(response.read()), self.expected_png(self.SCENE))
+            with self.assertRaises(urllib.error.HTTPError) as caught:
+                urllib.request.urlopen(url + "/render", data=b"sphere 1 2")
+            self.assertEqual(caught.exception.code, 400)
+            caught.exception.close()
+            with urllib.request.urlopen(url + "/metrics") as response:
+                self.assertGreaterEqual(json.load(response)["completed"], 1)
+        finally:
+            http_server.shutdown()
+            http_server.server_close()
+            thread.join()
+
+    def test_http_content_length(self):
+        http_server = server.make_server(self.service, port=0, max_bytes=100, log_requests=False)
+        thread = threading.Thread(target=http_server.serve_forever)
+        thread.start()
+        try:
+            for length, status in (("-1", 400), ("many", 400), ("101", 413), (str(1 << 70), 413)):
+                connection = http.client.HTTPConnection(*http_server.server_address)
+                try:
+                    connection.putrequest("POST", "/render")
+                    connection.putheader("Content-Length", length)
+                    connection.endheaders()
+                    self.assertEqual(connection.getresponse().status, status, length)
+                finally:
+                    connection.close()
+        finally:
+            http_server.shutdown()
+            http_server.server_close()
+            thread.join()
+
+    def test_stdio(self):
+        output = io.StringIO()
+        with tempfile.TemporaryDirectory() as directory:
+            unwritable = os.path.join(directory, "missing", "out.png")
+            lines = [json.dumps({"id": "good", "scene": self.SCENE}), "", "not json",
+                     json.dumps({"id": "bad", "scene": "sphere 1 2"}),
+                     json.dumps({"id": "unwritable", "scene": self.SCENE, "output": unwritable})]
+            self.assertEqual(server.serve_stdio(self.service, lines, output), 3)
+        responses = {response["id"]: response for response in map(json.loads, output.getvalue().splitlines())}
+        self.assertEqual(set(responses), {"good", "bad", "unwritable", 2})
+        self.assertIn("Could not write", responses["unwritable"]["error"])
+        png = base64.b64decode(responses["good"]["png"])
+        np.testing.assert_array_equal(self.decode(png), self.expected_png(self.SCENE))
+        self.assertIn("render", responses["good"]["timings"])
+        self.assertIn("error", responses["bad"])
+
+class TestInstrument(unittest.TestCase):
+    def tearDown(self):
+        instrument.disable()
+        instrument.reset()
+
+    def test_disabled_leaves_functions_alone(self):
+        intersection = shapes.Sphere.intersection
+        instrument.enable()
+        self.assertIsNot(shapes.Sphere.intersection, intersection)
+        instrument.disable()
+        self.assertIs(shapes.Sphere.intersection, intersection)
+
+    def test_engines_count_the_same_rays(self):
+        objects, meta = make_test_scene()
+        instrument.enable()
+        render(raytracer.raytrace_scene, objects, meta)
+        reference = dict(instrument.counters)
+        self.assertGreater(instrument.times["trace"], 0)
+        instrument.reset()
+        render(render_compiled, objects, meta)
+        for name in ("primary rays", "shadow rays", "reflection rays"):
+            self.assertEqual(instrument.counters[name], reference[name], name)
+        self.assertGreater(instrument.counters["intersection tests"], 0)
+
+    def test_workers_are_merged(self):
+        objects, meta = make_test_scene()
+        scene_arrays = compiled.compile_scene(objects)
+        instrument.enable()
+        tiles.render_frame(scene_arrays, meta, workers=1, tile_size=8)
+        single = dict(instrument.counters)
+        instrument.reset()
+        tiles.render_frame(scene_arrays, meta, workers=2, tile_size=8)
+        self.assertEqual(dict(instrument.counters), single)